@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Count connections opened by API clients sessions with own default adapters
+and with SharedHTTPAdapter, clients are taken by workers in turn like from
+api_clients_queue.
+
+Usage: python benchmarks/connection_pool.py [clients] [workers] [requests]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import socket
+import sys
+from time import time
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from gevent.queue import Queue
+from requests import Session
+
+from openprocurement.bridge.basic.transport import SharedHTTPAdapter
+
+
+CLIENTS = 20
+WORKERS = 4
+REQUESTS = 2000
+
+
+def application(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', '2')])
+    return ['{}']
+
+
+def opened_connections(sessions):
+    adapters = set(session.get_adapter('http://') for session in sessions)
+    return sum(pool.num_connections for adapter in adapters
+               for pool in (adapter.poolmanager.pools.get(key) for key in adapter.poolmanager.pools.keys()))
+
+
+def measure(url, sessions, workers, requests_count):
+    clients = Queue()
+    for session in sessions:
+        clients.put(session)
+
+    def worker(count):
+        for _ in xrange(count):
+            session = clients.get()
+            session.get(url)
+            clients.put(session)
+
+    start = time()
+    pool = Pool(workers)
+    for _ in xrange(workers):
+        pool.spawn(worker, requests_count // workers)
+    pool.join()
+    return opened_connections(sessions), requests_count / (time() - start)
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else CLIENTS
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else WORKERS
+    requests_count = int(sys.argv[3]) if len(sys.argv) > 3 else REQUESTS
+    # Without TCP_NODELAY test server delays body of response on hot connection until client ACKs headers
+    listener = socket.socket()
+    listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    server = WSGIServer(listener, application, log=None)
+    server.start()
+    url = 'http://127.0.0.1:{}/api/tenders/1'.format(server.server_port)
+    print('{:>16} {:>12} {:>12}'.format('sessions', 'connections', 'requests/s'))
+    print('{:>16} {:>12} {:>12.0f}'.format('own adapters', *measure(url, [Session() for _ in xrange(clients)],
+                                                                       workers, requests_count)))
+    adapter = SharedHTTPAdapter(workers)
+    sessions = [Session() for _ in xrange(clients)]
+    for session in sessions:
+        adapter.mount_to(session)
+    print('{:>16} {:>12} {:>12.0f}'.format('shared adapter', *measure(url, sessions, workers, requests_count)))
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
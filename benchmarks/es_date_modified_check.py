@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Compare dateModified freshness check of BasicElasticSearchFilter modes
+(ElasticsearchStorage.get_date_modified) against local ElasticSearch
+compatible server:
+
+- source: mget with _source_include=dateModified (loads stored _source)
+- docvalue_fields: ids query with docvalue_fields, _source disabled
+
+Usage: python benchmarks/es_date_modified_check.py [host:port] [docs] [doc_size_kb]
+"""
+import sys
+from datetime import datetime
+from time import time
+from uuid import uuid4
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk as es_bulk
+
+from openprocurement.bridge.basic.storages.elasticsearch_plugin import ElasticsearchStorage
+
+
+BULK_SIZE = 100
+ROUNDS = 50
+
+
+def prepare_storage(host, port, lookup, ids, doc_size):
+    index = 'bench_{}'.format(lookup)
+    Elasticsearch('{}:{}'.format(host, port)).indices.delete(index=index, ignore=404)
+    storage = ElasticsearchStorage({'resource': 'tenders', 'storage_config': {
+        'host': host, 'port': port, 'db_name': index, 'alias': '{}_alias'.format(index),
+        'date_modified_lookup': lookup
+    }})
+    padding = 'x' * (doc_size * 1024)
+    actions = ({
+        '_index': storage.alias, '_type': storage.doc_type.title(), '_id': doc_id,
+        '_source': {'id': doc_id, 'dateModified': datetime.now().isoformat(), 'description': padding}
+    } for doc_id in ids)
+    es_bulk(storage.db, actions)
+    storage.db.indices.refresh(index=index)
+    return storage
+
+
+def measure(storage, ids):
+    start = time()
+    for i in xrange(ROUNDS):
+        offset = (i * BULK_SIZE) % len(ids)
+        storage.get_date_modified(ids[offset:offset + BULK_SIZE])
+    return (time() - start) / ROUNDS * 1000
+
+
+def main():
+    host, port = (sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1:9200').split(':')
+    docs = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    doc_size = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    ids = [uuid4().hex for _ in xrange(docs)]
+    print('docs {}, doc size {} KB, bulk {}'.format(docs, doc_size, BULK_SIZE))
+    for lookup in ('source', 'docvalue_fields'):
+        storage = prepare_storage(host, port, lookup, ids, doc_size)
+        # Storage falls back to source if dateModified can't be mapped as keyword
+        print('{:<16} {:.2f} ms per bulk check'.format(storage.date_modified_lookup + ':', measure(storage, ids)))
+        storage.db.indices.delete(index=storage.db_name)
+
+
+if __name__ == '__main__':
+    main()
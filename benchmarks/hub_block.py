@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Measure how long decoding of large public documents blocks gevent hub:
+ticker greenlet sleeps 1 ms in loop and records how late it wakes up while
+workers decode responses inline or in hub thread pool (threadpool_decode_size).
+
+Usage: python benchmarks/hub_block.py [document_kb] [documents]
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import sys
+from time import time
+
+from gevent import sleep, spawn
+from gevent.pool import Pool
+from munch import munchify
+
+from openprocurement.bridge.basic.workers import BasicResourceItemWorker
+
+
+DOCUMENT_KB = 2048
+DOCUMENTS = 20
+WORKERS = 4
+
+
+class StandInClient(object):
+    """ API client stand-in which returns same response body for every item """
+
+    prefix_path = 'http://localhost/api/2.4/tenders'
+
+    def __init__(self, body):
+        self.response = munchify({'status_code': 200, 'content': body})
+
+    def request(self, method, path, headers=None):
+        sleep(0)
+        return self.response
+
+
+def make_body(size_kb):
+    items = [{'id': i, 'description': 'x' * 200, 'quantity': i, 'unit': {'code': 'H87', 'name': 'item'}}
+             for i in xrange(size_kb * 1024 / 300)]
+    return json.dumps({'data': {'id': 'a' * 32, 'dateModified': '2018-01-01T00:00:00+02:00', 'items': items}})
+
+
+def ticker(delays, stop):
+    last = time()
+    while not stop:
+        sleep(0.001)
+        now = time()
+        delays.append(now - last - 0.001)
+        last = now
+
+
+def measure(threadpool_decode_size, body, documents):
+    config = {'resource': 'tenders', 'worker_config': {'bulk_save_limit': 1, 'bulk_save_interval': 1,
+                                                       'threadpool_decode_size': threadpool_decode_size}}
+    worker = BasicResourceItemWorker(config_dict=config)
+    client = StandInClient(body)
+    delays, stop = [], []
+    watcher = spawn(ticker, delays, stop)
+    sleep(0.01)
+    start = time()
+    pool = Pool(WORKERS)
+    for i in xrange(documents):
+        pool.spawn(worker._get_public_document, client, str(i))
+    pool.join()
+    duration = time() - start
+    stop.append(True)
+    watcher.join()
+    delays.sort()
+    return duration, delays[-1] * 1000, delays[int(len(delays) * 0.99)] * 1000, len(delays) / duration
+
+
+def main():
+    size_kb = int(sys.argv[1]) if len(sys.argv) > 1 else DOCUMENT_KB
+    documents = int(sys.argv[2]) if len(sys.argv) > 2 else DOCUMENTS
+    body = make_body(size_kb)
+    print('{} documents of {} KB, {} workers'.format(documents, len(body) / 1024, WORKERS))
+    print('{:>12} {:>10} {:>16} {:>16} {:>12}'.format('decode', 'total, s', 'max block, ms', 'p99 block, ms',
+                                                     'hub loops/s'))
+    for name, threadpool_decode_size in (('inline', 0), ('threadpool', 1)):
+        print('{:>12} {:>10.2f} {:>16.1f} {:>16.1f} {:>12.0f}'.format(name, *measure(threadpool_decode_size, body,
+                                                                                     documents)))
+
+
+if __name__ == '__main__':
+    main()
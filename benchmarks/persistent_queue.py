@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Compare put and get throughput of in-memory DedupPriorityQueue and
+PersistentPriorityQueue with different sync_batch (changes per commit),
+entries of persistent queue are acknowledged right after get.
+
+Usage: python benchmarks/persistent_queue.py [items] [sync_batch ...]
+"""
+import os
+import shutil
+import sys
+from tempfile import mkdtemp
+from time import time
+from uuid import uuid4
+
+from openprocurement.bridge.basic.queues import DedupPriorityQueue, PersistentPriorityQueue
+
+
+ITEMS = 20000
+SYNC_BATCHES = (1, 100, 1000)
+
+
+def measure(queue, items):
+    start = time()
+    for priority, resource_id in items:
+        queue.put((priority, resource_id))
+    put_time = time() - start
+    start = time()
+    for _ in xrange(len(items)):
+        item = queue.get()
+        if isinstance(queue, PersistentPriorityQueue):
+            queue.ack(item[1])
+    get_time = time() - start
+    return len(items) / put_time, len(items) / get_time
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else ITEMS
+    sync_batches = [int(b) for b in sys.argv[2:]] or SYNC_BATCHES
+    items = [(1000 if i % 2 else 1, uuid4().hex) for i in xrange(count)]
+    print('{:>24} {:>14} {:>18}'.format('queue', 'put, items/s', 'get+ack, items/s'))
+    print('{:>24} {:>14.0f} {:>18.0f}'.format('in-memory', *measure(DedupPriorityQueue(), items)))
+    for sync_batch in sync_batches:
+        tmp_dir = mkdtemp()
+        try:
+            queue = PersistentPriorityQueue(os.path.join(tmp_dir, 'queue.sqlite'), sync_batch=sync_batch)
+            print('{:>24} {:>14.0f} {:>18.0f}'.format('sqlite, sync_batch={}'.format(sync_batch),
+                                                      *measure(queue, items)))
+            queue.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
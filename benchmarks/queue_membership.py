@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Compare membership check used by filters on plain gevent PriorityQueue
+(linear scan of heap list) and DedupPriorityQueue (id index).
+
+Usage: python benchmarks/queue_membership.py [depth ...]
+"""
+import sys
+from timeit import timeit
+from uuid import uuid4
+
+from gevent.queue import PriorityQueue
+
+from openprocurement.bridge.basic.queues import DedupPriorityQueue
+
+
+DEPTHS = (10000, 100000, 1000000)
+CHECKS = 100
+
+
+def fill(queue, depth):
+    for i in xrange(depth):
+        queue.put((1000 if i % 2 else 1, uuid4().hex))
+    return queue
+
+
+def main():
+    depths = [int(d) for d in sys.argv[1:]] or DEPTHS
+    print('{:>10} {:>18} {:>18} {:>10}'.format('depth', 'PriorityQueue, us', 'Dedup, us', 'speedup'))
+    for depth in depths:
+        plain = fill(PriorityQueue(), depth)
+        dedup = fill(DedupPriorityQueue(), depth)
+        missing = uuid4().hex
+
+        plain_time = timeit(
+            lambda: (1, missing) not in plain.queue and (1000, missing) not in plain.queue, number=CHECKS
+        ) / CHECKS * 10 ** 6
+        dedup_time = timeit(lambda: missing not in dedup, number=CHECKS) / CHECKS * 10 ** 6
+        print('{:>10} {:>18.2f} {:>18.2f} {:>9.0f}x'.format(depth, plain_time, dedup_time,
+                                                             plain_time / dedup_time))
+
+
+if __name__ == '__main__':
+    main()
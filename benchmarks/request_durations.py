@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Compare request durations bookkeeping of perfomance_watcher: dict keyed by
+request datetime (walked in full every watch interval) and RequestDurations
+ring buffer. Requests are spread over api clients at given rate, time is
+simulated so run takes seconds instead of minutes, clock reads are not
+measured.
+
+Usage: python benchmarks/request_durations.py [rate] [clients] [seconds]
+"""
+import random
+import sys
+from datetime import datetime, timedelta
+from time import time
+
+from openprocurement.bridge.basic.stats import RequestDurations
+
+
+RATE = 1000  # requests per second
+CLIENTS = 10
+SECONDS = 900
+PERFOMANCE_WINDOW = 300
+WATCH_INTERVAL = 10
+SAMPLES = 1024
+
+
+def run_dict(durations, rate, clients, seconds):
+    """ Old bookkeeping, see BasicDataBridge perfomance_watcher before ring buffer """
+    infos = [{} for _ in xrange(clients)]
+    started = datetime.now()
+    add_time = watch_time = 0
+    for second in xrange(seconds):
+        now = started + timedelta(seconds=second)
+        keys = [now + timedelta(microseconds=i) for i in xrange(rate)]
+        start = time()
+        for i in xrange(rate):
+            infos[i % clients][keys[i]] = durations[i]
+        add_time += time() - start
+        if (second + 1) % WATCH_INTERVAL:
+            continue
+        start = time()
+        current_date = now - timedelta(seconds=PERFOMANCE_WINDOW)
+        for info in infos:
+            if info:
+                min(info.keys()) <= current_date
+                round(sum(info.values()) * 1.0 / len(info), 3)
+        current_date = now - timedelta(seconds=PERFOMANCE_WINDOW + WATCH_INTERVAL)
+        for info in infos:
+            for key in [key for key in info if key < current_date]:
+                del info[key]
+        watch_time += time() - start
+    return add_time, watch_time, sum(len(info) for info in infos)
+
+
+def run_ring(durations, rate, clients, seconds):
+    infos = [RequestDurations(SAMPLES) for _ in xrange(clients)]
+    add_time = watch_time = 0
+    for second in xrange(seconds):
+        stamps = [second + i * 1e-6 for i in xrange(rate)]
+        start = time()
+        for i in xrange(rate):
+            infos[i % clients].add(durations[i], now=stamps[i])
+        add_time += time() - start
+        if (second + 1) % WATCH_INTERVAL:
+            continue
+        start = time()
+        for info in infos:
+            if len(info):
+                info.since <= second - PERFOMANCE_WINDOW
+                round(info.mean, 3)
+                info.percentiles(50, 95, 99)
+            info.expire(second - PERFOMANCE_WINDOW - WATCH_INTERVAL)
+        watch_time += time() - start
+    return add_time, watch_time, sum(len(info) for info in infos)
+
+
+def main():
+    rate = int(sys.argv[1]) if len(sys.argv) > 1 else RATE
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else CLIENTS
+    seconds = int(sys.argv[3]) if len(sys.argv) > 3 else SECONDS
+    if seconds < WATCH_INTERVAL:
+        sys.exit('seconds must be at least {} (watch interval)'.format(WATCH_INTERVAL))
+    durations = [random.expovariate(10) for _ in xrange(rate)]
+    adds = rate * seconds
+    watches = seconds // WATCH_INTERVAL
+    print('{} req/s, {} clients, {} s, window {} s'.format(rate, clients, seconds, PERFOMANCE_WINDOW))
+    print('{:>18} {:>10} {:>12} {:>10}'.format('', 'add, us', 'watch, ms', 'samples'))
+    for name, run in (('dict by datetime', run_dict), ('RequestDurations', run_ring)):
+        add_time, watch_time, samples = run(durations, rate, clients, seconds)
+        print('{:>18} {:>10.2f} {:>12.2f} {:>10}'.format(name, add_time / adds * 10 ** 6,
+                                                          watch_time / watches * 1000, samples))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Measure documents saved per second by BasicResourceItemWorker with different
+prefetch_size of full local docs against local CouchDB stand-in: storage
+which answers every request after fixed round trip latency. Default 'meta'
+lookup doesn't prefetch local docs, it is measured for comparison.
+
+Usage: python benchmarks/worker_prefetch.py [docs] [storage_latency_ms] [prefetch_size ...]
+"""
+import json
+import sys
+from datetime import datetime
+from time import time
+from uuid import uuid4
+
+from gevent import sleep
+from gevent.queue import Queue
+
+from openprocurement.bridge.basic.queues import DedupPriorityQueue
+from openprocurement.bridge.basic.stats import RequestDurations
+from openprocurement.bridge.basic.workers import BasicResourceItemWorker
+
+
+PREFETCH_SIZES = (1, 10, 50)
+API_LATENCY = 0.001
+DATE_MODIFIED = datetime.now().isoformat()
+
+
+class StandInStorage(object):
+    """ CouchDB stand-in, every request costs latency seconds """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.docs = {}
+        self.saved = 0
+
+    def get_doc(self, doc_id):
+        sleep(self.latency)
+        return self.docs.get(doc_id)
+
+    def get_docs(self, doc_ids):
+        sleep(self.latency)
+        return {doc_id: self.docs[doc_id] for doc_id in doc_ids if doc_id in self.docs}
+
+    def get_docs_meta(self, doc_ids):
+        sleep(self.latency)
+        return {doc_id: {'_id': doc_id, '_rev': self.docs[doc_id].get('_rev')}
+                for doc_id in doc_ids if doc_id in self.docs}
+
+    def save_bulk(self, bulk):
+        sleep(self.latency)
+        self.saved += len(bulk)
+        self.docs.update(bulk)
+        return [(True, doc_id, '2-{}'.format(uuid4().hex)) for doc_id in bulk]
+
+
+class StandInResponse(object):
+
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = content
+
+
+class StandInClient(object):
+    prefix_path = '/api/2.4/tenders'
+
+    def __init__(self):
+        self.session = type('Session', (object,), {'headers': {'User-Agent': 'benchmark'}})()
+
+    def request(self, method, path, headers=None):
+        sleep(API_LATENCY)
+        resource_item_id = path.rsplit('/', 1)[-1]
+        return StandInResponse(json.dumps({'data': {'id': resource_item_id, 'dateModified': DATE_MODIFIED}}))
+
+
+def measure(docs, latency, prefetch_size, lookup):
+    storage = StandInStorage(latency)
+    queue = DedupPriorityQueue()
+    for _ in xrange(docs):
+        queue.put((1, uuid4().hex))
+    api_clients_queue = Queue()
+    api_client_dict = {'id': uuid4().hex, 'client': StandInClient(), 'request_interval': 0}
+    api_clients_queue.put(api_client_dict)
+    api_clients_info = {api_client_dict['id']: {'drop_cookies': False, 'request_durations': RequestDurations()}}
+    config = {
+        'resource': 'tenders',
+        'worker_config': {
+            'bulk_save_limit': 100, 'bulk_save_interval': 3, 'queue_timeout': 1, 'worker_sleep': 0.01,
+            'retries_count': 10, 'retry_default_timeout': 1,
+            'prefetch_size': prefetch_size, 'local_docs_lookup': lookup
+        }
+    }
+    worker = BasicResourceItemWorker(api_clients_queue=api_clients_queue, resource_items_queue=queue,
+                                     db=storage, config_dict=config, api_clients_info=api_clients_info,
+                                     retry_resource_items_queue=DedupPriorityQueue())
+    start = time()
+    worker.start()
+    while storage.saved + len(worker.bulk) < docs:
+        sleep(0.01)
+    worker.shutdown()
+    worker.join()
+    return docs / (time() - start)
+
+
+def main():
+    docs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.005
+    prefetch_sizes = [int(size) for size in sys.argv[3:]] or PREFETCH_SIZES
+    print('docs {}, storage latency {} ms, API latency {} ms'.format(docs, latency * 1000, API_LATENCY * 1000))
+    print('{:<23}: {:>8.1f} docs/sec'.format('meta', measure(docs, latency, 1, 'meta')))
+    for prefetch_size in prefetch_sizes:
+        print('{:<23}: {:>8.1f} docs/sec'.format('full, prefetch_size {}'.format(prefetch_size),
+                                                measure(docs, latency, prefetch_size, 'full')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from binascii import unhexlify
+from calendar import timegm
+from collections import OrderedDict
+
+from iso8601 import parse_date
+
+
+logger = logging.getLogger(__name__)
+
+# Approximate memory used by one cache entry (32 chars id, iso8601 dateModified
+# and OrderedDict bookkeeping) on CPython 2.7 x86_64, in bytes.
+ENTRY_SIZE = 400
+
+INDEX_MAGIC = 'OPBIDX02'
+INDEX_HEADER = struct.Struct('<8sQQ')  # magic, capacity, count
+INDEX_SLOT = struct.Struct('<B16sq')  # occupied flag, binary id, dateModified as microseconds since epoch
+INDEX_EMPTY = '\x00'
+INDEX_OCCUPIED = 1
+INDEX_MIN_CAPACITY = 1024
+INDEX_MAX_LOAD = 0.7
+# Fields which don't make document changed for ContentHashCache by default, dateModified isn't
+# excluded, otherwise storage would keep stale dateModified of document
+CONTENT_HASH_EXCLUDE = ('doc_type',)
+
+
+def date_modified_to_microseconds(date_modified):
+    """
+    Convert iso8601 dateModified to microseconds since epoch (UTC).
+    Fast path for API format `2018-05-25T13:10:46.124331+03:00`.
+    """
+    try:
+        if len(date_modified) != 32 or date_modified[19] != '.':
+            raise ValueError(date_modified)
+        seconds = timegm((int(date_modified[0:4]), int(date_modified[5:7]), int(date_modified[8:10]),
+                          int(date_modified[11:13]), int(date_modified[14:16]), int(date_modified[17:19])))
+        offset = int(date_modified[27:29]) * 3600 + int(date_modified[30:32]) * 60
+        if date_modified[26] == '-':
+            offset = -offset
+        elif date_modified[26] != '+':
+            raise ValueError(date_modified)
+        return (seconds - offset) * 1000000 + int(date_modified[20:26])
+    except ValueError:
+        dt = parse_date(date_modified)
+        seconds = timegm(dt.utctimetuple())
+        return seconds * 1000000 + dt.microsecond
+
+
+class DateModifiedCache(object):
+    """
+    In-process LRU cache of resource id -> dateModified of documents which
+    are known to be stored in storage.
+
+    :param int memory_limit: Memory cap in megabytes, converted to max entries count by `ENTRY_SIZE`
+    """
+
+    # Cache miss doesn't mean that document is absent in storage
+    authoritative = False
+
+    def __init__(self, memory_limit):
+        self.max_size = int(memory_limit * 1024 * 1024 / ENTRY_SIZE)
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def is_fresh(self, key, date_modified):
+        """ Check that storage already has document with same or newer dateModified """
+        cached = self.get(key)
+        return cached is not None and cached >= date_modified
+
+    def put(self, key, value):
+        """ Store dateModified for key unless cache already has newer one """
+        current = self.data.pop(key, None)
+        if current is not None and current > value:
+            value = current
+        self.data[key] = value
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits * 1.0 / total, 3) if total else 0
+        }
+
+
+class DateModifiedIndex(object):
+    """
+    Memory-mapped open addressing hash table with id -> dateModified of all
+    documents in storage.
+
+    Slot is 25 bytes: occupied flag, 16 bytes binary id (uuid hex ids are
+    unhexlified, other ids are md5 hashed) and 8 bytes dateModified in
+    microseconds since epoch. Capacity is power of two and table grows twice
+    when load factor exceeds 0.7, so index takes 36-72 MB per million
+    documents (52 MB for exactly 1M). Pages are backed by file in page cache,
+    not by python heap.
+
+    Index is filled from storage by `load` and updated by workers after saves.
+    Storage may change while bridge is stopped, so index opened from existing
+    file is `authoritative` (cache miss means that document is absent in
+    storage) only after `load` completes in this process.
+
+    :param str path: Path to index file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.authoritative = False
+        self.hits = 0
+        self.misses = 0
+        self._open()
+
+    def _open(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < INDEX_HEADER.size:
+            self._create(self.path, INDEX_MIN_CAPACITY)
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.capacity, self.count = INDEX_HEADER.unpack_from(self.map, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('Invalid date modified index file {}'.format(self.path))
+
+    @staticmethod
+    def _create(path, capacity):
+        with open(path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, capacity, 0))
+            f.truncate(INDEX_HEADER.size + capacity * INDEX_SLOT.size)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+    @staticmethod
+    def _key(resource_id):
+        if len(resource_id) == 32:
+            try:
+                return unhexlify(resource_id)
+            except TypeError:
+                pass
+        return hashlib.md5(resource_id.encode('utf-8')).digest()
+
+    def _find(self, key):
+        """ Return offset of slot with key or of empty slot where key should be stored """
+        mask = self.capacity - 1
+        slot = struct.unpack_from('<Q', key)[0] & mask
+        while True:
+            offset = INDEX_HEADER.size + slot * INDEX_SLOT.size
+            if self.map[offset] == INDEX_EMPTY:
+                return offset, False
+            if self.map[offset + 1:offset + 17] == key:
+                return offset, True
+            slot = (slot + 1) & mask
+
+    def _grow(self):
+        tmp_path = self.path + '.tmp'
+        old_map, old_file, old_capacity = self.map, self.file, self.capacity
+        self._create(tmp_path, old_capacity * 2)
+        self.file = open(tmp_path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.capacity, self.count = old_capacity * 2, 0
+        for slot in xrange(old_capacity):
+            occupied, key, value = INDEX_SLOT.unpack_from(old_map, INDEX_HEADER.size + slot * INDEX_SLOT.size)
+            if occupied:
+                self._put(key, value)
+        old_map.close()
+        old_file.close()
+        self.map.flush()
+        os.rename(tmp_path, self.path)
+        logger.info('Date modified index grown to {} slots'.format(self.capacity))
+
+    def _put(self, key, value):
+        offset, found = self._find(key)
+        if found:
+            if INDEX_SLOT.unpack_from(self.map, offset)[2] >= value:
+                return
+        else:
+            self.count += 1
+            INDEX_HEADER.pack_into(self.map, 0, INDEX_MAGIC, self.capacity, self.count)
+        INDEX_SLOT.pack_into(self.map, offset, INDEX_OCCUPIED, key, value)
+
+    def put(self, resource_id, date_modified):
+        """ Store dateModified for resource_id unless index already has newer one """
+        if self.count + 1 > self.capacity * INDEX_MAX_LOAD:
+            self._grow()
+        self._put(self._key(resource_id), date_modified_to_microseconds(date_modified))
+
+    def get(self, resource_id):
+        """ :return: dateModified in microseconds since epoch or None """
+        offset, found = self._find(self._key(resource_id))
+        if not found:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return INDEX_SLOT.unpack_from(self.map, offset)[2]
+
+    def is_fresh(self, resource_id, date_modified):
+        """ Check that storage already has document with same or newer dateModified """
+        stored = self.get(resource_id)
+        return stored is not None and stored >= date_modified_to_microseconds(date_modified)
+
+    def load(self, items):
+        """
+        Fill index from storage, index becomes authoritative when all items are loaded
+
+        :param iterable items: Tuples (resource_id, dateModified)
+        """
+        loaded = 0
+        for resource_id, date_modified in items:
+            self.put(resource_id, date_modified)
+            loaded += 1
+            if loaded % 100000 == 0:
+                logger.info('Date modified index loaded {} items'.format(loaded))
+        self.map.flush()
+        logger.info('Date modified index loaded {} items'.format(loaded),
+                    extra={'DATE_MODIFIED_INDEX_LOADED': loaded})
+        self.authoritative = True
+        return loaded
+
+    def __contains__(self, resource_id):
+        return self._find(self._key(resource_id))[1]
+
+    def __len__(self):
+        return self.count
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': self.count,
+            'max_size': int(self.capacity * INDEX_MAX_LOAD),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits * 1.0 / total, 3) if total else 0
+        }
+
+
+class ValidatorsCache(object):
+    """
+    LRU cache of HTTP validators (ETag and Last-Modified) of public resource
+    items for conditional GET requests.
+
+    Validators are stored by `observe` hook of API clients sessions from
+    `200 OK` responses, worker adds dateModified of received document.
+    Worker sends conditional request only when storage already has this
+    dateModified, so `304 Not Modified` means that nothing to save.
+
+    :param int max_size: Max entries count
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # id -> [etag, last_modified, body size, dateModified]
+        self.data = OrderedDict()
+        self.conditional = 0
+        self.not_modified = 0
+        self.bytes_saved = 0
+
+    def observe(self, response, *args, **kwargs):
+        """ `requests` response hook """
+        if response.request.method != 'GET' or response.status_code != 200 or '?' in response.url:
+            return
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return
+        resource_id = response.url.rstrip('/').rsplit('/', 1)[-1]
+        self.data.pop(resource_id, None)
+        self.data[resource_id] = [etag, last_modified, len(response.content), None]
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def put_date_modified(self, resource_id, date_modified):
+        """ Bind dateModified of received document to its validators """
+        entry = self.data.get(resource_id)
+        if entry is not None:
+            entry[3] = date_modified
+
+    def get_date_modified(self, resource_id):
+        entry = self.data.get(resource_id)
+        return entry[3] if entry is not None else None
+
+    def headers(self, resource_id):
+        """
+        :return: Conditional request headers, counted as conditional request
+        :rtype: dict
+        """
+        entry = self.data.pop(resource_id)
+        self.data[resource_id] = entry
+        headers = {}
+        if entry[0] is not None:
+            headers['If-None-Match'] = entry[0]
+        if entry[1] is not None:
+            headers['If-Modified-Since'] = entry[1]
+        self.conditional += 1
+        return headers
+
+    def put_not_modified(self, resource_id):
+        """ Count `304 Not Modified` response """
+        self.not_modified += 1
+        entry = self.data.get(resource_id)
+        if entry is not None:
+            self.bytes_saved += entry[2]
+
+    def __contains__(self, resource_id):
+        return resource_id in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'conditional': self.conditional,
+            'not_modified': self.not_modified,
+            'not_modified_rate': round(self.not_modified * 1.0 / self.conditional, 3) if self.conditional else 0,
+            'bytes_saved': self.bytes_saved
+        }
+
+
+def content_hash(doc, exclude=CONTENT_HASH_EXCLUDE):
+    """
+    MD5 digest of document content without service keys (`_id`, `_rev`,
+    `_ver`, ...) and excluded fields
+    """
+    content = {k: v for k, v in doc.items() if not k.startswith('_') and k not in exclude}
+    return hashlib.md5(json.dumps(content, sort_keys=True)).digest()
+
+
+class ContentHashCache(object):
+    """
+    LRU cache of resource id -> content hash of documents saved to storage.
+
+    Document which differs from stored one only by service keys and excluded
+    fields (by default doc_type) isn't saved again, so storage doesn't get
+    new revision for it.
+
+    :param int max_size: Max entries count
+    :param tuple exclude: Fields ignored by hash
+    """
+
+    def __init__(self, max_size, exclude=CONTENT_HASH_EXCLUDE):
+        self.max_size = max_size
+        self.exclude = tuple(exclude)
+        self.data = OrderedDict()
+        self.skipped = 0
+
+    def is_unchanged(self, doc):
+        """ Check that storage has document with same content, counted as skipped write """
+        stored = self.data.pop(doc['id'], None)
+        if stored is None:
+            return False
+        self.data[doc['id']] = stored
+        if stored != content_hash(doc, self.exclude):
+            return False
+        self.skipped += 1
+        return True
+
+    def put(self, doc):
+        """ Store content hash of saved document """
+        self.data.pop(doc['id'], None)
+        self.data[doc['id']] = content_hash(doc, self.exclude)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def __contains__(self, resource_id):
+        return resource_id in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'skipped': self.skipped
+        }
@@ -2,8 +2,11 @@
 DEFAULTS = {
     'worker_config': {
         'worker_type': 'basic_couchdb',
-        'client_inc_step_timeout': 0.1,
-        'client_dec_step_timeout': 0.02,
+        'client_max_rate': 100,  # requests per second of single API client
+        'client_min_rate': 0.1,
+        'client_rate_increase': 1,  # requests per second added after successful request
+        'client_rate_decrease': 0.5,  # rate multiplier after 429 Too Many Requests
+        'client_burst': 1,
         'drop_threshold_client_cookies': 2,
         'worker_sleep': 5,
         'retry_default_timeout': 3,
@@ -55,6 +58,22 @@ DEFAULTS = {
     'input_queue_size': 10000,
     'resource_items_limit': 1000,
     'queues_controller_timeout': 60,
-    'perfomance_window': 300
+    'perfomance_window': 300,
+    'perfomance_samples': 1024,  # last request durations kept per api client
+    'date_modified_cache_memory': 64,  # megabytes, 0 - disabled
+    'date_modified_index_path': '',  # path to persistent index file, replaces cache if set
+    'validators_cache_size': 100000,  # ETag/Last-Modified entries for conditional requests, 0 - disabled
+    'content_hash_cache_size': 100000,  # content hashes of saved documents to skip not changed, 0 - disabled
+    'content_hash_exclude': ['doc_type'],  # fields which changes alone don't cause write, besides service keys
+    'queues_path': '',  # directory for persistent queues databases, queues are in-memory if empty
+    'queues_sync_batch': 100,
+    'queues_sync_interval': 1,
+    'dead_letters_path': ''  # path to dead letters database, dropped items are only logged if empty
+}
+# Removed worker_config options -> options which replace them
+DEPRECATED_WORKER_CONFIG = {
+    # Requests interval steps are replaced with AIMD rate of API client RateLimiter
+    'client_inc_step_timeout': 'client_rate_decrease',
+    'client_dec_step_timeout': 'client_rate_increase'
 }
 PROCUREMENT_METHOD_TYPE_HANDLERS = {}
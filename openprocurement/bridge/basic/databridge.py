@@ -9,20 +9,29 @@ import math
 import os
 import uuid
 from copy import deepcopy
-from datetime import datetime, timedelta
+from time import time
 from urlparse import urlparse
 
 import gevent.pool
 from gevent import sleep, spawn
-from gevent.queue import PriorityQueue, Queue
 from openprocurement_client.exceptions import RequestFailed
 from openprocurement_client.resources.sync import ResourceFeeder
 from openprocurement_client.resources.tenders import TendersClient as APIClient
 from pkg_resources import iter_entry_points
 from yaml import load
 
-from openprocurement.bridge.basic.constants import DEFAULTS, PROCUREMENT_METHOD_TYPE_HANDLERS
-from openprocurement.bridge.basic.utils import DataBridgeConfigError
+from openprocurement.bridge.basic.caches import (
+    ContentHashCache, DateModifiedCache, DateModifiedIndex, ValidatorsCache
+)
+from openprocurement.bridge.basic.constants import DEFAULTS, DEPRECATED_WORKER_CONFIG, PROCUREMENT_METHOD_TYPE_HANDLERS
+from openprocurement.bridge.basic.queues import (
+    APIClientsQueue, DeadLetterStore, DedupPriorityQueue, InFlightRegistry, PersistentPriorityQueue, RateLimiter,
+    RetryScheduler
+)
+from openprocurement.bridge.basic.stats import RequestDurations
+from openprocurement.bridge.basic.transport import SharedHTTPAdapter
+from openprocurement.bridge.basic.utils import DataBridgeConfigError, accepted_kwargs
+from openprocurement.bridge.basic.writers import BulkWriter
 
 
 try:
@@ -54,6 +63,12 @@ class BasicDataBridge(object):
         self.worker_type = self.config['worker_config'].get('worker_type', 'basic_couchdb')
         self.filter_type = self.config['filter_config'].get('filter_type', 'basic_couchdb')
 
+        # Removed options don't change behaviour anymore
+        for key, replacement in DEPRECATED_WORKER_CONFIG.items():
+            if key in self.config['worker_config']:
+                logger.warning('\'{}\' in \'worker_config\' is deprecated and ignored, use \'{}\''.format(
+                    key, replacement), extra={'MESSAGE_ID': 'deprecated_config'})
+
         # Check up_wait_sleep
         up_wait_sleep = self.retrievers_params.get('up_wait_sleep')
         if up_wait_sleep is not None and up_wait_sleep < 30:
@@ -64,25 +79,33 @@ class BasicDataBridge(object):
         self.workers_pool = gevent.pool.Pool(self.workers_max)
         self.retry_workers_pool = gevent.pool.Pool(self.retry_workers_max)
         self.filter_workers_pool = gevent.pool.Pool(self.filter_workers_count)
+        self.queue_filters = []
+        # Ids which filter greenlets are putting to resource_items_queue right now
+        self.filter_in_flight = {}
+        self.filter_processed = 0
+        self.filter_passed = 0
+        self.filter_stats_time = time()
 
         # Queues
-        if self.input_queue_size == -1:
-            self.input_queue = PriorityQueue()
-        else:
-            self.input_queue = PriorityQueue(self.input_queue_size)
+        self.input_queue = self._create_queue('input_queue', self.input_queue_size)
+        self.resource_items_queue = self._create_queue('resource_items_queue', self.resource_items_queue_size)
 
-        if self.resource_items_queue_size == -1:
-            self.resource_items_queue = PriorityQueue()
+        self.api_clients_queue = APIClientsQueue()
+        # Connection pool shared by API clients, each worker makes single request at a time
+        if self.config['worker_config'].get('shared_connection_pool', True):
+            self.transport = SharedHTTPAdapter(self.workers_max + self.retry_workers_max)
         else:
-            self.resource_items_queue = PriorityQueue(self.resource_items_queue_size)
-
-        self.api_clients_queue = Queue()
+            self.transport = None
         # self.retry_api_clients_queue = Queue()
 
-        if self.retry_resource_items_queue_size == -1:
-            self.retry_resource_items_queue = PriorityQueue()
-        else:
-            self.retry_resource_items_queue = PriorityQueue(self.retry_resource_items_queue_size)
+        self.retry_resource_items_queue = self._create_queue('retry_resource_items_queue',
+                                                             self.retry_resource_items_queue_size)
+        self.retry_scheduler = RetryScheduler(self.retry_resource_items_queue,
+                                              max_delay=self.config['worker_config'].get('retry_max_delay', 300),
+                                              jitter=self.config['worker_config'].get('retry_jitter', 0.1))
+        self.dead_letters = DeadLetterStore(self.dead_letters_path) if self.dead_letters_path else None
+        # Ids which are being fetched by main and retry workers
+        self.in_flight_fetches = InFlightRegistry()
 
         if self.api_host != '' and self.api_host is not None:
             api_host = urlparse(self.api_host)
@@ -97,6 +120,33 @@ class BasicDataBridge(object):
             plugin = entry_point.load()
             self.db = plugin(self.config)
 
+        if self.date_modified_index_path:
+            self.date_modified_cache = DateModifiedIndex(self.date_modified_index_path)
+            if len(self.date_modified_cache) == 0:
+                logger.info('Load date modified index from storage')
+                self.date_modified_cache.load(self.db.iter_date_modified())
+        elif self.date_modified_cache_memory > 0:
+            self.date_modified_cache = DateModifiedCache(self.date_modified_cache_memory)
+        else:
+            self.date_modified_cache = None
+
+        if self.validators_cache_size > 0:
+            self.validators_cache = ValidatorsCache(self.validators_cache_size)
+        else:
+            self.validators_cache = None
+
+        if self.content_hash_cache_size > 0:
+            self.content_hash_cache = ContentHashCache(self.content_hash_cache_size, self.content_hash_exclude)
+        else:
+            self.content_hash_cache = None
+
+        # Opt-in, only BasicResourceItemWorker saves documents through writer
+        if self.config['worker_config'].get('shared_writer', False):
+            self.writer = BulkWriter(self.db, self.config, date_modified_cache=self.date_modified_cache,
+                                     content_hash_cache=self.content_hash_cache)
+        else:
+            self.writer = None
+
         # Register handlers
         handlers = self.config.get('handlers', [])
         for entry_point in iter_entry_points('openprocurement.bridge.basic.handlers'):
@@ -118,6 +168,67 @@ class BasicDataBridge(object):
                                      adaptive=True, with_priority=True)
         self.api_clients_info = {}
 
+    def _spawn_worker(self, resource_items_queue):
+        # Worker plugins get only keyword arguments their constructor accepts
+        kwargs = accepted_kwargs(self.worker_greenlet, {
+            'date_modified_cache': self.date_modified_cache,
+            'writer': self.writer,
+            'retry_scheduler': self.retry_scheduler,
+            'dead_letters': self.dead_letters,
+            'validators_cache': self.validators_cache,
+            'content_hash_cache': self.content_hash_cache,
+            'in_flight_fetches': self.in_flight_fetches
+        })
+        return self.worker_greenlet.spawn(self.api_clients_queue,
+                                          resource_items_queue,
+                                          self.db, self.config,
+                                          self.retry_resource_items_queue,
+                                          self.api_clients_info,
+                                          **kwargs)
+
+    def _create_queue(self, name, size):
+        maxsize = None if size == -1 else size
+        if self.queues_path:
+            return PersistentPriorityQueue(os.path.join(self.queues_path, '{}.sqlite'.format(name)), maxsize,
+                                           sync_batch=self.queues_sync_batch,
+                                           sync_interval=self.queues_sync_interval)
+        return DedupPriorityQueue(maxsize)
+
+    def _spawn_filter(self):
+        kwargs = accepted_kwargs(self.filter_greenlet, {
+            'date_modified_cache': self.date_modified_cache,
+            'pool': self.filter_workers_pool,
+            'in_flight': self.filter_in_flight
+        })
+        return self.filter_greenlet.spawn(self.config, self.input_queue,
+                                          self.resource_items_queue, self.db,
+                                          **kwargs)
+
+    def _spawn_filters(self):
+        if getattr(self.filter_greenlet, 'parallel_workers', False):
+            count = self.filter_workers_count
+        else:
+            count = 1
+        return [self._spawn_filter() for _ in xrange(count)]
+
+    def _log_filters_throughput(self):
+        # Third party filter plugins may not count items
+        processed = sum(getattr(queue_filter, 'processed', 0) for queue_filter in self.queue_filters)
+        passed = sum(getattr(queue_filter, 'passed', 0) for queue_filter in self.queue_filters)
+        now = time()
+        interval = now - self.filter_stats_time
+        # Counters of respawned filters start from zero
+        processed_delta = processed - self.filter_processed if processed >= self.filter_processed else processed
+        passed_delta = passed - self.filter_passed if passed >= self.filter_passed else passed
+        throughput = round(processed_delta / interval, 2) if interval > 0 else 0
+        self.filter_processed, self.filter_passed, self.filter_stats_time = processed, passed, now
+        logger.info(
+            'Filters processed {} items, passed {} items, {} items/sec.'.format(
+                processed_delta, passed_delta, throughput),
+            extra={'FILTER_PROCESSED': processed_delta, 'FILTER_PASSED': passed_delta,
+                   'FILTER_THROUGHPUT': throughput}
+        )
+
     def create_api_client(self):
         client_user_agent = self.user_agent + '/' + self.bridge_id
         timeout = 0.1
@@ -127,6 +238,10 @@ class BasicDataBridge(object):
                     host_url=self.api_host, user_agent=client_user_agent, api_version=self.api_version, key='',
                     resource=self.resource
                 )
+                if self.validators_cache is not None:
+                    api_client.session.hooks['response'].append(self.validators_cache.observe)
+                if self.transport is not None:
+                    self.transport.mount_to(api_client.session)
                 client_id = uuid.uuid4().hex
                 logger.info(
                     'Started api_client {}'.format(api_client.session.headers['User-Agent']),
@@ -134,12 +249,14 @@ class BasicDataBridge(object):
                 api_client_dict = {
                     'id': client_id,
                     'client': api_client,
+                    'limiter': self._create_rate_limiter(),
                     'request_interval': 0,
                     'not_actual_count': 0
                 }
                 self.api_clients_info[api_client_dict['id']] = {
+                    'limiter': api_client_dict['limiter'],
                     'drop_cookies': False,
-                    'request_durations': {},
+                    'request_durations': RequestDurations(self.perfomance_samples),
                     'request_interval': 0,
                     'avg_duration': 0
                 }
@@ -158,6 +275,14 @@ class BasicDataBridge(object):
                 logger.info('create_api_client will be sleep {} sec.'.format(timeout))
                 sleep(timeout)
 
+    def _create_rate_limiter(self):
+        worker_config = self.config['worker_config']
+        return RateLimiter(max_rate=worker_config.get('client_max_rate', 100),
+                           min_rate=worker_config.get('client_min_rate', 0.1),
+                           increase=worker_config.get('client_rate_increase', 1),
+                           decrease=worker_config.get('client_rate_decrease', 0.5),
+                           burst=worker_config.get('client_burst', 1))
+
     def fill_api_clients_queue(self):
         while self.api_clients_queue.qsize() < self.workers_min:
             self.create_api_client()
@@ -176,15 +301,16 @@ class BasicDataBridge(object):
 
     def _get_average_requests_duration(self):
         req_durations = []
-        delta = timedelta(seconds=self.perfomance_window)
-        current_date = datetime.now() - delta
+        current_date = time() - self.perfomance_window
         for cid, info in self.api_clients_info.items():
-            if len(info['request_durations']) > 0:
-                if min(info['request_durations'].keys()) <= current_date:
+            durations = info['request_durations']
+            if len(durations) > 0:
+                if durations.since <= current_date:
                     info['grown'] = True
-                avg = round(sum(info['request_durations'].values()) * 1.0 / len(info['request_durations']), 3)
+                avg = round(durations.mean, 3)
                 req_durations.append(avg)
                 info['avg_duration'] = avg
+                info['percentiles'] = [round(value, 3) for value in durations.percentiles(50, 95, 99)]
 
         if len(req_durations) > 0:
             return round(sum(req_durations) / len(req_durations), 3), req_durations
@@ -201,11 +327,7 @@ class BasicDataBridge(object):
                  ((float(self.resource_items_queue_size) / 100) *
                   self.workers_inc_threshold))):
                 self.create_api_client()
-                w = self.worker_greenlet.spawn(self.api_clients_queue,
-                                               self.resource_items_queue,
-                                               self.db, self.config,
-                                               self.retry_resource_items_queue,
-                                               self.api_clients_info)
+                w = self._spawn_worker(self.resource_items_queue)
                 self.workers_pool.add(w)
                 logger.info('Queue controller: Create main queue worker.')
             elif (self.resource_items_queue.qsize() <
@@ -236,14 +358,16 @@ class BasicDataBridge(object):
                          extra={'MESSAGE_ID': 'exception'})
             self.input_queue_filler = spawn(self.fill_input_queue)
         logger.info('Input threads {}'.format(input_threads), extra={'INPUT_THREADS': input_threads})
-        fill_threads = 1
-        if hasattr(self, 'queue_filter') and self.queue_filter.ready():
-            fill_threads = 0
-            logger.error('Fill thread error: {}'.format(self.queue_filter.exception.message),
-                         extra={'MESSAGE_ID': 'exception'})
-            self.queue_filter = self.filter_greenlet.spawn(self.config, self.input_queue,
-                                                           self.resource_items_queue, self.db)
+        fill_threads = len(self.queue_filters)
+        for i, queue_filter in enumerate(self.queue_filters):
+            if queue_filter.ready():
+                fill_threads -= 1
+                logger.error('Fill thread error: {}'.format(queue_filter.exception.message),
+                             extra={'MESSAGE_ID': 'exception'})
+                self.queue_filters[i] = self._spawn_filter()
         logger.info('Filter threads {}'.format(fill_threads), extra={'FILTER_THREADS': fill_threads})
+        if self.queue_filters:
+            self._log_filters_throughput()
 
         main_threads = self.workers_max - self.workers_pool.free_count()
         logger.info('Main threads {}'.format(main_threads), extra={'MAIN_THREADS': main_threads})
@@ -251,11 +375,7 @@ class BasicDataBridge(object):
         if len(self.workers_pool) < self.workers_min:
             for i in xrange(0, (self.workers_min - len(self.workers_pool))):
                 self.create_api_client()
-                w = self.worker_greenlet.spawn(self.api_clients_queue,
-                                               self.resource_items_queue,
-                                               self.db, self.config,
-                                               self.retry_resource_items_queue,
-                                               self.api_clients_info)
+                w = self._spawn_worker(self.resource_items_queue)
                 self.workers_pool.add(w)
                 logger.info('Watcher: Create main queue worker.')
         retry_threads = self.retry_workers_max - self.retry_workers_pool.free_count()
@@ -263,11 +383,7 @@ class BasicDataBridge(object):
         if len(self.retry_workers_pool) < self.retry_workers_min:
             for i in xrange(0, self.retry_workers_min - len(self.retry_workers_pool)):
                 self.create_api_client()
-                w = self.worker_greenlet.spawn(self.api_clients_queue,
-                                               self.retry_resource_items_queue,
-                                               self.db, self.config,
-                                               self.retry_resource_items_queue,
-                                               self.api_clients_info)
+                w = self._spawn_worker(self.retry_resource_items_queue)
                 self.retry_workers_pool.add(w)
                 logger.info('Watcher: Create retry queue worker.')
 
@@ -278,9 +394,56 @@ class BasicDataBridge(object):
         retry_queue_size = self.retry_resource_items_queue.qsize()
         logger.info('Resource items retry queue size {}'.format(retry_queue_size),
                     extra={'RETRY_QUEUE_SIZE': retry_queue_size})
+        for queue in (self.input_queue, self.resource_items_queue, self.retry_resource_items_queue):
+            if isinstance(queue, PersistentPriorityQueue):
+                queue.sync()
+        if self.retry_scheduler.greenlet is not None and self.retry_scheduler.greenlet.ready():
+            logger.error('Retry scheduler error: {}'.format(self.retry_scheduler.greenlet.exception.message),
+                         extra={'MESSAGE_ID': 'exception'})
+            self.retry_scheduler.start()
+        retry_scheduled = len(self.retry_scheduler)
+        logger.info('Resource items scheduled for retry {}'.format(retry_scheduled),
+                    extra={'RETRY_SCHEDULED': retry_scheduled})
+        stats = self.in_flight_fetches.stats()
+        logger.info('Fetches in flight {in_flight}, duplicates avoided {duplicates}'.format(**stats),
+                    extra={'FETCHES_IN_FLIGHT': stats['in_flight'], 'DUPLICATES_AVOIDED': stats['duplicates']})
         api_clients_count = len(self.api_clients_info)
         logger.info('API Clients count: {}'.format(api_clients_count),
                     extra={'API_CLIENTS': api_clients_count})
+        if self.transport is not None:
+            stats = self.transport.stats()
+            logger.info('API connections opened {handshakes}, reused {reused} of {requests} requests'.format(
+                **stats), extra={'API_HANDSHAKES': stats['handshakes'], 'API_CONNECTIONS_REUSED': stats['reused'],
+                                 'API_CONNECTIONS_REUSE_RATE': stats['reuse_rate']})
+        if self.writer is not None:
+            if self.writer.dispatcher is not None and self.writer.dispatcher.ready():
+                logger.error('Writer error: {}'.format(self.writer.dispatcher.exception.message),
+                             extra={'MESSAGE_ID': 'exception'})
+                self.writer.start()
+            stats = self.writer.stats()
+            logger.info('Writers {writers}, busy {busy}, pending docs {pending}, save latency {latency} ms'.format(
+                **stats), extra={'WRITERS': stats['writers'], 'WRITERS_BUSY': stats['busy'],
+                                 'WRITER_PENDING': stats['pending'], 'SAVE_LATENCY': stats['latency'],
+                                 'WRITER_SAVED': stats['saved']})
+        if self.date_modified_cache is not None:
+            stats = self.date_modified_cache.stats()
+            logger.info('Date modified cache size {size}, hits {hits}, misses {misses}'.format(**stats),
+                        extra={'DATE_MODIFIED_CACHE_SIZE': stats['size'],
+                               'DATE_MODIFIED_CACHE_HITS': stats['hits'],
+                               'DATE_MODIFIED_CACHE_MISSES': stats['misses'],
+                               'DATE_MODIFIED_CACHE_HIT_RATE': stats['hit_rate']})
+        if self.validators_cache is not None:
+            stats = self.validators_cache.stats()
+            logger.info('Conditional requests {conditional}, not modified {not_modified}, '
+                        'bytes saved {bytes_saved}'.format(**stats),
+                        extra={'CONDITIONAL_REQUESTS': stats['conditional'],
+                               'NOT_MODIFIED': stats['not_modified'],
+                               'NOT_MODIFIED_RATE': stats['not_modified_rate'],
+                               'BYTES_SAVED': stats['bytes_saved']})
+        if self.content_hash_cache is not None:
+            stats = self.content_hash_cache.stats()
+            logger.info('Skipped writes of not changed documents {skipped}'.format(**stats),
+                        extra={'SKIPPED_WRITES': stats['skipped'], 'CONTENT_HASH_CACHE_SIZE': stats['size']})
 
     def _calculate_st_dev(self, values):
         if len(values) > 0:
@@ -292,6 +455,14 @@ class BasicDataBridge(object):
         else:
             return 0
 
+    @staticmethod
+    def _is_throttled(info):
+        # Throttled rate recovers gradually, so only recent 429 makes client bad
+        limiter = info.get('limiter')
+        if limiter is not None:
+            return limiter.throttled
+        return info['request_interval'] > 0
+
     def _mark_bad_clients(self, dev):
         # Mark bad api clients
         for cid, info in self.api_clients_info.items():
@@ -301,7 +472,7 @@ class BasicDataBridge(object):
                     'Perfomance watcher: Mark client {} as bad, avg. request_duration is {} sec.'.format(
                         cid, info['avg_duration']),
                     extra={'MESSAGE_ID': 'marked_as_bad'})
-            elif info['avg_duration'] < dev and info['request_interval'] > 0:
+            elif info['avg_duration'] < dev and self._is_throttled(info):
                 info['drop_cookies'] = True
                 logger.debug(
                     'Perfomance watcher: Mark client {} as bad, request_interval is {} sec.'.format(
@@ -310,17 +481,17 @@ class BasicDataBridge(object):
 
     def perfomance_watcher(self):
             avg_duration, values = self._get_average_requests_duration()
-            for _, info in self.api_clients_info.items():
-                delta = timedelta(
-                    seconds=self.perfomance_window + self.watch_interval)
-                current_date = datetime.now() - delta
-                delete_list = []
-                for key in info['request_durations']:
-                    if key < current_date:
-                        delete_list.append(key)
-                for k in delete_list:
-                    del info['request_durations'][k]
-                delete_list = []
+            current_date = time() - self.perfomance_window - self.watch_interval
+            for cid, info in self.api_clients_info.items():
+                info['request_durations'].expire(current_date)
+                percentiles = info.pop('percentiles', None)
+                if percentiles is not None:
+                    p50, p95, p99 = percentiles
+                    logger.debug(
+                        'Perfomance watcher: client {} request duration p50 - {} sec., p95 - {} sec., '
+                        'p99 - {} sec.'.format(cid, p50, p95, p99),
+                        extra={'MESSAGE_ID': 'client_request_durations', 'REQUESTS_P50': p50 * 1000,
+                               'REQUESTS_P95': p95 * 1000, 'REQUESTS_P99': p99 * 1000})
 
             st_dev = self._calculate_st_dev(values)
             if len(values) > 0:
@@ -342,13 +513,96 @@ class BasicDataBridge(object):
                        'REQUESTS_AVG': avg_duration * 1000})
             self._mark_bad_clients(dev)
 
+    def _replay_pending(self):
+        """
+        Check that replayed items are still in queues or retry scheduler, are
+        prefetched, fetched or processed by workers or wait for save in
+        worker bulks or writer
+        """
+        if self.resource_items_queue.qsize() or self.retry_resource_items_queue.qsize() or len(self.retry_scheduler):
+            return True
+        if len(self.in_flight_fetches):
+            return True
+        for worker in list(self.workers_pool) + list(self.retry_workers_pool):
+            if (getattr(worker, 'prefetched', None) or getattr(worker, 'bulk', None) or
+                    len(getattr(worker, 'flushes', ())) or getattr(worker, 'handling', None)):
+                return True
+        return self.writer is not None and bool(self.writer.bulk or self.writer.busy)
+
+    def _replay_left(self, resource_id):
+        """ Check that replayed item wasn't processed, i.e. it is back in queues or waits for retry """
+        return (resource_id in self.resource_items_queue or resource_id in self.retry_resource_items_queue or
+                resource_id in self.retry_scheduler)
+
+    def _stop_workers(self):
+        """
+        Stop workers gracefully: they finish current items, save their bulks
+        and put prefetched items back to queue
+        """
+        for pool in (self.workers_pool, self.retry_workers_pool):
+            for worker in list(pool):
+                worker.shutdown()
+        self.workers_pool.join()
+        self.retry_workers_pool.join()
+        if self.writer is not None:
+            self.writer.flush()
+
+    def replay_dead_letters(self, rate=10, limit=None):
+        """
+        Put items dropped after retries_count retries back to resource items
+        queue with their last priority not faster than rate items per second
+        and wait until workers process them. Items which are processed are
+        removed from dead letters store, items dropped again or left in
+        queues after workers are stopped are kept.
+
+        :param float rate: Items per second
+        :param int limit: Max items count, all items if None
+        :return: Replayed items count
+        """
+        if self.dead_letters is None:
+            raise DataBridgeConfigError('In config dictionary empty or missing \'dead_letters_path\'')
+        start = time()
+        items = self.dead_letters.items(limit)
+        logger.info('Replay {} dead letters with rate {} items/sec'.format(len(items), rate),
+                    extra={'MESSAGE_ID': 'replay_dead_letters'})
+        self.retry_scheduler.start()
+        if self.writer is not None:
+            self.writer.start()
+        for _ in xrange(self.workers_min):
+            self.create_api_client()
+            self.workers_pool.add(self._spawn_worker(self.resource_items_queue))
+        for _ in xrange(self.retry_workers_min):
+            self.create_api_client()
+            self.retry_workers_pool.add(self._spawn_worker(self.retry_resource_items_queue))
+        for item in items:
+            self.resource_items_queue.put((item['priority'], item['item'] if item['item'] is not None else item['id']))
+            sleep(1.0 / rate)
+        while self._replay_pending():
+            if not len(self.workers_pool) and not len(self.retry_workers_pool):
+                logger.error('All workers are stopped, replay is not finished',
+                             extra={'MESSAGE_ID': 'replay_dead_letters'})
+                break
+            sleep(self.watch_interval)
+        self._stop_workers()
+        processed = [item['id'] for item in items if not self._replay_left(item['id'])]
+        removed = self.dead_letters.remove(processed, dropped_before=start)
+        logger.info('Replayed {} dead letters, {} dropped again or not processed'.format(
+            len(items), len(items) - removed), extra={'DEAD_LETTERS_REPLAYED': removed})
+        return len(items)
+
     def run(self):
         logger.info('Start Basic Bridge', extra={'MESSAGE_ID': 'start_basic_bridge'})
         logger.info('Start data sync...', extra={'MESSAGE_ID': 'basic_bridge__data_sync'})
         self.input_queue_filler = spawn(self.fill_input_queue)
+        self.retry_scheduler.start()
+        if self.writer is not None:
+            self.writer.start()
+        if self.date_modified_index_path and not self.date_modified_cache.authoritative:
+            # Index file of previous run is used as cache until it is verified against storage
+            logger.info('Verify date modified index against storage')
+            spawn(self.date_modified_cache.load, self.db.iter_date_modified())
         if hasattr(self, 'filter_greenlet'):
-            self.queue_filter = self.filter_greenlet.spawn(self.config, self.input_queue,
-                                                           self.resource_items_queue, self.db)
+            self.queue_filters = self._spawn_filters()
         else:
             self.resource_items_queue = self.input_queue
         spawn(self.queues_controller)
@@ -360,12 +614,20 @@ class BasicDataBridge(object):
 def main():
     parser = argparse.ArgumentParser(description='---- Basic Data Bridge ----')
     parser.add_argument('config', type=str, help='Path to configuration file')
+    parser.add_argument('command', type=str, nargs='?', default='run', choices=['run', 'replay_dead_letters'],
+                        help='run - sync data, replay_dead_letters - put dropped items back to queue')
+    parser.add_argument('--rate', type=float, default=10, help='Replayed items per second')
+    parser.add_argument('--limit', type=int, default=None, help='Max replayed items count')
     params = parser.parse_args()
     if os.path.isfile(params.config):
         with open(params.config) as config_file_obj:
             config = load(config_file_obj.read())
         logging.config.dictConfig(config)
-        BasicDataBridge(config).run()
+        bridge = BasicDataBridge(config)
+        if params.command == 'replay_dead_letters':
+            bridge.replay_dead_letters(rate=params.rate, limit=params.limit)
+        else:
+            bridge.run()
 
 
 ##############################################################
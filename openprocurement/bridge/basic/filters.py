@@ -14,6 +14,7 @@ from gevent.queue import Empty
 from zope.interface import implementer
 
 from openprocurement.bridge.basic.interfaces import IFilter
+from openprocurement.bridge.basic.queues import PersistentPriorityQueue, next_mark
 from openprocurement.bridge.basic.utils import journal_context
 
 
@@ -24,17 +25,91 @@ INFINITY = True
 @implementer(IFilter)
 class BasicCouchDBFilter(Greenlet):
 
-    def __init__(self, conf, input_queue, filtered_queue, db):
+    # Filter aggregates input queue into bulks, so bridge spawns only one greenlet
+    parallel_workers = False
+
+    def __init__(self, conf, input_queue, filtered_queue, db, date_modified_cache=None, pool=None, in_flight=None):
         logger.info('Init Basic CouchDB Filter')
         Greenlet.__init__(self)
         self.config = conf
         self.input_queue = input_queue
         self.filtered_queue = filtered_queue
         self.db = db
+        self.date_modified_cache = date_modified_cache
+        self.pool = pool
+        self.in_flight = in_flight if in_flight is not None else {}
+        self.failed_checks = {}
+        self.processed = 0
+        self.passed = 0
         self.resource = self.config['resource']
         self.view_path = '_design/{}/_view/by_dateModified'.format(self.resource)
-        self.bulk_query_interval = self.config['storage_config']['bulk_query_interval']
-        self.bulk_query_limit = self.config['storage_config']['bulk_query_limit']
+        self._init_bulk_query_bounds()
+        self._init_feed_items()
+
+    def _init_feed_items(self):
+        # In feed-only mode workers build documents from feed items, so whole
+        # newest feed item is kept until its id is passed or skipped
+        self.feed_only = self.config['worker_config'].get('feed_only', False)
+        self.feed_items = {}
+
+    def _queue_entry(self, item_id):
+        """ Feed item in feed-only mode, resource item id otherwise """
+        return self.feed_items.pop(item_id, item_id)
+
+    def _replace_queued(self, item_id):
+        """
+        Replace feed item which waits in filtered queue with newer one, so
+        worker doesn't build document from stale snapshot.
+
+        :return: True if queued feed item was replaced
+        """
+        feed_item = self.feed_items.pop(item_id, None)
+        return feed_item is not None and self.filtered_queue.replace(feed_item)
+
+    def _forget_feed_item(self, item_id, date_modified):
+        """ Drop skipped feed item, newer one which came meanwhile is kept for next bulk """
+        feed_item = self.feed_items.get(item_id)
+        if feed_item is not None and feed_item['dateModified'] <= date_modified:
+            del self.feed_items[item_id]
+
+    def _init_bulk_query_bounds(self):
+        """
+        Configured bulk_query_limit and bulk_query_interval are start values,
+        controller moves them within bounds from storage_config.
+        """
+        storage_config = self.config['storage_config']
+        self.bulk_query_interval = storage_config['bulk_query_interval']
+        self.bulk_query_limit = storage_config['bulk_query_limit']
+        self.bulk_query_interval_min = storage_config.get('bulk_query_interval_min',
+                                                          min(0.1, self.bulk_query_interval))
+        self.bulk_query_interval_max = storage_config.get('bulk_query_interval_max', self.bulk_query_interval)
+        self.bulk_query_limit_min = storage_config.get('bulk_query_limit_min', max(self.bulk_query_limit // 8, 1))
+        self.bulk_query_limit_max = storage_config.get('bulk_query_limit_max', self.bulk_query_limit * 10)
+
+    def _adapt_bulk_query(self, bulk_size, limit_reached):
+        """
+        Grow bulk while input queue is backlogged, shrink bulk and interval
+        when feed is idle, so single item doesn't wait full interval.
+
+        :param int bulk_size: Count of items in dispatched bulk
+        :param bool limit_reached: Bulk was dispatched by limit, not by interval
+        """
+        limit, interval = self.bulk_query_limit, self.bulk_query_interval
+        if limit_reached:
+            if self.input_queue.qsize() > 0:
+                limit = min(limit * 2, self.bulk_query_limit_max)
+                interval = self.bulk_query_interval_max
+        elif bulk_size <= 1:
+            limit = max(limit / 2, self.bulk_query_limit_min)
+            interval = max(interval / 2.0, self.bulk_query_interval_min)
+        elif bulk_size < limit / 2:
+            limit = max(limit / 2, self.bulk_query_limit_min)
+        if (limit, interval) != (self.bulk_query_limit, self.bulk_query_interval):
+            self.bulk_query_limit, self.bulk_query_interval = limit, interval
+            logger.info(
+                'Bulk query limit {}, interval {} sec.'.format(limit, interval),
+                extra={'BULK_QUERY_LIMIT': limit, 'BULK_QUERY_INTERVAL': interval}
+            )
 
     def _check_bulk(self, bulk, priority_cache):
         sleep_before_retry = 2
@@ -57,22 +132,133 @@ class BasicCouchDBFilter(Greenlet):
                 sleep_before_retry *= 2
         for item_id, date_modified in bulk.items():
             if item_id in resp_dict and date_modified == resp_dict[item_id]:
+                self._forget_feed_item(item_id, date_modified)
                 logger.debug(
                     'Skipped {} {}: In db exist newest.'.format(self.resource[:-1], item_id),
                     extra={'MESSAGE_ID': 'skipped'}
                 )
-            elif ((1, item_id) not in self.filtered_queue.queue and
-                    (1000, item_id) not in self.filtered_queue.queue):
-                self.filtered_queue.put((priority_cache[item_id], item_id))
-                logger.debug(
-                    'Put to main queue {}: {}'.format(self.resource[:-1], item_id),
-                    extra={'MESSAGE_ID': 'add_to_resource_items_queue'}
-                )
             else:
+                self._put_to_filtered_queue(item_id, priority_cache[item_id])
+
+    def _put_to_filtered_queue(self, item_id, priority):
+        if item_id not in self.filtered_queue:
+            self.filtered_queue.put((priority, self._queue_entry(item_id)))
+            self.passed += 1
+            logger.debug(
+                'Put to main queue {}: {}'.format(self.resource[:-1], item_id),
+                extra={'MESSAGE_ID': 'add_to_resource_items_queue'}
+            )
+        elif self._replace_queued(item_id):
+            logger.debug(
+                'Replaced {} {} in queue with newer feed item'.format(self.resource[:-1], item_id),
+                extra={'MESSAGE_ID': 'skipped'}
+            )
+        else:
+            logger.debug(
+                'Skipped {} {}: In queue exist with same id'.format(self.resource[:-1], item_id),
+                extra={'MESSAGE_ID': 'skipped'}
+            )
+
+    def _skip_cached(self, bulk):
+        """
+        Drop from bulk items which dateModified is known from local cache,
+        so only cache misses are sent to storage.
+
+        :param dict bulk: Dict where key: item_id, value: dateModified
+        :return: Dict with items which should be checked in storage
+        :rtype: dict
+        """
+        if self.date_modified_cache is None:
+            return bulk
+        misses = {}
+        for item_id, date_modified in bulk.items():
+            if self.date_modified_cache.is_fresh(item_id, date_modified):
+                self._forget_feed_item(item_id, date_modified)
                 logger.debug(
-                    'Skipped {} {}: In queue exist with same id'.format(self.resource[:-1], item_id),
+                    'Skipped {} {}: In cache exist newest.'.format(self.resource[:-1], item_id),
                     extra={'MESSAGE_ID': 'skipped'}
                 )
+            else:
+                misses[item_id] = date_modified
+        return misses
+
+    def _ack(self, item_ids, mark=None):
+        """ Acknowledge entries of checked items taken from persistent input queue before mark """
+        if isinstance(self.input_queue, PersistentPriorityQueue):
+            for item_id in item_ids:
+                self.input_queue.ack(item_id, mark)
+
+    def _check_bulk_in_flight(self, bulk, priority_cache, mark=None):
+        try:
+            self._check_bulk(bulk, priority_cache)
+            self._ack(bulk, mark)
+        except Exception as e:
+            # Filter greenlet may wait for free pool slot, so items are kept
+            # in filter instead of putting them back to its own input queue
+            logger.error('Bulk check failed, keep {} items for next bulk: {}'.format(len(bulk), e.message),
+                         extra={'MESSAGE_ID': 'exceptions'})
+            for item_id, date_modified in bulk.items():
+                self.failed_checks[item_id] = (date_modified, priority_cache[item_id])
+        finally:
+            for item_id, date_modified in bulk.items():
+                if self.in_flight.get(item_id) == date_modified:
+                    del self.in_flight[item_id]
+
+    def _merge_failed_checks(self, input_dict, priority_cache):
+        """ Add items of failed bulk checks to bulk, keep newest dateModified and highest priority """
+        for item_id, (date_modified, priority) in self.failed_checks.items():
+            if item_id not in input_dict or input_dict[item_id] < date_modified:
+                input_dict[item_id] = date_modified
+            if item_id not in priority_cache or priority < priority_cache[item_id]:
+                priority_cache[item_id] = priority
+        self.failed_checks.clear()
+
+    def _dispatch(self, input_dict, priority_cache):
+        """
+        Check bulk in storage.
+
+        Without pool bulk checked in filter greenlet. With pool check is
+        spawned in it, so up to pool size bulk checks are in flight while
+        filter keeps reading input queue. Items which id is already in flight
+        are left for next bulk.
+
+        Entries taken from input queue before dispatch are acknowledged when
+        their items are checked, items left for next bulk are acknowledged by
+        next dispatch.
+
+        :return: Tuple of dicts (input_dict, priority_cache) with items left for next bulk
+        :rtype: tuple
+        """
+        mark = next_mark()
+        bulk = self._skip_cached(input_dict)
+        self._ack([item_id for item_id in input_dict if item_id not in bulk], mark)
+        if self.date_modified_cache is not None and self.date_modified_cache.authoritative:
+            # Index contains all stored documents, so storage check isn't needed
+            for item_id in bulk:
+                self._put_to_filtered_queue(item_id, priority_cache[item_id])
+            self._ack(bulk, mark)
+            return {}, {}
+        if self.pool is None:
+            if bulk:
+                self._check_bulk(bulk, priority_cache)
+                self._ack(bulk, mark)
+            return {}, {}
+        ready = {}
+        deferred = {}
+        deferred_priority = {}
+        for item_id, date_modified in bulk.items():
+            if item_id in self.in_flight:
+                deferred[item_id] = date_modified
+                deferred_priority[item_id] = priority_cache[item_id]
+            else:
+                ready[item_id] = date_modified
+                self.in_flight[item_id] = date_modified
+        if ready:
+            self.pool.spawn(self._check_bulk_in_flight, ready,
+                            {item_id: priority_cache[item_id] for item_id in ready}, mark)
+        logger.debug('Bulk checks in flight: {}'.format(len(self.pool)),
+                     extra={'CHECK_BULKS_IN_FLIGHT': len(self.pool)})
+        return deferred, deferred_priority
 
     def _run(self):
         start_time = datetime.now()
@@ -91,102 +277,294 @@ class BasicCouchDBFilter(Greenlet):
                 except Empty:
                     resource_item = None
 
-            # Add resource_item to bulk
+            # Add resource_item to bulk, keep newest dateModified and highest priority per id
             if resource_item is not None:
                 logger.debug('Add to input_dict {}'.format(resource_item['id']))
-                input_dict[resource_item['id']] = resource_item['dateModified']
-                priority_cache[resource_item['id']] = priority
-
-            if (len(input_dict) >= self.bulk_query_limit or (datetime.now() - start_time).total_seconds() >=
-                    self.bulk_query_interval):
-                if len(input_dict) > 0:
-                    self._check_bulk(input_dict, priority_cache)
-                    input_dict = {}
-                    priority_cache = {}
+                self.processed += 1
+                item_id = resource_item['id']
+                if item_id not in input_dict or input_dict[item_id] < resource_item['dateModified']:
+                    input_dict[item_id] = resource_item['dateModified']
+                    if self.feed_only:
+                        self.feed_items[item_id] = resource_item
+                if item_id not in priority_cache or priority < priority_cache[item_id]:
+                    priority_cache[item_id] = priority
+
+            limit_reached = len(input_dict) >= self.bulk_query_limit
+            if limit_reached or (datetime.now() - start_time).total_seconds() >= self.bulk_query_interval:
+                self._merge_failed_checks(input_dict, priority_cache)
+                bulk_size = len(input_dict)
+                if bulk_size > 0:
+                    input_dict, priority_cache = self._dispatch(input_dict, priority_cache)
+                self._adapt_bulk_query(bulk_size, limit_reached)
                 start_time = datetime.now()
 
 
 @implementer(IFilter)
 class BasicElasticSearchFilter(BasicCouchDBFilter):
 
-    def __init__(self, conf, input_queue, filtered_queue, db):
+    def __init__(self, conf, input_queue, filtered_queue, db, date_modified_cache=None, pool=None, in_flight=None):
         self.config = conf
         self.input_queue = input_queue
         self.filtered_queue = filtered_queue
         self.db = db
-        self.bulk_query_interval = self.config['storage_config']['bulk_query_interval']
-        self.bulk_query_limit = self.config['storage_config']['bulk_query_limit']
+        self.date_modified_cache = date_modified_cache
+        self.pool = pool
+        self.in_flight = in_flight if in_flight is not None else {}
+        self.failed_checks = {}
+        self.processed = 0
+        self.passed = 0
+        self.resource = self.config['resource']
+        self._init_bulk_query_bounds()
+        self._init_feed_items()
 
     def _check_bulk(self, bulk, priority_cache):
         logger.debug('Send check bulk: {}'.format(len(bulk)), extra={'CHECK_BULK_LEN': len(bulk)})
         start = time()
-        rows = self.db.mget(
-            index=self.db.alias, doc_type=self.db.doc_type.title(),
-            body={"ids": bulk.keys()}, _source_include="dateModified"
-        )
+        # Storage reads dateModified from _source or doc values, see its date_modified_lookup
+        stored = self.db.get_date_modified(bulk.keys())
         end = time() - start
         logger.debug('Duration bulk check: {} sec.'.format(end), extra={'CHECK_BULK_DURATION': end * 1000})
-        for item in rows['docs']:
-            doc_id = item['_id']
-            date_modified = item['_source']['dateModified'] if '_source' in item else item['found']
-            if date_modified != bulk[doc_id] and ((1, doc_id) not in self.filtered_queue.queue and
-                                                  (1000, doc_id) not in self.filtered_queue.queue):
-                self.filtered_queue.put((priority_cache[doc_id], doc_id))
+        for doc_id, date_modified in stored.items():
+            if date_modified != bulk[doc_id] and doc_id not in self.filtered_queue:
+                self.filtered_queue.put((priority_cache[doc_id], self._queue_entry(doc_id)))
+                self.passed += 1
+            elif date_modified != bulk[doc_id] and self._replace_queued(doc_id):
+                logger.debug('Replaced {} in queue with newer feed item'.format(doc_id),
+                             extra={'MESSAGE_ID': 'skipped'})
             else:
+                self._forget_feed_item(doc_id, bulk[doc_id])
                 logger.debug(
                     'Ignored {}: SYNC - {}, ElasticSearch or Queue - {}'.format(doc_id, bulk[doc_id], date_modified),
                     extra={'MESSAGE_ID': 'skipped'}
                 )
 
 
+def get_equality_predicate(expression):
+    """
+    Extract simple equality check of top level field from compiled JMESPath
+    expression, e.g. `status == 'active'` or
+    `contains([`aboveThresholdUA`, `aboveThresholdEU`], procurementMethodType)`
+
+    :return: Tuple (field, frozenset of allowed values) or None
+    """
+    node = expression.parsed
+    children = node['children']
+    if node['type'] == 'comparator' and node['value'] == 'eq':
+        fields = [child['value'] for child in children if child['type'] == 'field']
+        values = [child['value'] for child in children if child['type'] == 'literal']
+        if len(fields) == 1 and len(values) == 1 and isinstance(values[0], basestring):
+            return fields[0], frozenset(values)
+    elif (node['type'] == 'function_expression' and node['value'] == 'contains' and
+          len(children) == 2 and children[1]['type'] == 'field'):
+        if children[0]['type'] == 'literal' and isinstance(children[0]['value'], list):
+            values = children[0]['value']
+        elif (children[0]['type'] == 'multi_select_list' and
+              all(child['type'] == 'literal' for child in children[0]['children'])):
+            values = [child['value'] for child in children[0]['children']]
+        else:
+            return None
+        if all(isinstance(value, basestring) for value in values):
+            return children[1]['value'], frozenset(values)
+    return None
+
+
+class FilterExpression(object):
+    """ Compiled JMESPath expression with pass/fail and timing counters """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.passed = 0
+        self.failed = 0
+        self.duration = 0.0
+
+    def search(self, resource):
+        start = time()
+        result = self.expression.search(resource)
+        self.duration += time() - start
+        if result:
+            self.passed += 1
+        else:
+            self.failed += 1
+        return result
+
+    @property
+    def rank(self):
+        """
+        Average cost per rejected resource, chain sorted by rank rejects
+        resources with least total evaluation time
+        """
+        checked = self.passed + self.failed
+        if not checked:
+            return 0
+        reject_rate = (self.failed + 1.0) / (checked + 2)
+        return self.duration / checked / reject_rate
+
+    def stats(self):
+        return {
+            'expression': self.expression.expression,
+            'passed': self.passed,
+            'failed': self.failed,
+            'duration': self.duration * 1000
+        }
+
+
 @implementer(IFilter)
 class JMESPathFilter(Greenlet):
 
-    def __init__(self, conf, input_queue, filtered_queue, db):
+    # Resources are checked independently, so bridge spawns filter_workers_count
+    # greenlets which share input queue and in_flight dict
+    parallel_workers = True
+
+    def __init__(self, conf, input_queue, filtered_queue, db, date_modified_cache=None, pool=None, in_flight=None):
         logger.info("Init Close Framework Agreement JMESPath Filter.")
         Greenlet.__init__(self)
         self.config = conf
         self.cache_db = db
         self.input_queue = input_queue
         self.filtered_queue = filtered_queue
+        self.in_flight = in_flight if in_flight is not None else {}
+        self.processed = 0
+        self.passed = 0
         self.resource = self.config['resource']
         self.resource_id = "{}_ID".format(self.resource[:-1]).upper()
+        self.reorder_interval = self.config['filter_config'].get('reorder_interval', 1000)
+        self.checked = 0
         self.filters = [jmespath.compile(expression['expression'])
                         for expression in self.config['filter_config'].get('filters', [])]
         self.timeout = self.config['filter_config']['timeout']
+        self.batch_size = self.config['filter_config'].get('batch_size', 100)
+        self.batch_interval = self.config['filter_config'].get('batch_interval', 0.5)
 
-    def _run(self):
-        while INFINITY:
-            if not self.input_queue.empty():
-                priority, resource = self.input_queue.get()
-            else:
-                try:
-                    priority, resource = self.input_queue.get(timeout=self.timeout)
-                except Empty:
-                    sleep(self.timeout)
-                    continue
-
-            cached = self.cache_db.get(resource['id'])
-            if cached and cached == resource['dateModified']:
-                logger.info(
-                    "{} {} not modified from last check. Skipping".format(self.resource[:-1].title(), resource['id']),
-                    extra=journal_context({"MESSAGE_ID": "SKIPPED"}, params={self.resource_id: resource['id']})
-                )
+    @property
+    def filters(self):
+        return self._filters
+
+    @filters.setter
+    def filters(self, filters):
+        """
+        Split compiled expressions to equality predicates, merged into
+        dispatch dict {field: allowed values}, and chain of other expressions.
+        """
+        self._filters = filters
+        self.dispatch = {}
+        self.chain = []
+        for expression in filters:
+            predicate = get_equality_predicate(expression)
+            if predicate is None:
+                self.chain.append(FilterExpression(expression))
                 continue
+            field, values = predicate
+            self.dispatch[field] = self.dispatch[field] & values if field in self.dispatch else values
+        self.dispatch_passed = 0
+        self.dispatch_failed = 0
 
-            for re in self.filters:
-                if re.search(resource):
-                    continue
-                else:
-                    break
-            else:
-                logger.debug(
-                    "Put to filtered queue {} {} {}".format(self.resource[:-1], resource['id'], resource['status'])
-                )
-                self.filtered_queue.put((priority, resource))
+    def _match(self, resource):
+        for field, values in self.dispatch.items():
+            try:
+                found = resource.get(field) in values
+            except TypeError:  # unhashable value can't be equal to string
+                found = False
+            if not found:
+                self.dispatch_failed += 1
+                return False
+        self.dispatch_passed += 1
+        for expression in self.chain:
+            if not expression.search(resource):
+                return False
+        return True
+
+    def _reorder(self):
+        """ Put most selective and cheap expressions first and report counters """
+        self.chain.sort(key=lambda expression: expression.rank)
+        logger.debug('Filter dispatch passed: {}, failed: {}'.format(self.dispatch_passed, self.dispatch_failed),
+                     extra={'FILTER_DISPATCH_PASSED': self.dispatch_passed,
+                            'FILTER_DISPATCH_FAILED': self.dispatch_failed})
+        for position, expression in enumerate(self.chain):
+            stats = expression.stats()
+            logger.debug(
+                'Filter expression #{} {}: passed {}, failed {}, duration {:.3f} ms'.format(
+                    position, stats['expression'], stats['passed'], stats['failed'], stats['duration']),
+                extra={'FILTER_EXPRESSION_PASSED': stats['passed'], 'FILTER_EXPRESSION_FAILED': stats['failed'],
+                       'FILTER_EXPRESSION_DURATION': stats['duration']}
+            )
+
+    def _get_batch(self):
+        """
+        Get from input queue up to batch_size items, waiting for next items
+        not longer than batch_interval after first one.
+
+        :return: List of tuples (priority, resource)
+        :rtype: list
+        """
+        try:
+            batch = [self.input_queue.get(timeout=self.timeout)]
+        except Empty:
+            return []
+        start = time()
+        while len(batch) < self.batch_size:
+            if not self.input_queue.empty():
+                batch.append(self.input_queue.get())
                 continue
+            timeout = self.batch_interval - (time() - start)
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.input_queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
 
+    def _filter_resource(self, priority, resource, cached):
+        if cached and cached == resource['dateModified']:
             logger.info(
-                "Skip {} {}".format(self.resource[:-1], resource['id']),
+                "{} {} not modified from last check. Skipping".format(self.resource[:-1].title(), resource['id']),
                 extra=journal_context({"MESSAGE_ID": "SKIPPED"}, params={self.resource_id: resource['id']})
             )
+            return
+
+        matched = self._match(resource)
+        self.checked += 1
+        if self.reorder_interval and self.checked % self.reorder_interval == 0:
+            self._reorder()
+        if matched:
+            self._put_to_filtered_queue(priority, resource)
+            return
+
+        logger.info(
+            "Skip {} {}".format(self.resource[:-1], resource['id']),
+            extra=journal_context({"MESSAGE_ID": "SKIPPED"}, params={self.resource_id: resource['id']})
+        )
+
+    def _put_to_filtered_queue(self, priority, resource):
+        # Worker gets actual resource from API, so one queued item per id is enough
+        if resource['id'] in self.filtered_queue or resource['id'] in self.in_flight:
+            logger.debug(
+                'Skipped {} {}: In queue exist with same id'.format(self.resource[:-1], resource['id']),
+                extra={'MESSAGE_ID': 'skipped'}
+            )
+            return
+        logger.debug(
+            "Put to filtered queue {} {} {}".format(self.resource[:-1], resource['id'], resource['status'])
+        )
+        # Put may block on full queue, other filter workers must see id as queued meanwhile
+        self.in_flight[resource['id']] = resource['dateModified']
+        try:
+            self.filtered_queue.put((priority, resource))
+            self.passed += 1
+        finally:
+            del self.in_flight[resource['id']]
+
+    def _run(self):
+        while INFINITY:
+            batch = self._get_batch()
+            if not batch:
+                sleep(self.timeout)
+                continue
+
+            # Resolve cache for whole batch with single request
+            cached = self.cache_db.get_many([resource['id'] for _, resource in batch])
+            for priority, resource in batch:
+                self._filter_resource(priority, resource, cached.get(resource['id']))
+                if isinstance(self.input_queue, PersistentPriorityQueue):
+                    self.input_queue.ack_entry((priority, resource))
+            self.processed += len(batch)
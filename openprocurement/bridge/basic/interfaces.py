@@ -22,6 +22,25 @@ class IStorage(Interface):
         :rtype: dict
         """
 
+    def get_docs(self, doc_ids):
+        """
+        Retrieve documents from storage with single request
+
+        :param list doc_ids: Documents ids
+        :return: Dictionary where key is doc_id, value - document. Missing documents are absent.
+        :rtype: dict
+        """
+
+    def get_docs_meta(self, doc_ids):
+        """
+        Retrieve only service keys of documents (revision or version) with single request
+
+        :param list doc_ids: Documents ids
+        :return: Dictionary where key is doc_id, value - dictionary with service keys, e.g. {'_rev': '1-...'}.
+        Missing documents are absent.
+        :rtype: dict
+        """
+
     def save_doc(self, doc):
         """
         Save document to storage
@@ -39,6 +58,14 @@ class IStorage(Interface):
         :rtype: list
         """
 
+    def iter_date_modified(self, batch):
+        """
+        Iterate over dateModified of all documents in storage (optional, used to load date modified index)
+
+        :param int batch: Page size
+        :return: Iterator of tuples (doc_id, dateModified)
+        """
+
 
 class IFilter(Interface):
     """ Databridge Filter Interface based on `gevent.greenlet.Greenlet` """
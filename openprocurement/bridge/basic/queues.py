@@ -0,0 +1,520 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import random
+import sqlite3
+from collections import deque
+from heapq import heapify, heappop, heappush
+from itertools import count
+from time import time
+
+from gevent import spawn
+from gevent.event import Event
+from gevent.queue import PriorityQueue
+
+
+logger = logging.getLogger(__name__)
+INFINITY = True
+# Source of processing marks, see next_mark
+MARKS = count(1)
+
+
+def item_key(item):
+    """
+    Return resource id of queue entry
+
+    :param tuple item: Queue entry (priority, resource_item_id) or (priority, resource_item)
+    :return: Resource id
+    :rtype: str
+    """
+    value = item[1]
+    if isinstance(value, dict):
+        return value['id']
+    return value
+
+
+def next_mark():
+    """
+    Return increasing mark of processing progress. Consumer takes mark when
+    processing of resource starts, entries of resource taken from
+    PersistentPriorityQueue before that mark are acknowledged when
+    processing is done.
+
+    :rtype: int
+    """
+    return next(MARKS)
+
+
+class DedupPriorityQueue(PriorityQueue):
+    """
+    Priority queue which keeps index of resource ids currently stored in queue,
+    so membership check `resource_id in queue` costs O(1) instead of linear scan
+    of heap list.
+    """
+
+    def __init__(self, maxsize=None):
+        self.index = {}
+        PriorityQueue.__init__(self, maxsize)
+
+    def _put(self, item):
+        key = item_key(item)
+        self.index[key] = self.index.get(key, 0) + 1
+        PriorityQueue._put(self, item)
+
+    def _get(self):
+        item = PriorityQueue._get(self)
+        key = item_key(item)
+        left = self.index.get(key, 0) - 1
+        if left > 0:
+            self.index[key] = left
+        else:
+            self.index.pop(key, None)
+        return item
+
+    def __contains__(self, resource_id):
+        return resource_id in self.index
+
+    def replace(self, value):
+        """
+        Replace queued resource item with its newer version, queued entry
+        keeps its priority. Costs linear scan of heap, so it's meant for rare
+        updates of items which wait in queue, e.g. feed items in feed-only
+        mode.
+
+        :param dict value: Resource item with id and dateModified
+        :return: True if queued item was replaced
+        :rtype: bool
+        """
+        if value['id'] not in self.index:
+            return False
+        for i, item in enumerate(self.queue):
+            if item_key(item) != value['id']:
+                continue
+            if isinstance(item[1], dict) and item[1].get('dateModified', '') >= value['dateModified']:
+                return False
+            self._replace(i, (item[0], value))
+            return True
+        return False
+
+    def _replace(self, i, item):
+        self.queue[i] = item
+        heapify(self.queue)
+
+
+class PersistentPriorityQueue(DedupPriorityQueue):
+    """
+    DedupPriorityQueue backed by SQLite database in WAL mode, so entries
+    survive restart of bridge.
+
+    Priority ordering is kept by in-memory heap, database is a log of
+    entries: put inserts row, consumer deletes it with `ack` after entry is
+    processed, i.e. document is saved or dropped. Entries which are taken
+    but not acknowledged (prefetched, waiting for retry or in bulk) are kept,
+    so they are replayed on startup with not taken ones.
+
+    Changes are committed once per sync_batch changes or sync_interval
+    seconds, `sync` commits the rest. Database uses synchronous=NORMAL,
+    commit doesn't fsync, so it doesn't block the hub; WAL is fsynced on
+    checkpoint and committed entries survive bridge crash, but not power loss.
+
+    :param str path: Path to database file
+    :param int maxsize: Queue size, replayed entries may exceed it
+    :param int sync_batch: Changes count per commit
+    :param float sync_interval: Max age of not committed change in seconds
+    """
+
+    def __init__(self, path, maxsize=None, sync_batch=100, sync_interval=1):
+        self.path = path
+        self.sync_batch = sync_batch
+        self.sync_interval = sync_interval
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS items (seq INTEGER PRIMARY KEY, entry TEXT NOT NULL)')
+        self.db.commit()
+        # serialized entry -> seqs of its rows in put order
+        self.seqs = {}
+        # resource id -> list of (mark, seq, serialized entry) of taken not acknowledged rows
+        self.taken = {}
+        self.changes = 0
+        self.last_sync = time()
+        DedupPriorityQueue.__init__(self, maxsize)
+        replayed = self._replay()
+        if replayed:
+            logger.info('Replayed {} items from {}'.format(replayed, path), extra={'QUEUE_REPLAYED': replayed})
+
+    def _replay(self):
+        replayed = 0
+        for seq, entry in self.db.execute('SELECT seq, entry FROM items ORDER BY seq'):
+            self.seqs.setdefault(entry, deque()).append(seq)
+            DedupPriorityQueue._put(self, tuple(json.loads(entry)))
+            replayed += 1
+        return replayed
+
+    def _put(self, item):
+        entry = json.dumps(item, sort_keys=True)
+        seq = self.db.execute('INSERT INTO items (entry) VALUES (?)', (entry,)).lastrowid
+        self.seqs.setdefault(entry, deque()).append(seq)
+        DedupPriorityQueue._put(self, item)
+        self._changed()
+
+    def _get(self):
+        item = DedupPriorityQueue._get(self)
+        entry = json.dumps(item, sort_keys=True)
+        seqs = self.seqs[entry]
+        self.taken.setdefault(item_key(item), []).append((next_mark(), seqs.popleft(), entry))
+        if not seqs:
+            del self.seqs[entry]
+        return item
+
+    def _replace(self, i, item):
+        old_entry = json.dumps(self.queue[i], sort_keys=True)
+        entry = json.dumps(item, sort_keys=True)
+        seqs = self.seqs[old_entry]
+        seq = seqs.popleft()
+        if not seqs:
+            del self.seqs[old_entry]
+        self.db.execute('UPDATE items SET entry = ? WHERE seq = ?', (entry, seq))
+        self.seqs.setdefault(entry, deque()).append(seq)
+        DedupPriorityQueue._replace(self, i, item)
+        self._changed()
+
+    def ack(self, resource_id, mark=None):
+        """
+        Acknowledge entries of resource taken from queue before mark, so
+        entries of same resource taken later by other consumers are kept.
+
+        :param str resource_id: Resource id
+        :param int mark: Mark from next_mark taken when processing started, all taken entries if None
+        :return: Acknowledged entries count
+        :rtype: int
+        """
+        taken = self.taken.get(resource_id)
+        if not taken:
+            return 0
+        acked = [row for row in taken if mark is None or row[0] < mark]
+        if not acked:
+            return 0
+        left = [row for row in taken if mark is not None and row[0] >= mark]
+        if left:
+            self.taken[resource_id] = left
+        else:
+            del self.taken[resource_id]
+        for _, seq, _ in acked:
+            self.db.execute('DELETE FROM items WHERE seq = ?', (seq,))
+        self._changed()
+        return len(acked)
+
+    def ack_entry(self, item):
+        """
+        Acknowledge single taken entry, e.g. dropped one or one put back to queue
+
+        :param tuple item: Queue entry
+        :return: True if entry was taken and not acknowledged
+        :rtype: bool
+        """
+        resource_id = item_key(item)
+        entry = json.dumps(item, sort_keys=True)
+        taken = self.taken.get(resource_id, [])
+        for i, row in enumerate(taken):
+            if row[2] == entry:
+                del taken[i]
+                if not taken:
+                    del self.taken[resource_id]
+                self.db.execute('DELETE FROM items WHERE seq = ?', (row[1],))
+                self._changed()
+                return True
+        return False
+
+    def unacked(self):
+        """ :return: Count of taken not acknowledged entries """
+        return sum(len(taken) for taken in self.taken.values())
+
+    def _changed(self):
+        self.changes += 1
+        if self.changes >= self.sync_batch or time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """ Commit not committed changes """
+        if self.changes:
+            self.db.commit()
+            self.changes = 0
+        self.last_sync = time()
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+
+class DeadLetterStore(object):
+    """
+    SQLite table of resource items dropped after retries_count retries with
+    their last error, so they can be replayed instead of full resync.
+    Item is stored once per id, the last drop replaces previous one.
+
+    :param str path: Path to database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS dead_letters (id TEXT PRIMARY KEY, entry TEXT, '
+                        'priority INTEGER, status_code INTEGER, error TEXT, dropped REAL)')
+        self.db.commit()
+
+    def add(self, item, error=None, status_code=0):
+        """
+        Store dropped item
+
+        :param tuple item: Queue entry (priority, resource_item_id) or (priority, resource_item)
+        :param str error: Last error
+        :param int status_code: Last status code of API response
+        """
+        priority, value = item
+        entry = json.dumps(value) if isinstance(value, dict) else None
+        self.db.execute('INSERT OR REPLACE INTO dead_letters VALUES (?, ?, ?, ?, ?, ?)',
+                        (item_key(item), entry, priority, status_code, error, time()))
+        self.db.commit()
+
+    def items(self, limit=None):
+        """
+        :return: Stored items as dicts ordered by drop time
+        :rtype: list
+        """
+        rows = self.db.execute('SELECT id, entry, priority, status_code, error, dropped FROM dead_letters '
+                               'ORDER BY dropped LIMIT ?', (limit if limit is not None else -1,))
+        return [{'id': row[0], 'item': json.loads(row[1]) if row[1] is not None else None, 'priority': row[2],
+                 'status_code': row[3], 'error': row[4], 'dropped': row[5]} for row in rows]
+
+    def remove(self, ids, dropped_before=None):
+        """
+        Remove items, items dropped again after dropped_before timestamp are kept
+
+        :return: Removed items count
+        """
+        removed = 0
+        for resource_id in ids:
+            if dropped_before is None:
+                cursor = self.db.execute('DELETE FROM dead_letters WHERE id = ?', (resource_id,))
+            else:
+                cursor = self.db.execute('DELETE FROM dead_letters WHERE id = ? AND dropped < ?',
+                                         (resource_id, dropped_before))
+            removed += cursor.rowcount
+        self.db.commit()
+        return removed
+
+    def __contains__(self, resource_id):
+        return self.db.execute('SELECT 1 FROM dead_letters WHERE id = ?', (resource_id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM dead_letters').fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+class RetryScheduler(object):
+    """
+    Time-ordered heap of delayed queue entries. Scheduler greenlet puts
+    entries to queue when they are due, so workers don't sleep to back off.
+
+    :param queue: Queue where due entries are put
+    :param float max_delay: Upper bound of delay in seconds
+    :param float jitter: Delay is randomly changed up to this fraction to spread retries of failed bulk
+    """
+
+    def __init__(self, queue, max_delay=300, jitter=0.1):
+        self.queue = queue
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.heap = []
+        self.index = {}
+        self.counter = count()
+        self.wakeup = Event()
+        self.greenlet = None
+
+    def schedule(self, item, delay):
+        """
+        Put entry to queue after delay seconds
+
+        :param tuple item: Queue entry
+        :param float delay: Delay in seconds
+        """
+        if delay > 0 and self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        delay = min(delay, self.max_delay)
+        if delay <= 0:
+            self.queue.put(item)
+            return
+        due = time() + delay
+        key = item_key(item)
+        self.index[key] = self.index.get(key, 0) + 1
+        heappush(self.heap, (due, next(self.counter), item))
+        if self.heap[0][0] == due:
+            self.wakeup.set()
+
+    def _release(self):
+        now = time()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, item = heappop(self.heap)
+            key = item_key(item)
+            left = self.index.get(key, 0) - 1
+            if left > 0:
+                self.index[key] = left
+            else:
+                self.index.pop(key, None)
+            self.queue.put(item)
+
+    def _run(self):
+        while INFINITY:
+            timeout = max(self.heap[0][0] - time(), 0) if self.heap else None
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            self._release()
+
+    def start(self):
+        self.greenlet = spawn(self._run)
+        return self.greenlet
+
+    def __contains__(self, resource_id):
+        return resource_id in self.index
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class InFlightRegistry(object):
+    """
+    Bridge-wide set of resource ids which are being fetched from public API
+    by main and retry workers.
+
+    Worker which takes id already fetched by other worker drops it instead
+    of downloading same document twice: fetching worker saves the result or
+    puts id to retry queue on failure.
+    """
+
+    def __init__(self):
+        self.ids = set()
+        self.duplicates = 0
+
+    def acquire(self, resource_id):
+        """
+        Register fetch of resource_id
+
+        :return: False if resource_id is already being fetched, counted as avoided duplicate
+        :rtype: bool
+        """
+        if resource_id in self.ids:
+            self.duplicates += 1
+            return False
+        self.ids.add(resource_id)
+        return True
+
+    def release(self, resource_id):
+        self.ids.discard(resource_id)
+
+    def __contains__(self, resource_id):
+        return resource_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def stats(self):
+        return {
+            'in_flight': len(self.ids),
+            'duplicates': self.duplicates
+        }
+
+
+class RateLimiter(object):
+    """
+    Token bucket of API client requests with AIMD rate: rate grows by
+    increase requests per second after each successful request up to
+    max_rate and is multiplied by decrease after `429 Too Many Requests`
+    down to min_rate.
+
+    :param float max_rate: Initial and max requests per second
+    :param float min_rate: Min requests per second
+    :param float increase: Additive rate increase after successful request
+    :param float decrease: Multiplicative rate decrease after throttled request
+    :param int burst: Bucket capacity, requests which can be made at once
+    """
+
+    def __init__(self, max_rate=100, min_rate=0.1, increase=1, decrease=0.5, burst=1):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.rate = max_rate
+        self.tokens = burst
+        self.updated = time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self):
+        """ :return: Timestamp when token is available """
+        now = time()
+        self._refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Take token, bucket goes into debt if it is empty
+
+        :return: Seconds to wait before request
+        :rtype: float
+        """
+        self._refill(time())
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def success(self):
+        self.rate = min(self.rate + self.increase, self.max_rate)
+
+    def throttle(self):
+        self.rate = max(self.rate * self.decrease, self.min_rate)
+        self.tokens = min(self.tokens, 0)
+
+    def reset(self):
+        self.rate = self.max_rate
+        self.tokens = self.burst
+        self.updated = time()
+
+    @property
+    def throttled(self):
+        """ Rate isn't recovered from last decrease yet, i.e. client got `429 Too Many Requests` recently """
+        return self.rate < self.max_rate and self.rate <= self.max_rate * self.decrease
+
+    @property
+    def interval(self):
+        """ Requests interval in seconds imposed by throttling, 0 if rate isn't decreased """
+        return 0 if self.rate >= self.max_rate else round(1.0 / self.rate, 3)
+
+
+class APIClientsQueue(PriorityQueue):
+    """
+    Queue of API clients dicts ordered by time when their `limiter` has
+    token ready, so worker gets client which can make request first instead
+    of waiting for throttled one. Clients without limiter are always ready.
+    """
+
+    def __init__(self, maxsize=None):
+        self.counter = count()
+        PriorityQueue.__init__(self, maxsize)
+
+    def _put(self, item):
+        limiter = item.get('limiter')
+        PriorityQueue._put(self, (limiter.ready_at() if limiter is not None else 0, next(self.counter), item))
+
+    def _get(self):
+        return PriorityQueue._get(self)[2]
+
+    def _peek(self):
+        return self.queue[0][2]
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from array import array
+from time import time
+
+
+class RequestDurations(object):
+    """
+    Fixed-size ring buffer of last requests durations of api client with
+    their timestamps. Adding duration and dropping expired ones are O(1),
+    mean is kept as running sum, percentiles are calculated over samples
+    in buffer when requested.
+
+    :param int size: Max kept samples, oldest are overwritten
+    """
+    __slots__ = ('size', 'times', 'values', 'head', 'count', 'total', 'since')
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.times = array('d', [0.0]) * size
+        self.values = array('d', [0.0]) * size
+        self.reset()
+
+    def reset(self):
+        self.head = 0  # Index of oldest sample
+        self.count = 0
+        self.total = 0.0
+        self.since = None  # Timestamp of first sample since buffer was empty
+
+    def add(self, duration, now=None):
+        now = time() if now is None else now
+        if self.count == self.size:
+            self.total -= self.values[self.head]
+            self.head = (self.head + 1) % self.size
+            self.count -= 1
+        elif self.count == 0:
+            self.since = now
+        index = (self.head + self.count) % self.size
+        self.times[index] = now
+        self.values[index] = duration
+        self.total += duration
+        self.count += 1
+
+    def expire(self, before):
+        """ Drop samples added before `before` timestamp """
+        while self.count and self.times[self.head] < before:
+            self.total -= self.values[self.head]
+            self.head = (self.head + 1) % self.size
+            self.count -= 1
+        if not self.count:
+            self.reset()
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentiles(self, *ranks):
+        """
+        Nearest-rank percentiles of kept durations, 0 for empty buffer
+
+        :param ranks: Percentiles in range (0, 100], 50, 95 and 99 by default
+        :return: list of durations in order of ranks
+        """
+        ranks = ranks or (50, 95, 99)
+        if not self.count:
+            return [0] * len(ranks)
+        values = sorted(self.values[(self.head + i) % self.size] for i in xrange(self.count))
+        return [values[max(int(-(-rank * self.count // 100)) - 1, 0)] for rank in ranks]
@@ -75,9 +75,44 @@ class CouchDBStorage(object):
         """
         return self.db.get(doc_id, default)
 
+    def get_docs(self, doc_ids):
+        """
+        Get docs with single _all_docs request
+        :param doc_ids: list of doc ids
+        :return: dict: doc_id -> doc, missing and deleted docs are absent
+        """
+        if not doc_ids:
+            return {}
+        rows = self.db.view('_all_docs', keys=list(doc_ids), include_docs=True)
+        return {row.key: row.doc for row in rows if row.get('doc')}
+
+    def get_docs_meta(self, doc_ids):
+        """
+        Get docs revisions with single _all_docs request without docs bodies
+        :param doc_ids: list of doc ids
+        :return: dict: doc_id -> {'_id': doc_id, '_rev': rev}, missing and deleted docs are absent
+        """
+        if not doc_ids:
+            return {}
+        rows = self.db.view('_all_docs', keys=list(doc_ids))
+        return {
+            row.key: {'_id': row.key, '_rev': row.value['rev']}
+            for row in rows if row.get('value') and not row.value.get('deleted')
+        }
+
     def save_doc(self, doc):
         return self.db.save(doc)
 
+    def iter_date_modified(self, batch=10000):
+        """
+        Iterate over all documents dateModified by paging through by_dateModified view
+
+        :param int batch: Page size
+        :return: Iterator of tuples (doc_id, dateModified)
+        """
+        for row in self.db.iterview(self.view_path, batch):
+            yield row.id, row.key
+
     def save_bulk(self, bulk):
         """
         Save to storage bulk data
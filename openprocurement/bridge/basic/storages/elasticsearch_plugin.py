@@ -3,6 +3,7 @@ import logging
 from functools import partial
 
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
 from zope.interface import implementer
 
 from openprocurement.bridge.basic.interfaces import IStorage
@@ -12,7 +13,12 @@ STORAGE_DEFAULTS = {
     'host': '127.0.0.1',
     'port': '9200',
     'db_name': 'bridge_db',
-    'alias': 'bridge'
+    'alias': 'bridge',
+    # 'source' - filter reads dateModified from _source with realtime mget,
+    # 'docvalue_fields' - dateModified mapped as keyword and read from doc values with search,
+    # which isn't realtime: docs saved after last index refresh look missing or outdated and are
+    # queued again; falls back to 'source' if existing index maps dateModified otherwise
+    'date_modified_lookup': 'source'
 }
 
 
@@ -31,6 +37,15 @@ class ElasticsearchStorage(object):
         if settings.get(self.db_name, {}).get(u'settings', {}).get(u'index', {}).get(u'mapping', {}) \
                    .get(u'total_fields', {}).get(u'limit', u'1000') != u'4000':
             self.db.indices.put_settings(body={'index.mapping.total_fields.limit': 4000}, index=self.db_name)
+        if self.date_modified_lookup == 'docvalue_fields':
+            res = self.db.indices.put_mapping(
+                index=self.db_name, doc_type=self.doc_type.title(),
+                body={'properties': {'dateModified': {'type': 'keyword', 'doc_values': True}}}, ignore=400
+            )
+            if 'error' in res:
+                # Doc values of dateModified mapped otherwise never equal to feed dateModified
+                LOGGER.error('Can\'t map dateModified as keyword, read it from source: {}'.format(res['error']))
+                self.date_modified_lookup = 'source'
         self.db.index_get = partial(self.db.get, index=self.alias)
         self.db.index_bulk = partial(self.db.bulk, index=self.alias)
 
@@ -86,9 +101,86 @@ class ElasticsearchStorage(object):
             doc = None
         return doc
 
+    def get_docs(self, doc_ids):
+        """
+        Get docs with single mget request
+        :param doc_ids: list of doc ids
+        :return: dict: doc_id -> doc, missing docs are absent
+        """
+        if not doc_ids:
+            return {}
+        res = self.db.mget(index=self.alias, doc_type=self.doc_type.title(), body={'ids': list(doc_ids)})
+        docs = {}
+        for item in res['docs']:
+            if item.get('found') and '_source' in item:
+                doc = item['_source']
+                doc['_ver'] = item['_version']
+                docs[item['_id']] = doc
+        return docs
+
+    def get_docs_meta(self, doc_ids):
+        """
+        Get docs versions with single mget request without _source
+        :param doc_ids: list of doc ids
+        :return: dict: doc_id -> {'_ver': version}, missing docs are absent
+        """
+        if not doc_ids:
+            return {}
+        res = self.db.mget(index=self.alias, doc_type=self.doc_type.title(), body={'ids': list(doc_ids)},
+                           _source=False)
+        return {item['_id']: {'_ver': item['_version']} for item in res['docs'] if item.get('found')}
+
+    def get_date_modified(self, doc_ids):
+        """
+        Get docs dateModified with single request, lookup depends on
+        date_modified_lookup
+        :param doc_ids: list of doc ids
+        :return: dict: doc_id -> dateModified, False for missing docs
+        """
+        if not doc_ids:
+            return {}
+        if self.date_modified_lookup == 'docvalue_fields':
+            return self._get_date_modified_from_doc_values(doc_ids)
+        return self._get_date_modified_from_source(doc_ids)
+
+    def _get_date_modified_from_source(self, doc_ids):
+        res = self.db.mget(index=self.alias, doc_type=self.doc_type.title(), body={'ids': list(doc_ids)},
+                           _source_include='dateModified')
+        return {
+            item['_id']: item['_source']['dateModified'] if '_source' in item else item['found']
+            for item in res['docs']
+        }
+
+    def _get_date_modified_from_doc_values(self, doc_ids):
+        # Search sees docs as of last index refresh
+        res = self.db.search(
+            index=self.alias, doc_type=self.doc_type.title(),
+            body={
+                'query': {'ids': {'values': list(doc_ids)}},
+                '_source': False,
+                'docvalue_fields': ['dateModified'],
+                'size': len(doc_ids)
+            }
+        )
+        result = {doc_id: False for doc_id in doc_ids}
+        for hit in res['hits']['hits']:
+            result[hit['_id']] = hit.get('fields', {}).get('dateModified', [False])[0]
+        return result
+
     def save_doc(doc):
         pass
 
+    def iter_date_modified(self, batch=10000):
+        """
+        Iterate over all documents dateModified with scroll
+
+        :param int batch: Scroll page size
+        :return: Iterator of tuples (doc_id, dateModified)
+        """
+        for hit in scan(self.db, index=self.alias, doc_type=self.doc_type.title(), size=batch,
+                        query={'_source': ['dateModified']}):
+            yield hit['_id'], hit['_source']['dateModified']
+
 
 def includeme(config):
     return ElasticsearchStorage(config)
@@ -17,6 +17,19 @@ class DbProxy(object):
     def get(self, key):
         return self.db.get(key)
 
+    def get_many(self, keys):
+        """
+        :param list keys: Keys
+        :return: Dict with found keys and their values
+        :rtype: dict
+        """
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
     def put(self, key, value):
         self.set_value(key, value)
 
@@ -37,6 +50,12 @@ class DbRedis(DbProxy):
         self.set_value = self.db.set
         self.has_value = self.db.exists
 
+    def get_many(self, keys):
+        """ Get values with single MGET request """
+        if not keys:
+            return {}
+        return {key: value for key, value in zip(keys, self.db.mget(keys)) if value is not None}
+
 
 class DbLazy(DbProxy):
     """ Database proxy for LazyDB """
@@ -50,6 +50,9 @@ class AdaptiveCache(object):
     def get(self, key):
         return self.data.get(key, '')
 
+    def get_many(self, keys):
+        return {key: self.data[key] for key in keys if key in self.data}
+
     def put(self, key, value):
         self.data[key] = value
 
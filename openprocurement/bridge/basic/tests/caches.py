@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+from uuid import uuid4
+
+from munch import munchify
+
+from openprocurement.bridge.basic.caches import (
+    ContentHashCache,
+    DateModifiedCache,
+    DateModifiedIndex,
+    ENTRY_SIZE,
+    INDEX_MIN_CAPACITY,
+    ValidatorsCache,
+    content_hash,
+    date_modified_to_microseconds
+)
+
+
+class TestDateModifiedCache(unittest.TestCase):
+
+    def test_init(self):
+        cache = DateModifiedCache(1)
+        self.assertEqual(cache.max_size, 1024 * 1024 / ENTRY_SIZE)
+        self.assertEqual(len(cache), 0)
+
+    def test_get_put(self):
+        cache = DateModifiedCache(1)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', '2018-01-02')
+        self.assertEqual(cache.get('a'), '2018-01-02')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Older dateModified never replace newer one
+        cache.put('a', '2018-01-01')
+        self.assertEqual(cache.get('a'), '2018-01-02')
+        cache.put('a', '2018-01-03')
+        self.assertEqual(cache.get('a'), '2018-01-03')
+
+    def test_is_fresh(self):
+        cache = DateModifiedCache(1)
+        cache.put('a', '2018-01-02')
+        self.assertTrue(cache.is_fresh('a', '2018-01-01'))
+        self.assertTrue(cache.is_fresh('a', '2018-01-02'))
+        self.assertFalse(cache.is_fresh('a', '2018-01-03'))
+        self.assertFalse(cache.is_fresh('b', '2018-01-01'))
+        self.assertEqual(cache.stats(), {
+            'size': 1, 'max_size': cache.max_size, 'hits': 3, 'misses': 1, 'hit_rate': 0.75
+        })
+
+    def test_lru_eviction(self):
+        cache = DateModifiedCache(1)
+        cache.max_size = 2
+        cache.put('a', '2018-01-01')
+        cache.put('b', '2018-01-01')
+        cache.get('a')
+        cache.put('c', '2018-01-01')
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+
+class TestDateModifiedIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_date_modified_to_microseconds(self):
+        self.assertEqual(date_modified_to_microseconds('1970-01-01T03:00:01.000002+03:00'), 1000002)
+        self.assertEqual(date_modified_to_microseconds('1970-01-01T00:00:01.000002-01:00'), 3601000002)
+        self.assertEqual(date_modified_to_microseconds('1970-01-01T00:00:01Z'), 1000000)
+        self.assertEqual(date_modified_to_microseconds(u'2018-05-25T13:10:46.124331+03:00'),
+                         date_modified_to_microseconds('2018-05-25T10:10:46.124331Z'))
+
+    def test_put_get(self):
+        index = DateModifiedIndex(self.path)
+        resource_id = uuid4().hex
+        self.assertIsNone(index.get(resource_id))
+        self.assertFalse(index.is_fresh(resource_id, '2018-05-25T13:10:46.124331+03:00'))
+
+        index.put(resource_id, '2018-05-25T13:10:46.124331+03:00')
+        self.assertIn(resource_id, index)
+        self.assertEqual(len(index), 1)
+        self.assertTrue(index.is_fresh(resource_id, '2018-05-25T13:10:46.124331+03:00'))
+        self.assertTrue(index.is_fresh(resource_id, '2018-05-25T12:10:46.124331+03:00'))
+        self.assertFalse(index.is_fresh(resource_id, '2018-05-25T14:10:46.124331+03:00'))
+
+        # Older dateModified never replace newer one
+        index.put(resource_id, '2018-05-24T13:10:46.124331+03:00')
+        self.assertTrue(index.is_fresh(resource_id, '2018-05-25T13:10:46.124331+03:00'))
+        self.assertEqual(len(index), 1)
+
+        # Not uuid ids are hashed
+        index.put('not-uuid-id', '2018-05-25T13:10:46.124331+03:00')
+        self.assertIn('not-uuid-id', index)
+        self.assertEqual(len(index), 2)
+
+    def test_grow_and_reopen(self):
+        index = DateModifiedIndex(self.path)
+        ids = [uuid4().hex for _ in xrange(INDEX_MIN_CAPACITY)]
+        index.load((resource_id, '2018-05-25T13:10:46.124331+03:00') for resource_id in ids)
+        self.assertEqual(len(index), INDEX_MIN_CAPACITY)
+        self.assertEqual(index.capacity, INDEX_MIN_CAPACITY * 2)
+        index.close()
+
+        index = DateModifiedIndex(self.path)
+        self.assertEqual(len(index), INDEX_MIN_CAPACITY)
+        for resource_id in ids:
+            self.assertTrue(index.is_fresh(resource_id, '2018-05-25T13:10:46.124331+03:00'))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_zero_key(self):
+        index = DateModifiedIndex(self.path)
+        zero_id = '0' * 32
+        self.assertNotIn(zero_id, index)
+        index.put(zero_id, '2018-05-25T13:10:46.124331+03:00')
+        index.put(uuid4().hex, '2018-05-25T13:10:46.124331+03:00')
+        self.assertIn(zero_id, index)
+        self.assertEqual(len(index), 2)
+        self.assertTrue(index.is_fresh(zero_id, '2018-05-25T13:10:46.124331+03:00'))
+        index._grow()
+        self.assertEqual(len(index), 2)
+        self.assertIn(zero_id, index)
+
+    def test_authoritative(self):
+        index = DateModifiedIndex(self.path)
+        self.assertFalse(index.authoritative)
+        index.load([(uuid4().hex, '2018-05-25T13:10:46.124331+03:00')])
+        self.assertTrue(index.authoritative)
+        index.close()
+
+        # Storage could change while index file wasn't updated
+        index = DateModifiedIndex(self.path)
+        self.assertEqual(len(index), 1)
+        self.assertFalse(index.authoritative)
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as f:
+            f.write('x' * 64)
+        with self.assertRaises(ValueError):
+            DateModifiedIndex(self.path)
+
+
+class TestValidatorsCache(unittest.TestCase):
+
+    def response(self, url, status_code=200, method='GET', headers=None):
+        return munchify({'url': url, 'status_code': status_code, 'request': {'method': method},
+                         'headers': headers if headers is not None else {'ETag': '"etag"'}, 'content': 'x' * 10})
+
+    def test_observe(self):
+        cache = ValidatorsCache(2)
+        resource_id = uuid4().hex
+        url = 'http://localhost/api/2.4/tenders/{}'.format(resource_id)
+        cache.observe(self.response(url, status_code=404))
+        cache.observe(self.response(url, method='PATCH'))
+        cache.observe(self.response('http://localhost/api/2.4/tenders?offset=1'))
+        cache.observe(self.response(url, headers={}))
+        self.assertEqual(len(cache), 0)
+
+        cache.observe(self.response(url, headers={'ETag': '"etag"', 'Last-Modified': 'Tue, 02 Jan 2018'}))
+        self.assertEqual(cache.data[resource_id], ['"etag"', 'Tue, 02 Jan 2018', 10, None])
+
+        # Least recently used entry is evicted
+        cache.observe(self.response(url + 'a'))
+        cache.headers(resource_id)
+        cache.observe(self.response(url + 'b'))
+        self.assertIn(resource_id, cache)
+        self.assertNotIn(resource_id + 'a', cache)
+
+    def test_headers_stats(self):
+        cache = ValidatorsCache(10)
+        resource_id = uuid4().hex
+        cache.observe(self.response('http://localhost/api/2.4/tenders/{}'.format(resource_id)))
+        self.assertIsNone(cache.get_date_modified(resource_id))
+        cache.put_date_modified(resource_id, '2018-01-01')
+        cache.put_date_modified(uuid4().hex, '2018-01-01')
+        self.assertEqual(cache.get_date_modified(resource_id), '2018-01-01')
+        self.assertEqual(len(cache), 1)
+
+        self.assertEqual(cache.headers(resource_id), {'If-None-Match': '"etag"'})
+        cache.headers(resource_id)
+        cache.put_not_modified(resource_id)
+        self.assertEqual(cache.stats(), {'size': 1, 'conditional': 2, 'not_modified': 1,
+                                         'not_modified_rate': 0.5, 'bytes_saved': 10})
+
+
+class TestContentHashCache(unittest.TestCase):
+
+    def test_content_hash(self):
+        doc = {'id': uuid4().hex, 'dateModified': '1', 'title': 'test', 'items': [{'b': 1, 'a': 2}]}
+        same = dict(doc, doc_type='Tender', _id=doc['id'], _rev='1-a')
+        self.assertEqual(content_hash(doc), content_hash(same))
+        self.assertNotEqual(content_hash(doc), content_hash(same, exclude=()))
+        self.assertNotEqual(content_hash(doc), content_hash(dict(doc, dateModified='2')))
+        self.assertNotEqual(content_hash(doc), content_hash(dict(doc, title='changed')))
+
+    def test_is_unchanged(self):
+        cache = ContentHashCache(2)
+        doc = {'id': uuid4().hex, 'dateModified': '1', 'title': 'test'}
+        self.assertFalse(cache.is_unchanged(doc))
+        cache.put(doc)
+        self.assertTrue(cache.is_unchanged(dict(doc, _rev='2-a')))
+        self.assertFalse(cache.is_unchanged(dict(doc, dateModified='2')))
+        self.assertFalse(cache.is_unchanged(dict(doc, title='changed')))
+        self.assertEqual(cache.stats(), {'size': 1, 'skipped': 1})
+
+        # Excluded fields are configurable
+        cache = ContentHashCache(2, exclude=['dateModified'])
+        cache.put(doc)
+        self.assertTrue(cache.is_unchanged(dict(doc, dateModified='2')))
+
+        # Least recently used entry is evicted
+        docs = [{'id': uuid4().hex, 'dateModified': '1'} for _ in xrange(2)]
+        cache.put(docs[0])
+        cache.is_unchanged(doc)
+        cache.put(docs[1])
+        self.assertEqual(len(cache), 2)
+        self.assertIn(doc['id'], cache)
+        self.assertNotIn(docs[0]['id'], cache)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestDateModifiedCache))
+    suite.addTest(unittest.makeSuite(TestDateModifiedIndex))
+    suite.addTest(unittest.makeSuite(TestValidatorsCache))
+    suite.addTest(unittest.makeSuite(TestContentHashCache))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -5,18 +5,30 @@ monkey.patch_all()
 import unittest
 import datetime
 import logging
+import os
+import shutil
 import uuid
 from copy import deepcopy
-from gevent import sleep
-from gevent.queue import Queue
+from collections import deque
+from tempfile import mkdtemp
+from time import time
+from gevent import Greenlet, sleep
+from gevent.queue import Empty, Queue
 from couchdb import Server
 from mock import MagicMock, patch
 from munch import munchify
 from openprocurement_client.exceptions import RequestFailed
 
+from openprocurement.bridge.basic.caches import ContentHashCache, ValidatorsCache
 from openprocurement.bridge.basic.databridge import BasicDataBridge
+from openprocurement.bridge.basic.queues import (
+    APIClientsQueue, DeadLetterStore, DedupPriorityQueue, PersistentPriorityQueue, RateLimiter, RetryScheduler
+)
 from openprocurement.bridge.basic.storages.couchdb_plugin import CouchDBStorage
+from openprocurement.bridge.basic.stats import RequestDurations
+from openprocurement.bridge.basic.transport import SharedHTTPAdapter
 from openprocurement.bridge.basic.utils import DataBridgeConfigError
+from openprocurement.bridge.basic.writers import BulkWriter
 from openprocurement.bridge.basic.tests.base import MockedResponse, AlmostAlwaysTrue, TEST_CONFIG
 
 
@@ -24,6 +36,55 @@ logger = logging.getLogger()
 logger.level = logging.DEBUG
 
 
+class ReplayWorker(Greenlet):
+    """ Worker stand-in which processes taken items, failed ones are dropped to dead letters again """
+
+    def __init__(self, resource_items_queue, dead_letters, failed):
+        Greenlet.__init__(self)
+        self.resource_items_queue = resource_items_queue
+        self.dead_letters = dead_letters
+        self.failed = failed
+        self.prefetched = deque()
+        self.taken = []
+        self.exit = False
+
+    def _run(self):
+        while not self.exit:
+            try:
+                item = self.resource_items_queue.get(timeout=0.01)
+            except Empty:
+                continue
+            self.taken.append(item)
+            if item[1] in self.failed:
+                self.dead_letters.add(item, error='Request failed')
+
+    def shutdown(self):
+        self.exit = True
+
+
+class BaselineWorker(Greenlet):
+    """ Worker plugin with constructor signature of older bridge """
+
+    def __init__(self, api_clients_queue=None, resource_items_queue=None, db=None, config_dict=None,
+                 retry_resource_items_queue=None, api_clients_info=None):
+        Greenlet.__init__(self)
+        self.resource_items_queue = resource_items_queue
+
+    def _run(self):
+        pass
+
+
+class BaselineFilter(Greenlet):
+    """ Filter plugin with constructor signature of older bridge """
+
+    def __init__(self, conf, input_queue, filtered_queue, db):
+        Greenlet.__init__(self)
+        self.filtered_queue = filtered_queue
+
+    def _run(self):
+        pass
+
+
 class TestBasicDataBridge(unittest.TestCase):
 
     config = deepcopy(TEST_CONFIG)
@@ -96,6 +157,41 @@ class TestBasicDataBridge(unittest.TestCase):
         self.assertEqual(bridge.api_clients_queue.qsize(),
                          bridge.workers_min)
 
+    @patch('openprocurement.bridge.basic.databridge.APIClient')
+    def test_create_api_client_limiter(self, mock_APIClient):
+        config = deepcopy(self.config)
+        config['main']['worker_config'].update({'client_max_rate': 20, 'client_rate_decrease': 0.25})
+        bridge = BasicDataBridge(config)
+        self.assertIsInstance(bridge.api_clients_queue, APIClientsQueue)
+        bridge.create_api_client()
+        limiter = bridge.api_clients_queue.get()['limiter']
+        self.assertIsInstance(limiter, RateLimiter)
+        self.assertEqual((limiter.max_rate, limiter.min_rate, limiter.increase, limiter.decrease, limiter.burst),
+                         (20, 0.1, 1, 0.25, 1))
+
+    @patch('openprocurement.bridge.basic.databridge.logger')
+    def test_deprecated_worker_config(self, mocked_logger):
+        config = deepcopy(self.config)
+        config['main']['worker_config']['client_inc_step_timeout'] = 0.1
+        BasicDataBridge(config)
+        mocked_logger.warning.assert_called_once_with(
+            '\'client_inc_step_timeout\' in \'worker_config\' is deprecated and ignored, use \'client_rate_decrease\'',
+            extra={'MESSAGE_ID': 'deprecated_config'})
+
+    @patch('openprocurement.bridge.basic.databridge.APIClient')
+    def test_create_api_client_transport(self, mock_APIClient):
+        bridge = BasicDataBridge(self.config)
+        self.assertIsInstance(bridge.transport, SharedHTTPAdapter)
+        self.assertEqual(bridge.transport._pool_maxsize, bridge.workers_max + bridge.retry_workers_max)
+        bridge.transport = MagicMock()
+        bridge.create_api_client()
+        bridge.transport.mount_to.assert_called_once_with(mock_APIClient.return_value.session)
+
+        config = deepcopy(self.config)
+        config['main']['worker_config']['shared_connection_pool'] = False
+        bridge = BasicDataBridge(config)
+        self.assertIsNone(bridge.transport)
+
     def test_fill_input_queue(self):
         bridge = BasicDataBridge(self.config)
         return_value = [(
@@ -113,8 +209,10 @@ class TestBasicDataBridge(unittest.TestCase):
     @patch('openprocurement.bridge.basic.databridge.APIClient')
     def test_gevent_watcher(self, mock_APIClient, mock_riw_spawn, mock_spawn):
         bridge = BasicDataBridge(self.config)
-        bridge.queue_filter = MagicMock()
-        bridge.queue_filter.exception = Exception('test_filler')
+        queue_filter = MagicMock(processed=10, passed=5)
+        queue_filter.exception = Exception('test_filler')
+        bridge.queue_filters = [queue_filter]
+        bridge._spawn_filter = MagicMock(return_value=MagicMock(processed=0, passed=0))
         bridge.input_queue_filler = MagicMock()
         bridge.input_queue_filler.exception = Exception('test_temp_filler')
         self.assertEqual(bridge.workers_pool.free_count(),
@@ -122,12 +220,157 @@ class TestBasicDataBridge(unittest.TestCase):
         self.assertEqual(bridge.retry_workers_pool.free_count(),
                          bridge.retry_workers_max)
         bridge.gevent_watcher()
+        self.assertEqual(bridge.queue_filters, [bridge._spawn_filter.return_value])
+        self.assertEqual((bridge.filter_processed, bridge.filter_passed), (0, 0))
         self.assertEqual(bridge.workers_pool.free_count(),
                          bridge.workers_max - bridge.workers_min)
         self.assertEqual(bridge.retry_workers_pool.free_count(),
                          bridge.retry_workers_max - bridge.retry_workers_min)
         del bridge
 
+    @patch('openprocurement.bridge.basic.databridge.APIClient')
+    def test__log_filters_throughput(self, mock_APIClient):
+        bridge = BasicDataBridge(self.config)
+        # Filter plugin without counters
+        bridge.queue_filters = [MagicMock(processed=10, passed=5), MagicMock(spec=['start', 'ready'])]
+        bridge._log_filters_throughput()
+        self.assertEqual((bridge.filter_processed, bridge.filter_passed), (10, 5))
+
+    def test_writer(self):
+        bridge = BasicDataBridge(self.config)
+        self.assertIsNone(bridge.writer)
+
+        config = deepcopy(self.config)
+        config['main']['worker_config']['shared_writer'] = True
+        bridge = BasicDataBridge(config)
+        self.assertIsInstance(bridge.writer, BulkWriter)
+        bridge.worker_greenlet = MagicMock()
+        bridge._spawn_worker(bridge.resource_items_queue)
+        self.assertIs(bridge.worker_greenlet.spawn.call_args[1]['writer'], bridge.writer)
+
+    @patch('openprocurement.bridge.basic.databridge.APIClient')
+    def test_validators_cache(self, mock_APIClient):
+        bridge = BasicDataBridge(self.config)
+        self.assertIsInstance(bridge.validators_cache, ValidatorsCache)
+        mock_APIClient.return_value.session.hooks = {'response': []}
+        mock_APIClient.return_value.session.headers = {'User-Agent': 'test'}
+        bridge.create_api_client()
+        self.assertEqual(mock_APIClient.return_value.session.hooks['response'], [bridge.validators_cache.observe])
+        # requests already negotiates gzip and deflate
+        self.assertNotIn('Accept-Encoding', mock_APIClient.return_value.session.headers)
+        bridge.worker_greenlet = MagicMock()
+        bridge._spawn_worker(bridge.resource_items_queue)
+        self.assertIs(bridge.worker_greenlet.spawn.call_args[1]['validators_cache'], bridge.validators_cache)
+
+        config = deepcopy(self.config)
+        config['main']['validators_cache_size'] = 0
+        bridge = BasicDataBridge(config)
+        self.assertIsNone(bridge.validators_cache)
+
+    def test_content_hash_cache(self):
+        config = deepcopy(self.config)
+        config['main']['content_hash_exclude'] = ['doc_type', 'next_check']
+        config['main']['worker_config']['shared_writer'] = True
+        bridge = BasicDataBridge(config)
+        self.assertIsInstance(bridge.content_hash_cache, ContentHashCache)
+        self.assertEqual(bridge.content_hash_cache.exclude, ('doc_type', 'next_check'))
+        self.assertIs(bridge.writer.content_hash_cache, bridge.content_hash_cache)
+        bridge.worker_greenlet = MagicMock()
+        bridge._spawn_worker(bridge.resource_items_queue)
+        self.assertIs(bridge.worker_greenlet.spawn.call_args[1]['content_hash_cache'], bridge.content_hash_cache)
+        self.assertIs(bridge.worker_greenlet.spawn.call_args[1]['in_flight_fetches'], bridge.in_flight_fetches)
+
+        config['main']['content_hash_cache_size'] = 0
+        bridge = BasicDataBridge(config)
+        self.assertIsNone(bridge.content_hash_cache)
+
+    def test_create_queue(self):
+        bridge = BasicDataBridge(self.config)
+        self.assertIsInstance(bridge.input_queue, DedupPriorityQueue)
+        self.assertNotIsInstance(bridge.input_queue, PersistentPriorityQueue)
+        self.assertEqual(bridge.input_queue.maxsize, bridge.input_queue_size)
+        self.assertIsNone(bridge.retry_resource_items_queue.maxsize)
+
+        tmp_dir = mkdtemp()
+        try:
+            config = deepcopy(self.config)
+            config['main'].update({'queues_path': tmp_dir, 'queues_sync_batch': 10})
+            bridge = BasicDataBridge(config)
+            for name in ('input_queue', 'resource_items_queue', 'retry_resource_items_queue'):
+                queue = getattr(bridge, name)
+                self.assertIsInstance(queue, PersistentPriorityQueue)
+                self.assertEqual(queue.path, os.path.join(tmp_dir, '{}.sqlite'.format(name)))
+                self.assertEqual(queue.sync_batch, 10)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_replay_dead_letters(self):
+        bridge = BasicDataBridge(self.config)
+        self.assertIsNone(bridge.dead_letters)
+        with self.assertRaises(DataBridgeConfigError):
+            bridge.replay_dead_letters()
+
+        tmp_dir = mkdtemp()
+        try:
+            config = deepcopy(self.config)
+            config['main'].update({'dead_letters_path': os.path.join(tmp_dir, 'dead_letters.sqlite'),
+                                   'watch_interval': 0})
+            bridge = BasicDataBridge(config)
+            self.assertIsInstance(bridge.dead_letters, DeadLetterStore)
+            ids = [uuid.uuid4().hex for _ in xrange(3)]
+            for resource_id in ids:
+                bridge.dead_letters.add((1011, resource_id), error='Request failed', status_code=502)
+            bridge.create_api_client = MagicMock()
+            workers = []
+            bridge.worker_greenlet = MagicMock()
+            bridge.worker_greenlet.spawn.side_effect = lambda api_clients_queue, queue, *args, **kwargs: (
+                workers.append(ReplayWorker.spawn(queue, kwargs['dead_letters'], {ids[1]})) or workers[-1])
+            self.assertEqual(bridge.replay_dead_letters(rate=1000, limit=2), 2)
+            # Items are replayed with their priority, workers are stopped gracefully
+            self.assertEqual(sorted(item for worker in workers for item in worker.taken),
+                             sorted([(1011, ids[0]), (1011, ids[1])]))
+            self.assertTrue(all(worker.successful() for worker in workers))
+            # Processed item is removed, dropped again and not replayed ones are kept
+            self.assertEqual(sorted(item['id'] for item in bridge.dead_letters.items()), sorted(ids[1:]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_retry_scheduler(self):
+        config = deepcopy(self.config)
+        config['main']['worker_config'].update({'retry_max_delay': 60, 'retry_jitter': 0.2})
+        bridge = BasicDataBridge(config)
+        self.assertIsInstance(bridge.retry_scheduler, RetryScheduler)
+        self.assertIs(bridge.retry_scheduler.queue, bridge.retry_resource_items_queue)
+        self.assertEqual((bridge.retry_scheduler.max_delay, bridge.retry_scheduler.jitter), (60, 0.2))
+        bridge.worker_greenlet = MagicMock()
+        bridge._spawn_worker(bridge.retry_resource_items_queue)
+        self.assertIs(bridge.worker_greenlet.spawn.call_args[1]['retry_scheduler'], bridge.retry_scheduler)
+
+    def test_spawn_filters(self):
+        bridge = BasicDataBridge(self.config)
+        bridge.filter_workers_count = 3
+        bridge.filter_greenlet = MagicMock(parallel_workers=True)
+        self.assertEqual(len(bridge._spawn_filters()), 3)
+        for call_args in bridge.filter_greenlet.spawn.call_args_list:
+            self.assertIs(call_args[1]['in_flight'], bridge.filter_in_flight)
+
+        bridge.filter_greenlet = MagicMock(parallel_workers=False)
+        self.assertEqual(len(bridge._spawn_filters()), 1)
+
+    def test_spawn_baseline_plugins(self):
+        bridge = BasicDataBridge(self.config)
+        bridge.worker_greenlet = BaselineWorker
+        worker = bridge._spawn_worker(bridge.resource_items_queue)
+        self.assertIs(worker.resource_items_queue, bridge.resource_items_queue)
+        bridge.filter_greenlet = BaselineFilter
+        queue_filters = bridge._spawn_filters()
+        self.assertEqual(len(queue_filters), 1)
+        self.assertIs(queue_filters[0].filtered_queue, bridge.resource_items_queue)
+        worker.join()
+        queue_filters[0].join()
+        self.assertTrue(worker.successful())
+        self.assertTrue(queue_filters[0].successful())
+
     @patch('openprocurement.bridge.basic.databridge.APIClient')
     @patch('openprocurement.bridge.basic.workers.BasicResourceItemWorker.spawn')
     def test_queues_controller(self, mock_riw_spawn, mock_APIClient):
@@ -178,17 +421,18 @@ class TestBasicDataBridge(unittest.TestCase):
         request_duration = 1
         for k in bridge.api_clients_info:
             for i in xrange(0, 3):
-                bridge.api_clients_info[k]['request_durations'][
-                    datetime.datetime.now()] = request_duration
+                bridge.api_clients_info[k]['request_durations'].add(request_duration)
             request_duration += 1
         res, res_list = bridge._get_average_requests_duration()
         self.assertEqual(res, 2)
         self.assertEqual(len(res_list), 3)
+        for info in bridge.api_clients_info.values():
+            self.assertEqual(info['percentiles'], [info['avg_duration']] * 3)
 
-        delta = datetime.timedelta(seconds=301)
-        grown_date = datetime.datetime.now() - delta
+        request_durations = RequestDurations()
+        request_durations.add(1, now=time() - 301)
         bridge.api_clients_info[uuid.uuid4().hex] = {
-            'request_durations': {grown_date: 1},
+            'request_durations': request_durations,
             'destroy': False,
             'request_interval': 0,
             'avg_duration': 0
@@ -232,6 +476,8 @@ class TestBasicDataBridge(unittest.TestCase):
             bridge.api_clients_info[cid]['grown'] = True
             bridge.api_clients_info[cid]['request_interval'] = \
                 req_intervals[avg_duration]
+            if req_intervals[avg_duration]:
+                bridge.api_clients_info[cid]['limiter'].throttle()
             avg_duration += 1
         avg = 1.5
         bridge._mark_bad_clients(avg)
@@ -243,6 +489,27 @@ class TestBasicDataBridge(unittest.TestCase):
                 to_destroy += 1
         self.assertEqual(to_destroy, 3)
 
+    def test__mark_bad_clients_throttled(self):
+        bridge = BasicDataBridge(self.config)
+        recovering = RateLimiter(max_rate=100)
+        recovering.throttle()
+        for _ in xrange(5):
+            recovering.success()
+        throttled = RateLimiter(max_rate=100)
+        throttled.throttle()
+        bridge.api_clients_info = {
+            'recovering': {'limiter': recovering, 'request_interval': recovering.interval},
+            'throttled': {'limiter': throttled, 'request_interval': throttled.interval},
+            # Info of client without limiter
+            'plugin': {'request_interval': 0.1}
+        }
+        for info in bridge.api_clients_info.values():
+            info.update({'drop_cookies': False, 'avg_duration': 1})
+        self.assertGreater(recovering.interval, 0)
+        bridge._mark_bad_clients(1.5)
+        self.assertEqual(sorted(cid for cid, info in bridge.api_clients_info.items() if info['drop_cookies']),
+                         ['plugin', 'throttled'])
+
     @patch('openprocurement_client.templates.Session')
     def test_perfomance_watcher(self, mocked_session):
         mocked_session.request.return_value = MockedResponse(200)
@@ -251,7 +518,7 @@ class TestBasicDataBridge(unittest.TestCase):
             bridge.create_api_client()
         req_duration = 1
         for _, info in bridge.api_clients_info.items():
-            info['request_durations'][datetime.datetime.now()] = req_duration
+            info['request_durations'].add(req_duration)
             req_duration += 1
             self.assertEqual(info.get('grown', False), False)
             self.assertEqual(len(info['request_durations']), 1)
@@ -4,17 +4,23 @@ from copy import deepcopy
 from datetime import datetime
 from uuid import uuid4
 
+import gevent
 import jmespath
-from gevent.queue import PriorityQueue
+from gevent.pool import Pool
+from gevent.queue import Queue
 from mock import MagicMock, patch, call
 from munch import munchify
 
+from openprocurement.bridge.basic.caches import DateModifiedCache
 from openprocurement.bridge.basic.filters import (
     BasicCouchDBFilter,
     BasicElasticSearchFilter,
+    get_equality_predicate,
     JMESPathFilter,
 )
-from openprocurement.bridge.basic.tests.base import TEST_CONFIG
+from openprocurement.bridge.basic.queues import DedupPriorityQueue, PersistentPriorityQueue
+from openprocurement.bridge.basic.tests.base import AdaptiveCache, TEST_CONFIG
+from openprocurement.bridge.basic.workers import BasicResourceItemWorker
 
 
 CONFIG = {
@@ -23,6 +29,7 @@ CONFIG = {
         'procurementMethodTypes': [],
         'lot_status': None,
         'timeout': 0,
+        'batch_interval': 0,
         'filters': [],
     },
     'resource': 'tenders'
@@ -33,6 +40,7 @@ class TestBasicCouchDBFilter(unittest.TestCase):
 
     config = deepcopy(TEST_CONFIG['main'])
     config['storage_config']['bulk_query_limit'] = 1
+    config['storage_config']['bulk_query_limit_max'] = 1
 
     def setUp(self):
         self.old_date_modified = datetime.now().isoformat()
@@ -42,8 +50,8 @@ class TestBasicCouchDBFilter(unittest.TestCase):
         self.date_modified_2 = datetime.now().isoformat()
         self.id_3 = uuid4().hex
         self.date_modified_3 = datetime.now().isoformat()
-        self.queue = PriorityQueue()
-        self.input_queue = PriorityQueue()
+        self.queue = DedupPriorityQueue()
+        self.input_queue = DedupPriorityQueue()
         self.db = MagicMock()
         self.bulk = {
             self.id_1: self.date_modified_1,
@@ -86,14 +94,236 @@ class TestBasicCouchDBFilter(unittest.TestCase):
         self.assertEqual(self.queue.qsize(), 2)
         self.assertEqual(self.input_queue.qsize(), 0)
 
+    @patch('openprocurement.bridge.basic.filters.INFINITY')
+    def test__run_feed_only(self, mocked_infinity):
+        config = deepcopy(self.config)
+        config['worker_config']['feed_only'] = True
+        couchdb_filter = BasicCouchDBFilter(config, self.input_queue, self.queue, self.db)
+        feed_item = {'id': self.id_2, 'dateModified': self.date_modified_2, 'status': 'active'}
+        self.input_queue.put((1, {'id': self.id_1, 'dateModified': self.date_modified_1, 'status': 'active'}))
+        self.input_queue.put((1, feed_item))
+        mocked_infinity.__nonzero__.side_effect = [True] * 3 + [False, False]
+
+        couchdb_filter._run()
+        # Passed item is put as whole feed item, skipped one is forgotten
+        self.assertEqual(self.queue.get(), (1, feed_item))
+        self.assertEqual(self.queue.qsize(), 0)
+        self.assertEqual(couchdb_filter.feed_items, {})
+
+    @patch('openprocurement.bridge.basic.filters.INFINITY')
+    def test__run_feed_only_newer_version(self, mocked_infinity):
+        config = deepcopy(self.config)
+        config['worker_config'].update({'feed_only': True, 'feed_required_fields': ['status']})
+        self.db.db.view.return_value = []
+        couchdb_filter = BasicCouchDBFilter(config, self.input_queue, self.queue, self.db)
+        old_item = {'id': self.id_1, 'dateModified': self.old_date_modified, 'status': 'active.tendering'}
+        new_item = {'id': self.id_1, 'dateModified': self.date_modified_1, 'status': 'active.qualification'}
+        self.input_queue.put((1, old_item))
+        self.input_queue.put((1, new_item))
+        mocked_infinity.__nonzero__.side_effect = [True] * 2 + [False, False]
+
+        couchdb_filter._run()
+        # Queued snapshot is replaced with newer one
+        self.assertEqual(self.queue.qsize(), 1)
+        self.assertEqual(couchdb_filter.feed_items, {})
+
+        writer = MagicMock()
+        api_client_dict = {'id': uuid4().hex, 'client': MagicMock(), 'request_interval': 0}
+        api_clients_queue = Queue()
+        api_clients_queue.put(api_client_dict)
+        db = MagicMock()
+        db.get_docs_meta.return_value = {}
+        worker = BasicResourceItemWorker(api_clients_queue=api_clients_queue, resource_items_queue=self.queue,
+                                         db=db, config_dict=config, writer=writer,
+                                         api_clients_info={api_client_dict['id']: {'drop_cookies': False}})
+        worker.exit = MagicMock()
+        worker.exit.__nonzero__.side_effect = [False, True]
+        worker._run()
+        self.assertEqual(writer.put.call_count, 1)
+        self.assertEqual(writer.put.call_args[0][0], dict(new_item, _id=self.id_1, doc_type='Tender'))
+
+    @patch('openprocurement.bridge.basic.filters.logger')
+    def test__adapt_bulk_query(self, logger):
+        config = deepcopy(self.config)
+        config['storage_config'].update({'bulk_query_limit': 100, 'bulk_query_interval': 3,
+                                         'bulk_query_limit_max': 300, 'bulk_query_interval_min': 0.5})
+        couchdb_filter = BasicCouchDBFilter(config, self.input_queue, self.queue, self.db)
+        self.assertEqual(couchdb_filter.bulk_query_limit_min, 12)
+        self.assertEqual(couchdb_filter.bulk_query_interval_max, 3)
+
+        # Full bulk without backlog keeps values
+        couchdb_filter._adapt_bulk_query(100, True)
+        self.assertEqual((couchdb_filter.bulk_query_limit, couchdb_filter.bulk_query_interval), (100, 3))
+        self.assertEqual(logger.info.call_count, 1)
+
+        # Backlog grows limit up to max
+        self.input_queue.put((1, {'id': self.id_1, 'dateModified': self.date_modified_1}))
+        couchdb_filter._adapt_bulk_query(100, True)
+        self.assertEqual(couchdb_filter.bulk_query_limit, 200)
+        couchdb_filter._adapt_bulk_query(200, True)
+        couchdb_filter._adapt_bulk_query(300, True)
+        self.assertEqual(couchdb_filter.bulk_query_limit, 300)
+        self.assertEqual(logger.info.call_args_list[-1],
+                         call('Bulk query limit 300, interval 3 sec.',
+                              extra={'BULK_QUERY_LIMIT': 300, 'BULK_QUERY_INTERVAL': 3}))
+
+        # Partly filled bulk shrinks limit, interval kept
+        couchdb_filter._adapt_bulk_query(100, False)
+        self.assertEqual((couchdb_filter.bulk_query_limit, couchdb_filter.bulk_query_interval), (150, 3))
+
+        # Idle feed shrinks limit and interval down to min
+        for _ in xrange(5):
+            couchdb_filter._adapt_bulk_query(0, False)
+        self.assertEqual((couchdb_filter.bulk_query_limit, couchdb_filter.bulk_query_interval), (12, 0.5))
+
+        # Backlog after idle restores max interval
+        couchdb_filter._adapt_bulk_query(12, True)
+        self.assertEqual((couchdb_filter.bulk_query_limit, couchdb_filter.bulk_query_interval), (24, 3))
+
+        # Configured min limit
+        config['storage_config']['bulk_query_limit_min'] = 100
+        couchdb_filter = BasicCouchDBFilter(config, self.input_queue, self.queue, self.db)
+        couchdb_filter._adapt_bulk_query(0, False)
+        self.assertEqual(couchdb_filter.bulk_query_limit, 100)
+
+    @patch('openprocurement.bridge.basic.filters.INFINITY')
+    def test__run_with_date_modified_cache(self, mocked_infinity):
+        cache = DateModifiedCache(1)
+        cache.put(self.id_1, self.date_modified_1)
+        cache.put(self.id_2, self.old_date_modified)
+        couchdb_filter = BasicCouchDBFilter(self.config, self.input_queue, self.queue, self.db,
+                                            date_modified_cache=cache)
+        self.input_queue.put((1, {'id': self.id_1, 'dateModified': self.date_modified_1}))
+        self.input_queue.put((1, {'id': self.id_2, 'dateModified': self.date_modified_2}))
+        mocked_infinity.__nonzero__.side_effect = [True] * 2 + [False]
+
+        couchdb_filter._run()
+        # Only cache miss sent to storage
+        self.db.db.view.assert_called_once_with(couchdb_filter.view_path, keys=[self.date_modified_2])
+        self.assertEqual(self.queue.qsize(), 1)
+        self.assertEqual(self.queue.get(), (1, self.id_2))
+        self.assertEqual((cache.hits, cache.misses), (2, 0))
+
+
+    def test__dispatch_with_date_modified_index(self):
+        index = MagicMock(authoritative=True)
+        index.is_fresh.side_effect = lambda item_id, date_modified: item_id == self.id_1
+        couchdb_filter = BasicCouchDBFilter(self.config, self.input_queue, self.queue, self.db,
+                                            date_modified_cache=index)
+        self.queue.put((1000, self.id_3))
+
+        self.assertEqual(couchdb_filter._dispatch(self.bulk, self.priority_cache), ({}, {}))
+        self.assertEqual(self.db.db.view.call_count, 0)
+        self.assertEqual(self.queue.qsize(), 2)
+        self.assertEqual(self.queue.get(), (1, self.id_2))
+
+    def test__dispatch_with_pool(self):
+        pool = Pool(2)
+        couchdb_filter = BasicCouchDBFilter(self.config, self.input_queue, self.queue, self.db, pool=pool)
+        couchdb_filter.in_flight[self.id_3] = self.old_date_modified
+
+        input_dict, priority_cache = couchdb_filter._dispatch(self.bulk, self.priority_cache)
+        # Item which already in flight left for next bulk
+        self.assertEqual(input_dict, {self.id_3: self.date_modified_3})
+        self.assertEqual(priority_cache, {self.id_3: 1})
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(couchdb_filter.in_flight[self.id_1], self.date_modified_1)
+
+        pool.join()
+        self.assertEqual(couchdb_filter.in_flight, {self.id_3: self.old_date_modified})
+        self.assertEqual(self.queue.qsize(), 1)
+        self.assertEqual(self.queue.get(), (1, self.id_2))
+
+    @patch('openprocurement.bridge.basic.filters.sleep')
+    def test__dispatch_ack(self, mocked_sleep):
+        input_queue = MagicMock(spec=PersistentPriorityQueue)
+        cache = MagicMock(authoritative=False)
+        cache.is_fresh.side_effect = lambda item_id, date_modified: item_id == self.id_1
+        pool = Pool(2)
+        couchdb_filter = BasicCouchDBFilter(self.config, input_queue, self.queue, self.db,
+                                            date_modified_cache=cache, pool=pool)
+        couchdb_filter.in_flight[self.id_3] = self.old_date_modified
+
+        couchdb_filter._dispatch(self.bulk, self.priority_cache)
+        # Cached item is acknowledged at once, checked one after check, left for next bulk isn't
+        mark = input_queue.ack.call_args[0][1]
+        self.assertEqual(input_queue.ack.call_args_list, [call(self.id_1, mark)])
+        pool.join()
+        self.assertEqual(input_queue.ack.call_args_list, [call(self.id_1, mark), call(self.id_2, mark)])
+
+        # Items of failed check are kept
+        self.db.db.view.side_effect = Exception('test')
+        couchdb_filter._dispatch({self.id_2: self.date_modified_2}, {self.id_2: 1})
+        pool.join()
+        self.assertEqual(input_queue.ack.call_count, 2)
+
+    @patch('openprocurement.bridge.basic.filters.sleep')
+    def test__check_bulk_in_flight_error(self, mocked_sleep):
+        couchdb_filter = BasicCouchDBFilter(self.config, self.input_queue, self.queue, self.db, pool=Pool(1))
+        couchdb_filter.in_flight = {self.id_1: self.date_modified_1}
+        self.db.db.view.side_effect = Exception('test')
+
+        couchdb_filter._check_bulk_in_flight({self.id_1: self.date_modified_1}, {self.id_1: 1})
+        self.assertEqual(couchdb_filter.in_flight, {})
+        self.assertEqual(couchdb_filter.failed_checks, {self.id_1: (self.date_modified_1, 1)})
+        self.assertEqual(self.input_queue.qsize(), 0)
+
+        # Failed items are merged into next bulk, newer dateModified and higher priority win
+        input_dict = {self.id_1: self.old_date_modified, self.id_2: self.date_modified_2}
+        priority_cache = {self.id_1: 1000, self.id_2: 1}
+        couchdb_filter._merge_failed_checks(input_dict, priority_cache)
+        self.assertEqual(input_dict, {self.id_1: self.date_modified_1, self.id_2: self.date_modified_2})
+        self.assertEqual(priority_cache, {self.id_1: 1, self.id_2: 1})
+        self.assertEqual(couchdb_filter.failed_checks, {})
+
+    @patch('openprocurement.bridge.basic.filters.sleep')
+    @patch('openprocurement.bridge.basic.filters.INFINITY')
+    def test__run_check_error_with_full_input_queue(self, mocked_infinity, mocked_sleep):
+        input_queue = DedupPriorityQueue(maxsize=1)
+        pool = Pool(1)
+        couchdb_filter = BasicCouchDBFilter(self.config, input_queue, self.queue, self.db, pool=pool)
+        self.db.db.view.side_effect = [Exception('test')] * 3 + [[]]
+        couchdb_filter._dispatch({self.id_1: self.date_modified_1}, {self.id_1: 1})
+        input_queue.put((1, {'id': self.id_2, 'dateModified': self.date_modified_2}))
+        self.assertTrue(input_queue.full())
+
+        # Check fails while input queue is full, pool slot is freed without waiting for filter
+        with gevent.Timeout(1):
+            pool.join()
+        self.assertEqual(couchdb_filter.failed_checks, {self.id_1: (self.date_modified_1, 1)})
+
+        mocked_infinity.__nonzero__.side_effect = [True, False]
+        couchdb_filter._run()
+        pool.join()
+        self.assertEqual(sorted(self.db.db.view.call_args[1]['keys']),
+                         sorted([self.date_modified_1, self.date_modified_2]))
+        self.assertEqual(couchdb_filter.failed_checks, {})
+        self.assertEqual(sorted(self.queue.get()[1] for _ in xrange(2)), sorted([self.id_1, self.id_2]))
+
+    @patch('openprocurement.bridge.basic.filters.INFINITY')
+    def test__run_keep_newest_date_modified(self, mocked_infinity):
+        couchdb_filter = BasicCouchDBFilter(self.config, self.input_queue, self.queue, self.db)
+        couchdb_filter.bulk_query_limit = 2
+        couchdb_filter._check_bulk = MagicMock()
+        self.input_queue.put((1, {'id': self.id_1, 'dateModified': self.old_date_modified}))
+        self.input_queue.put((2, {'id': self.id_1, 'dateModified': self.date_modified_3}))
+        self.input_queue.put((3, {'id': self.id_2, 'dateModified': self.date_modified_2}))
+        mocked_infinity.__nonzero__.side_effect = [True] * 3 + [False]
+
+        couchdb_filter._run()
+        couchdb_filter._check_bulk.assert_called_once_with(
+            {self.id_1: self.date_modified_3, self.id_2: self.date_modified_2},
+            {self.id_1: 1, self.id_2: 3}
+        )
+
 
 class TestBasicElasticSearchFilter(unittest.TestCase):
 
     config = deepcopy(TEST_CONFIG['main'])
 
     def test__check_bulk(self):
-        input_queue = PriorityQueue()
-        queue = PriorityQueue()
+        input_queue = DedupPriorityQueue()
+        queue = DedupPriorityQueue()
         old_date_modified = datetime.now().isoformat()
         id_1 = uuid4().hex
         date_modified_1 = datetime.now().isoformat()
@@ -107,54 +337,46 @@ class TestBasicElasticSearchFilter(unittest.TestCase):
             id_2: date_modified_2,
             id_3: date_modified_3
         }
-        priority_cache = {id_1: 1, id_2: 1, id_3: 1}
-        return_value = {
-            u'docs': [
-                {
-                    u'_type': u'Tender',
-                    u'_source': {
-                        u'dateModified': date_modified_1
-                    },
-                    u'_index': u'bridge_tenders',
-                    u'_version': 1,
-                    u'found': True,
-                    u'_id': id_1
-                },
-                {
-                    u'_type': u'Tender',
-                    u'_source': {
-                        u'dateModified': old_date_modified
-                    },
-                    u'_index': u'bridge_tenders',
-                    u'_version': 1,
-                    u'found': True,
-                    u'_id': id_2
-                },
-                {
-                    u'found': False,
-                    u'_type': u'Tender',
-                    u'_id': id_3,
-                    u'_index': u'bridge_tenders'
-                }
-            ]
-        }
-        db.mget.return_value = return_value
+        priority_cache = {id_1: 1, id_2: 1, id_3: 1000}
+        db.get_date_modified.return_value = {id_1: date_modified_1, id_2: old_date_modified, id_3: False}
         elastic_filter = BasicElasticSearchFilter(self.config, input_queue, queue, db)
         self.assertEqual(queue.qsize(), 0)
 
         elastic_filter._check_bulk(bulk, priority_cache)
+        self.assertEqual(sorted(db.get_date_modified.call_args[0][0]), sorted(bulk.keys()))
         self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.get(), (1, id_2))
+        self.assertEqual(queue.get(), (1000, id_3))
+
+    def test__check_bulk_feed_only(self):
+        queue = DedupPriorityQueue()
+        resource_id = uuid4().hex
+        old_item = {'id': resource_id, 'dateModified': '2018-01-01T00:00:00.000000+02:00'}
+        new_item = {'id': resource_id, 'dateModified': datetime.now().isoformat()}
+        queue.put((1, old_item))
+        db = MagicMock()
+        db.get_date_modified.return_value = {resource_id: False}
+        config = deepcopy(self.config)
+        config['worker_config']['feed_only'] = True
+        elastic_filter = BasicElasticSearchFilter(config, DedupPriorityQueue(), queue, db)
+        elastic_filter.feed_items[resource_id] = new_item
+        elastic_filter._check_bulk({resource_id: new_item['dateModified']}, {resource_id: 1})
+
+        # Queued feed item is replaced with newer one
+        self.assertEqual(elastic_filter.feed_items, {})
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(queue.get(), (1, new_item))
 
 
 class TestResourceFilters(unittest.TestCase):
-    db = {}
+    db = AdaptiveCache({})
     conf = CONFIG
 
     @patch('openprocurement.bridge.basic.filters.INFINITY')
     @patch('openprocurement.bridge.basic.filters.logger')
     def test_JMESPathFilter(self, logger, infinity):
-        self.input_queue = PriorityQueue()
-        self.filtered_queue = PriorityQueue()
+        self.input_queue = DedupPriorityQueue()
+        self.filtered_queue = DedupPriorityQueue()
 
         resource = self.conf['resource'][:-1]
         jmes_filter = JMESPathFilter(self.conf, self.input_queue, self.filtered_queue, self.db)
@@ -172,7 +394,7 @@ class TestResourceFilters(unittest.TestCase):
         }
 
         self.input_queue.put((None, doc))
-        self.db['test_id'] = '1970-01-01'
+        self.db.put('test_id', '1970-01-01')
         infinity.__nonzero__.side_effect = [True, False]
         jmes_filter._run()
         mock_calls.append(
@@ -218,6 +440,125 @@ class TestResourceFilters(unittest.TestCase):
         self.assertIsNone(priority)
         self.assertEqual(filtered_doc, doc)
 
+    @patch('openprocurement.bridge.basic.filters.INFINITY')
+    @patch('openprocurement.bridge.basic.filters.logger')
+    def test_JMESPathFilter_batch(self, logger, infinity):
+        input_queue = DedupPriorityQueue()
+        filtered_queue = DedupPriorityQueue()
+        db = MagicMock()
+        db.get_many.return_value = {'id_1': '1970-01-01'}
+        conf = deepcopy(self.conf)
+        conf['filter_config']['batch_size'] = 2
+        jmes_filter = JMESPathFilter(conf, input_queue, filtered_queue, db)
+        self.assertEqual(jmes_filter.batch_size, 2)
+
+        for i in xrange(1, 4):
+            input_queue.put((i, {'id': 'id_{}'.format(i), 'dateModified': '1970-01-01', 'status': 'active'}))
+
+        # One cache request per batch
+        infinity.__nonzero__.side_effect = [True, True, False]
+        jmes_filter._run()
+        self.assertEqual(db.get_many.call_args_list, [call(['id_1', 'id_2']), call(['id_3'])])
+        self.assertEqual(filtered_queue.qsize(), 2)
+        self.assertEqual(filtered_queue.get()[0], 2)
+        self.assertEqual(filtered_queue.get()[0], 3)
+
+        # Wait next items not longer than batch_interval
+        jmes_filter.batch_interval = 0.01
+        input_queue.put((1, {'id': 'id_4', 'dateModified': '1970-01-01', 'status': 'active'}))
+        self.assertEqual(len(jmes_filter._get_batch()), 1)
+        self.assertEqual(jmes_filter._get_batch(), [])
+
+
+    def test_get_equality_predicate(self):
+        cases = {
+            "status == 'active'": ('status', frozenset(['active'])),
+            "`active` == status": ('status', frozenset(['active'])),
+            "contains([`a`, `b`], procurementMethodType)": ('procurementMethodType', frozenset(['a', 'b'])),
+            'contains(`["a", "b"]`, procurementMethodType)': ('procurementMethodType', frozenset(['a', 'b'])),
+            "status != 'active'": None,
+            "lot.status == 'active'": None,
+            "status == `1`": None,
+            "contains('active', status)": None,
+            "contains([`a`, status], procurementMethodType)": None,
+            "length(lots) > `0`": None
+        }
+        for expression, predicate in cases.items():
+            self.assertEqual(get_equality_predicate(jmespath.compile(expression)), predicate, expression)
+
+    @patch('openprocurement.bridge.basic.filters.logger')
+    def test_JMESPathFilter_chain(self, logger):
+        conf = deepcopy(self.conf)
+        conf['filter_config']['filters'] = [
+            {'expression': "contains([`a`, `b`], procurementMethodType)"},
+            {'expression': "length(lots) > `0`"},
+            {'expression': "status == 'active'"},
+            {'expression': "procurementMethodType != 'a'"},
+            {'expression': "contains([`b`, `c`], procurementMethodType)"},
+        ]
+        conf['filter_config']['reorder_interval'] = 4
+        jmes_filter = JMESPathFilter(conf, DedupPriorityQueue(), DedupPriorityQueue(), self.db)
+        self.assertEqual(jmes_filter.dispatch, {'procurementMethodType': frozenset(['b']),
+                                                'status': frozenset(['active'])})
+        self.assertEqual([e.expression.expression for e in jmes_filter.chain],
+                         ["length(lots) > `0`", "procurementMethodType != 'a'"])
+
+        resource = {'id': 'id', 'dateModified': '1970-01-01', 'status': 'active', 'procurementMethodType': 'b',
+                    'lots': [{}]}
+        self.assertTrue(jmes_filter._match(resource))
+        self.assertFalse(jmes_filter._match(dict(resource, status=['active'])))
+        self.assertFalse(jmes_filter._match(dict(resource, procurementMethodType='a')))
+        self.assertEqual((jmes_filter.dispatch_passed, jmes_filter.dispatch_failed), (1, 2))
+
+        # Expression which rejects resources is moved to chain start
+        jmes_filter.chain[0].duration = 0.001
+        jmes_filter.chain[1].duration = 0.001
+        jmes_filter.chain[1].failed = 10
+        self.assertFalse(jmes_filter._match(dict(resource, lots=[])))
+        self.assertEqual(jmes_filter.chain[0].stats()['failed'], 1)
+        jmes_filter._reorder()
+        self.assertEqual([e.expression.expression for e in jmes_filter.chain],
+                         ["procurementMethodType != 'a'", "length(lots) > `0`"])
+        self.assertEqual(len(logger.debug.call_args_list), 3)
+
+        # Chain reordered every reorder_interval checked resources
+        with patch.object(jmes_filter, '_reorder') as reorder:
+            for _ in xrange(4):
+                jmes_filter._filter_resource(1, resource, None)
+            self.assertEqual(reorder.call_count, 1)
+
+    @patch('openprocurement.bridge.basic.filters.INFINITY')
+    @patch('openprocurement.bridge.basic.filters.logger')
+    def test_JMESPathFilter_parallel_workers(self, logger, infinity):
+        self.assertTrue(JMESPathFilter.parallel_workers)
+        input_queue = DedupPriorityQueue()
+        filtered_queue = DedupPriorityQueue()
+        in_flight = {}
+        db = AdaptiveCache({})
+        filters = [JMESPathFilter(self.conf, input_queue, filtered_queue, db, in_flight=in_flight)
+                   for _ in xrange(2)]
+        self.assertIs(filters[0].in_flight, filters[1].in_flight)
+
+        doc = {'id': 'test_id', 'dateModified': '1970-01-01', 'status': 'active'}
+        for jmes_filter in filters:
+            input_queue.put((1, dict(doc)))
+            infinity.__nonzero__.side_effect = [True, False]
+            jmes_filter._run()
+        self.assertEqual(filtered_queue.qsize(), 1)
+        self.assertEqual([(f.processed, f.passed) for f in filters], [(1, 1), (1, 0)])
+        self.assertEqual(logger.debug.call_args_list[-1],
+                         call('Skipped tender test_id: In queue exist with same id', extra={'MESSAGE_ID': 'skipped'}))
+
+        # Id which is being put by other worker is skipped too
+        filtered_queue.get()
+        in_flight['test_id'] = '1970-01-01'
+        filters[0]._put_to_filtered_queue(1, doc)
+        self.assertEqual(filtered_queue.qsize(), 0)
+        del in_flight['test_id']
+        filters[0]._put_to_filtered_queue(1, doc)
+        self.assertEqual(filtered_queue.qsize(), 1)
+        self.assertEqual(in_flight, {})
+
 
 def suite():
     suite = unittest.TestSuite()
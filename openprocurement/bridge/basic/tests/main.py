@@ -3,7 +3,8 @@
 import unittest
 
 from openprocurement.bridge.basic.tests import (
-    databridge, workers, test_couchdb_storage, test_elasticsearch_storage, filters, utils, handlers
+    databridge, workers, test_couchdb_storage, test_elasticsearch_storage, filters, utils, handlers,
+    queues, caches, writers, transport, stats
 )
 
 
@@ -16,6 +17,11 @@ def suite():
     tests.addTest(test_elasticsearch_storage.suite())
     tests.addTest(utils.suite())
     tests.addTest(handlers.suite())
+    tests.addTest(queues.suite())
+    tests.addTest(caches.suite())
+    tests.addTest(writers.suite())
+    tests.addTest(transport.suite())
+    tests.addTest(stats.suite())
     return tests
 
 
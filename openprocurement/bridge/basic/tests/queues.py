@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+from time import time
+from uuid import uuid4
+
+from gevent import sleep
+from mock import patch
+
+from openprocurement.bridge.basic.queues import (
+    APIClientsQueue, DeadLetterStore, DedupPriorityQueue, InFlightRegistry, PersistentPriorityQueue, RateLimiter,
+    RetryScheduler, item_key, next_mark
+)
+
+
+class TestDedupPriorityQueue(unittest.TestCase):
+
+    def test_item_key(self):
+        resource_id = uuid4().hex
+        self.assertEqual(item_key((1, resource_id)), resource_id)
+        self.assertEqual(item_key((1, {'id': resource_id, 'dateModified': ''})), resource_id)
+
+    def test_contains(self):
+        queue = DedupPriorityQueue()
+        id_1 = uuid4().hex
+        id_2 = uuid4().hex
+        self.assertNotIn(id_1, queue)
+
+        queue.put((1000, id_1))
+        queue.put((1, {'id': id_2}))
+        self.assertIn(id_1, queue)
+        self.assertIn(id_2, queue)
+        self.assertEqual(queue.qsize(), 2)
+
+        self.assertEqual(queue.get(), (1, {'id': id_2}))
+        self.assertNotIn(id_2, queue)
+        self.assertIn(id_1, queue)
+        self.assertEqual(queue.get(), (1000, id_1))
+        self.assertNotIn(id_1, queue)
+        self.assertEqual(queue.index, {})
+
+    def test_duplicates(self):
+        queue = DedupPriorityQueue()
+        resource_id = uuid4().hex
+        queue.put((1, resource_id))
+        queue.put((1001, resource_id))
+        self.assertEqual(queue.index[resource_id], 2)
+
+        self.assertEqual(queue.get(), (1, resource_id))
+        self.assertIn(resource_id, queue)
+        self.assertEqual(queue.get(), (1001, resource_id))
+        self.assertNotIn(resource_id, queue)
+
+    def test_replace(self):
+        queue = DedupPriorityQueue()
+        id_1 = uuid4().hex
+        id_2 = uuid4().hex
+        queue.put((1, {'id': id_1, 'dateModified': '2'}))
+        queue.put((2, {'id': id_2, 'dateModified': '2'}))
+        self.assertFalse(queue.replace({'id': uuid4().hex, 'dateModified': '3'}))
+        self.assertFalse(queue.replace({'id': id_1, 'dateModified': '1'}))
+        self.assertTrue(queue.replace({'id': id_2, 'dateModified': '3'}))
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.get(), (1, {'id': id_1, 'dateModified': '2'}))
+        self.assertEqual(queue.get(), (2, {'id': id_2, 'dateModified': '3'}))
+        self.assertEqual(queue.index, {})
+
+
+class TestPersistentPriorityQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'queue.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def rows(self):
+        return PersistentPriorityQueue(self.path).db.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def test_put_get(self):
+        queue = PersistentPriorityQueue(self.path, sync_batch=1)
+        id_1 = uuid4().hex
+        id_2 = uuid4().hex
+        queue.put((1000, id_1))
+        queue.put((1, {'id': id_2, 'dateModified': '2018-01-01'}))
+        self.assertIn(id_1, queue)
+        self.assertEqual(self.rows(), 2)
+
+        # Taken entries are kept until acknowledged
+        self.assertEqual(queue.get(), (1, {'id': id_2, 'dateModified': '2018-01-01'}))
+        self.assertNotIn(id_2, queue)
+        self.assertEqual(self.rows(), 2)
+        self.assertEqual(queue.ack(id_2), 1)
+        self.assertEqual(self.rows(), 1)
+        self.assertEqual(queue.get(), (1000, id_1))
+        self.assertEqual((queue.seqs, queue.index), ({}, {}))
+        self.assertEqual(queue.unacked(), 1)
+        self.assertEqual(queue.ack(id_1), 1)
+        self.assertEqual(queue.ack(id_1), 0)
+        self.assertEqual(queue.taken, {})
+        self.assertEqual(self.rows(), 0)
+
+    def test_ack_mark(self):
+        queue = PersistentPriorityQueue(self.path, sync_batch=1)
+        resource_id = uuid4().hex
+        queue.put((1, resource_id))
+        queue.put((1000, resource_id))
+        queue.get()
+        mark = next_mark()
+        queue.get()
+
+        # Entry taken after processing started is kept
+        self.assertEqual(queue.ack(resource_id, mark), 1)
+        self.assertEqual(queue.unacked(), 1)
+        self.assertEqual(self.rows(), 1)
+        self.assertEqual(queue.ack(resource_id, mark), 0)
+        self.assertEqual(queue.ack(resource_id, next_mark()), 1)
+        self.assertEqual(self.rows(), 0)
+
+    def test_ack_entry(self):
+        queue = PersistentPriorityQueue(self.path, sync_batch=1)
+        resource_id = uuid4().hex
+        queue.put((1, resource_id))
+        queue.put((2, resource_id))
+        queue.get()
+        queue.get()
+        self.assertTrue(queue.ack_entry((2, resource_id)))
+        self.assertFalse(queue.ack_entry((2, resource_id)))
+        self.assertFalse(queue.ack_entry((3, resource_id)))
+        self.assertEqual(queue.unacked(), 1)
+        self.assertEqual(self.rows(), 1)
+        self.assertTrue(queue.ack_entry((1, resource_id)))
+        self.assertEqual((queue.taken, self.rows()), ({}, 0))
+
+    def test_replace(self):
+        queue = PersistentPriorityQueue(self.path, sync_batch=1)
+        resource_id = uuid4().hex
+        queue.put((1, {'id': resource_id, 'dateModified': '1'}))
+        self.assertTrue(queue.replace({'id': resource_id, 'dateModified': '2'}))
+        self.assertEqual(self.rows(), 1)
+
+        # Replaced entry is replayed
+        queue = PersistentPriorityQueue(self.path, sync_batch=1)
+        self.assertEqual(queue.get(), (1, {'id': resource_id, 'dateModified': '2'}))
+        self.assertEqual(queue.ack(resource_id), 1)
+        self.assertEqual(self.rows(), 0)
+
+    def test_replay(self):
+        queue = PersistentPriorityQueue(self.path, maxsize=4, sync_batch=1)
+        resource_id = uuid4().hex
+        queue.put((1001, resource_id))
+        queue.put((1, resource_id))
+        queue.put((2, {'id': resource_id}))
+        queue.put((3, resource_id))
+        queue.get()
+        queue.ack(resource_id)
+        # Taken but not acknowledged entry
+        queue.get()
+        queue.close()
+
+        # Not acknowledged entries are replayed in priority order, even above maxsize
+        queue = PersistentPriorityQueue(self.path, maxsize=1)
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual(queue.index[resource_id], 3)
+        self.assertEqual(queue.get(), (2, {'id': resource_id}))
+        self.assertEqual(queue.get(), (3, resource_id))
+        self.assertEqual(queue.get(), (1001, resource_id))
+        queue.ack(resource_id)
+        queue.close()
+        self.assertEqual(self.rows(), 0)
+
+    def test_sync(self):
+        queue = PersistentPriorityQueue(self.path, sync_batch=3, sync_interval=100)
+        self.assertEqual(queue.db.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL
+        ids = [uuid4().hex for _ in range(3)]
+        queue.put((1, ids[0]))
+        queue.put((1, ids[1]))
+        self.assertEqual(queue.changes, 2)
+        self.assertEqual(self.rows(), 0)
+
+        # Batch is committed
+        queue.put((1, ids[2]))
+        self.assertEqual(queue.changes, 0)
+        self.assertEqual(self.rows(), 3)
+
+        # Get isn't a change, ack is
+        queue.ack(item_key(queue.get()))
+        self.assertEqual(queue.changes, 1)
+        self.assertEqual(self.rows(), 3)
+        queue.sync()
+        self.assertEqual(self.rows(), 2)
+
+        # Old changes are committed
+        queue.last_sync -= 100
+        queue.ack(item_key(queue.get()))
+        self.assertEqual(self.rows(), 1)
+
+
+class TestDeadLetterStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'dead_letters.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_add_items(self):
+        store = DeadLetterStore(self.path)
+        id_1 = uuid4().hex
+        id_2 = uuid4().hex
+        store.add((1011, id_1), error='Request failed', status_code=502)
+        store.add((12, {'id': id_2, 'dateModified': '2018-01-01'}))
+        self.assertIn(id_1, store)
+        self.assertEqual(len(store), 2)
+
+        # Last drop replaces previous one
+        store.add((1011, id_1), error='Not found', status_code=404)
+        store.close()
+        store = DeadLetterStore(self.path)
+        self.assertEqual(len(store), 2)
+        items = store.items()
+        self.assertEqual([item['id'] for item in items], [id_2, id_1])
+        self.assertEqual((items[0]['item'], items[0]['priority'], items[0]['error']),
+                         ({'id': id_2, 'dateModified': '2018-01-01'}, 12, None))
+        self.assertEqual((items[1]['item'], items[1]['status_code'], items[1]['error']), (None, 404, 'Not found'))
+        self.assertEqual(len(store.items(limit=1)), 1)
+
+    def test_remove(self):
+        store = DeadLetterStore(self.path)
+        id_1 = uuid4().hex
+        id_2 = uuid4().hex
+        store.add((1011, id_1))
+        start = time()
+        store.add((1011, id_2))
+        store.db.execute('UPDATE dead_letters SET dropped = ? WHERE id = ?', (start - 1, id_1))
+
+        # Item dropped again after replay start is kept
+        store.db.execute('UPDATE dead_letters SET dropped = ? WHERE id = ?', (start + 1, id_2))
+        self.assertEqual(store.remove([id_1, id_2], dropped_before=start), 1)
+        self.assertNotIn(id_1, store)
+        self.assertIn(id_2, store)
+        self.assertEqual(store.remove([id_2]), 1)
+        self.assertEqual(len(store), 0)
+
+
+class TestRetryScheduler(unittest.TestCase):
+
+    def test_schedule(self):
+        queue = DedupPriorityQueue()
+        scheduler = RetryScheduler(queue, max_delay=10, jitter=0)
+        id_1 = uuid4().hex
+        id_2 = uuid4().hex
+
+        # Not delayed entry is put to queue immediately
+        scheduler.schedule((1, id_1), 0)
+        self.assertEqual(queue.get(), (1, id_1))
+        self.assertEqual(len(scheduler), 0)
+
+        scheduler.schedule((1001, id_1), 5)
+        scheduler.schedule((2, {'id': id_2}), 1)
+        self.assertIn(id_1, scheduler)
+        self.assertIn(id_2, scheduler)
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(scheduler.heap[0][2], (2, {'id': id_2}))
+        self.assertTrue(scheduler.wakeup.is_set())
+        self.assertEqual(queue.qsize(), 0)
+
+        # Delay is limited by max_delay
+        scheduler.schedule((1, uuid4().hex), 1000)
+        self.assertLessEqual(scheduler.heap[-1][0], time() + 10)
+
+    def test_jitter(self):
+        scheduler = RetryScheduler(DedupPriorityQueue(), max_delay=100, jitter=0.5)
+        for _ in xrange(20):
+            start = time()
+            scheduler.schedule((1, uuid4().hex), 10)
+            due = max(entry[0] for entry in scheduler.heap) - start
+            self.assertGreaterEqual(due, 4.9)
+            self.assertLessEqual(due, 15.1)
+        self.assertEqual(len(scheduler), 20)
+
+    def test_release(self):
+        queue = DedupPriorityQueue()
+        scheduler = RetryScheduler(queue, jitter=0)
+        resource_id = uuid4().hex
+        scheduler.schedule((1001, resource_id), 100)
+        scheduler.schedule((1, resource_id), 0.01)
+        self.assertEqual(scheduler.index[resource_id], 2)
+
+        sleep(0.02)
+        scheduler._release()
+        self.assertEqual(queue.get(), (1, resource_id))
+        self.assertIn(resource_id, scheduler)
+        self.assertEqual(len(scheduler), 1)
+
+        scheduler.heap[0] = (0,) + scheduler.heap[0][1:]
+        scheduler._release()
+        self.assertEqual(queue.get(), (1001, resource_id))
+        self.assertNotIn(resource_id, scheduler)
+        self.assertEqual(scheduler.index, {})
+
+    @patch('openprocurement.bridge.basic.queues.INFINITY')
+    def test_run(self, infinity):
+        queue = DedupPriorityQueue()
+        scheduler = RetryScheduler(queue, jitter=0)
+        resource_id = uuid4().hex
+        scheduler.schedule((1, resource_id), 0.01)
+        # First pass is woken up by schedule, second waits until entry is due
+        infinity.__nonzero__.side_effect = [True, True, False]
+        scheduler._run()
+        self.assertEqual(queue.get(), (1, resource_id))
+        self.assertFalse(scheduler.wakeup.is_set())
+
+    def test_start(self):
+        queue = DedupPriorityQueue()
+        scheduler = RetryScheduler(queue, jitter=0)
+        greenlet = scheduler.start()
+        self.assertIs(scheduler.greenlet, greenlet)
+        scheduler.schedule((1, uuid4().hex), 0.01)
+        sleep(0.05)
+        self.assertEqual(queue.qsize(), 1)
+        greenlet.kill()
+
+
+class TestInFlightRegistry(unittest.TestCase):
+
+    def test_acquire_release(self):
+        registry = InFlightRegistry()
+        resource_id = uuid4().hex
+        self.assertTrue(registry.acquire(resource_id))
+        self.assertIn(resource_id, registry)
+        self.assertFalse(registry.acquire(resource_id))
+        self.assertFalse(registry.acquire(resource_id))
+        self.assertTrue(registry.acquire(uuid4().hex))
+        self.assertEqual(registry.stats(), {'in_flight': 2, 'duplicates': 2})
+
+        registry.release(resource_id)
+        registry.release(resource_id)
+        self.assertNotIn(resource_id, registry)
+        self.assertEqual(len(registry), 1)
+        self.assertTrue(registry.acquire(resource_id))
+
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_acquire(self):
+        limiter = RateLimiter(max_rate=100, burst=2)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertLessEqual(limiter.ready_at() - time(), 0.01)
+        # Empty bucket goes into debt
+        self.assertAlmostEqual(limiter.acquire(), 0.01, places=3)
+        self.assertAlmostEqual(limiter.acquire(), 0.02, places=3)
+        sleep(0.02)
+        self.assertLessEqual(limiter.ready_at() - time(), 0.01)
+        limiter.reset()
+        self.assertEqual((limiter.tokens, limiter.ready_at() <= time()), (2, True))
+
+    def test_aimd(self):
+        limiter = RateLimiter(max_rate=10, min_rate=1, increase=2, decrease=0.5)
+        self.assertEqual(limiter.interval, 0)
+        limiter.throttle()
+        self.assertEqual((limiter.rate, limiter.interval), (5, 0.2))
+        # Throttled client waits full interval
+        self.assertAlmostEqual(limiter.ready_at() - time(), 0.2, places=2)
+        for _ in xrange(3):
+            limiter.throttle()
+        self.assertEqual(limiter.rate, 1)
+        limiter.success()
+        self.assertEqual(limiter.rate, 3)
+        for _ in xrange(5):
+            limiter.success()
+        self.assertEqual((limiter.rate, limiter.interval), (10, 0))
+
+    def test_throttled(self):
+        limiter = RateLimiter(max_rate=10, increase=2, decrease=0.5)
+        self.assertFalse(limiter.throttled)
+        limiter.throttle()
+        self.assertTrue(limiter.throttled)
+        # Recovering client still has requests interval, but isn't throttled
+        limiter.success()
+        self.assertFalse(limiter.throttled)
+        self.assertGreater(limiter.interval, 0)
+        self.assertFalse(RateLimiter(max_rate=10, decrease=1).throttled)
+
+
+class TestAPIClientsQueue(unittest.TestCase):
+
+    def test_ready_first(self):
+        queue = APIClientsQueue()
+        throttled = {'id': 'throttled', 'limiter': RateLimiter(max_rate=10)}
+        throttled['limiter'].throttle()
+        slow = {'id': 'slow', 'limiter': RateLimiter(max_rate=10)}
+        slow['limiter'].acquire()
+        ready = {'id': 'ready', 'limiter': RateLimiter(max_rate=10)}
+        for client in (throttled, slow, ready):
+            queue.put(client)
+        queue.put({'id': 'unlimited'})
+        self.assertEqual(queue.peek()['id'], 'unlimited')
+        self.assertEqual([queue.get()['id'] for _ in xrange(4)], ['unlimited', 'ready', 'slow', 'throttled'])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestDedupPriorityQueue))
+    suite.addTest(unittest.makeSuite(TestPersistentPriorityQueue))
+    suite.addTest(unittest.makeSuite(TestDeadLetterStore))
+    suite.addTest(unittest.makeSuite(TestRetryScheduler))
+    suite.addTest(unittest.makeSuite(TestInFlightRegistry))
+    suite.addTest(unittest.makeSuite(TestRateLimiter))
+    suite.addTest(unittest.makeSuite(TestAPIClientsQueue))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
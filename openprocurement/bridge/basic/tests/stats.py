@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from openprocurement.bridge.basic.stats import RequestDurations
+
+
+class TestRequestDurations(unittest.TestCase):
+
+    def test_add(self):
+        durations = RequestDurations(3)
+        self.assertEqual((len(durations), durations.mean, durations.since), (0, 0, None))
+        self.assertEqual(durations.percentiles(), [0, 0, 0])
+        durations.add(1, now=10)
+        durations.add(2, now=11)
+        durations.add(3, now=12)
+        self.assertEqual((len(durations), durations.mean, durations.since), (3, 2, 10))
+
+        # Oldest sample is overwritten
+        durations.add(5, now=13)
+        self.assertEqual((len(durations), durations.mean, durations.since), (3, 10 / 3.0, 10))
+        self.assertEqual(list(durations.times), [13, 11, 12])
+        self.assertEqual(durations.percentiles(), [3, 5, 5])
+
+    def test_expire(self):
+        durations = RequestDurations(4)
+        for i in xrange(6):
+            durations.add(i, now=i)
+        durations.expire(4)
+        self.assertEqual((len(durations), durations.mean), (2, 4.5))
+        self.assertEqual(durations.percentiles(50), [4])
+        durations.expire(10)
+        self.assertEqual((len(durations), durations.total, durations.since), (0, 0, None))
+        durations.add(1, now=20)
+        self.assertEqual((len(durations), durations.mean, durations.since), (1, 1, 20))
+
+    def test_percentiles(self):
+        durations = RequestDurations(200)
+        for i in xrange(200):
+            durations.add(100 - i * 0.5)
+        self.assertEqual(durations.percentiles(), [50, 95, 99])
+        self.assertEqual(durations.percentiles(1, 100), [1, 100])
+
+    def test_reset(self):
+        durations = RequestDurations(2)
+        durations.add(1)
+        durations.reset()
+        self.assertEqual((len(durations), durations.mean, durations.since), (0, 0, None))
+        self.assertFalse(hasattr(durations, '__dict__'))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestRequestDurations))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -6,6 +6,7 @@ from uuid import uuid4
 
 from couchdb.http import Unauthorized
 from mock import MagicMock, call, patch
+from munch import munchify
 
 from openprocurement.bridge.basic.storages.couchdb_plugin import CouchDBStorage
 from openprocurement.bridge.basic.tests.base import TEST_CONFIG
@@ -51,6 +52,38 @@ class TestCouchDBStorage(unittest.TestCase):
         doc = db.get_doc('1')
         self.assertEqual(mocked_doc, doc)
 
+    @patch('openprocurement.bridge.basic.storages.couchdb_plugin.Server')
+    def test_iter_date_modified(self, mocked_server):
+        db = CouchDBStorage(self.config)
+        db.db = MagicMock()
+        db.db.iterview.return_value = [munchify({'id': '1', 'key': '2018-01-01'}),
+                                       munchify({'id': '2', 'key': '2018-01-02'})]
+        self.assertEqual(list(db.iter_date_modified(batch=2)), [('1', '2018-01-01'), ('2', '2018-01-02')])
+        db.db.iterview.assert_called_once_with(db.view_path, 2)
+
+    @patch('openprocurement.bridge.basic.storages.couchdb_plugin.Server')
+    def test_get_docs(self, mocked_server):
+        db = CouchDBStorage(self.config)
+        db.db = MagicMock()
+        db.db.view.return_value = [munchify({'id': '1', 'key': '1', 'value': {'rev': '1-a'}, 'doc': {'_id': '1'}}),
+                                   munchify({'key': '2', 'error': 'not_found'}),
+                                   munchify({'id': '3', 'key': '3', 'value': {'deleted': True}, 'doc': None})]
+        self.assertEqual(db.get_docs(['1', '2', '3']), {'1': {'_id': '1'}})
+        db.db.view.assert_called_once_with('_all_docs', keys=['1', '2', '3'], include_docs=True)
+        self.assertEqual(db.get_docs([]), {})
+        self.assertEqual(db.db.view.call_count, 1)
+
+    @patch('openprocurement.bridge.basic.storages.couchdb_plugin.Server')
+    def test_get_docs_meta(self, mocked_server):
+        db = CouchDBStorage(self.config)
+        db.db = MagicMock()
+        db.db.view.return_value = [munchify({'id': '1', 'key': '1', 'value': {'rev': '1-a'}}),
+                                   munchify({'key': '2', 'error': 'not_found'}),
+                                   munchify({'id': '3', 'key': '3', 'value': {'rev': '2-b', 'deleted': True}})]
+        self.assertEqual(db.get_docs_meta(['1', '2', '3']), {'1': {'_id': '1', '_rev': '1-a'}})
+        db.db.view.assert_called_once_with('_all_docs', keys=['1', '2', '3'])
+        self.assertEqual(db.get_docs_meta([]), {})
+
     @patch('openprocurement.bridge.basic.storages.couchdb_plugin.Server')
     def test_save_bulk(self, mocked_server):
         storage = CouchDBStorage(self.config)
@@ -4,7 +4,11 @@ from copy import deepcopy
 
 from mock import patch
 
-from openprocurement.bridge.basic.storages.elasticsearch_plugin import ElasticsearchStorage, includeme
+from openprocurement.bridge.basic.storages.elasticsearch_plugin import (
+    ElasticsearchStorage,
+    STORAGE_DEFAULTS,
+    includeme
+)
 from openprocurement.bridge.basic.tests.base import TEST_CONFIG
 
 
@@ -128,6 +132,91 @@ class TestElasticsearchStorage(unittest.TestCase):
         self.assertEqual(doc, {'id': self.id_2, '_ver': 1})
         self.assertEqual(db.doc_type, self.config['resource'])
 
+    @patch('openprocurement.bridge.basic.storages.elasticsearch_plugin.Elasticsearch')
+    def test_get_docs(self, mocked_elastic):
+        mocked_elastic().indices.get_settings.return_value = {}
+        db = ElasticsearchStorage(self.config)
+        db.db.mget.return_value = {'docs': [
+            {'_id': self.id_1, 'found': False},
+            {'_id': self.id_2, 'found': True, '_version': 2, '_source': {'id': self.id_2}}
+        ]}
+        self.assertEqual(db.get_docs([self.id_1, self.id_2]), {self.id_2: {'id': self.id_2, '_ver': 2}})
+        db.db.mget.assert_called_once_with(index=db.alias, doc_type='Tenders', body={'ids': [self.id_1, self.id_2]})
+        self.assertEqual(db.get_docs([]), {})
+
+    @patch('openprocurement.bridge.basic.storages.elasticsearch_plugin.Elasticsearch')
+    def test_get_docs_meta(self, mocked_elastic):
+        mocked_elastic().indices.get_settings.return_value = {}
+        db = ElasticsearchStorage(self.config)
+        db.db.mget.return_value = {'docs': [
+            {'_id': self.id_1, 'found': False},
+            {'_id': self.id_2, 'found': True, '_version': 2}
+        ]}
+        self.assertEqual(db.get_docs_meta([self.id_1, self.id_2]), {self.id_2: {'_ver': 2}})
+        db.db.mget.assert_called_once_with(index=db.alias, doc_type='Tenders',
+                                           body={'ids': [self.id_1, self.id_2]}, _source=False)
+        self.assertEqual(db.get_docs_meta([]), {})
+
+    @patch('openprocurement.bridge.basic.storages.elasticsearch_plugin.Elasticsearch')
+    def test_get_date_modified(self, mocked_elastic):
+        mocked_elastic().indices.get_settings.return_value = {}
+        db = ElasticsearchStorage(self.config)
+        self.assertEqual(db.date_modified_lookup, 'source')
+        db.db.mget.return_value = {'docs': [
+            {'_id': self.id_1, 'found': False},
+            {'_id': self.id_2, 'found': True, '_version': 2, '_source': {'dateModified': '2018-01-01'}}
+        ]}
+        self.assertEqual(db.get_date_modified([self.id_1, self.id_2]), {self.id_1: False, self.id_2: '2018-01-01'})
+        db.db.mget.assert_called_once_with(index=db.alias, doc_type='Tenders', body={'ids': [self.id_1, self.id_2]},
+                                           _source_include='dateModified')
+        self.assertEqual(db.get_date_modified([]), {})
+        self.assertEqual(db.db.search.call_count, 0)
+
+    @patch('openprocurement.bridge.basic.storages.elasticsearch_plugin.Elasticsearch')
+    def test_get_date_modified_doc_values(self, mocked_elastic):
+        mocked_elastic().indices.get_settings.return_value = {}
+        mocked_elastic().indices.put_mapping.return_value = {'acknowledged': True}
+        config = deepcopy(self.config)
+        config['storage_config']['date_modified_lookup'] = 'docvalue_fields'
+        try:
+            db = ElasticsearchStorage(config)
+        finally:
+            STORAGE_DEFAULTS['date_modified_lookup'] = 'source'
+        id_3, id_4 = '4dbb346095554f788b568c5c29e9ef23', 'ae50ea25bb1349898600ab380ee74e57'
+        db.db.search.return_value = {'hits': {'hits': [
+            {'_id': self.id_1, 'fields': {'dateModified': ['2018-01-01']}},
+            # Stored document without dateModified
+            {'_id': id_4}
+        ]}}
+        ids = [self.id_1, id_3, id_4]
+        self.assertEqual(db.get_date_modified(ids), {self.id_1: '2018-01-01', id_3: False, id_4: False})
+        db.db.search.assert_called_once_with(index=db.alias, doc_type='Tenders', body={
+            'query': {'ids': {'values': ids}}, '_source': False, 'docvalue_fields': ['dateModified'], 'size': 3
+        })
+        self.assertEqual(db.db.mget.call_count, 0)
+
+    @patch('openprocurement.bridge.basic.storages.elasticsearch_plugin.LOGGER')
+    @patch('openprocurement.bridge.basic.storages.elasticsearch_plugin.Elasticsearch')
+    def test_date_modified_doc_values_mapping(self, mocked_elastic, mocked_logger):
+        mocked_elastic().indices.get_settings.return_value = {}
+        config = deepcopy(self.config)
+        config['storage_config']['date_modified_lookup'] = 'docvalue_fields'
+        mocked_elastic().indices.put_mapping.return_value = {'acknowledged': True}
+        db = ElasticsearchStorage(config)
+        db.db.indices.put_mapping.assert_called_once_with(
+            index=db.db_name, doc_type='Tenders',
+            body={'properties': {'dateModified': {'type': 'keyword', 'doc_values': True}}}, ignore=400
+        )
+        self.assertEqual(mocked_logger.error.call_count, 0)
+
+        self.assertEqual(db.date_modified_lookup, 'docvalue_fields')
+
+        mocked_elastic().indices.put_mapping.return_value = {'error': 'conflict'}
+        db = ElasticsearchStorage(config)
+        mocked_logger.error.assert_called_once_with('Can\'t map dateModified as keyword, read it from source: conflict')
+        self.assertEqual(db.date_modified_lookup, 'source')
+        STORAGE_DEFAULTS['date_modified_lookup'] = 'source'
+
     @patch('openprocurement.bridge.basic.storages.elasticsearch_plugin.Elasticsearch')
     def test_includeme(self, mocked_elastic):
         config = {'resource': 'lots'}
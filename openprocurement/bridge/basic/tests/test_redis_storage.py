@@ -71,4 +71,20 @@ class TestDbs(unittest.TestCase):
     def test_has(self):
         self.assertEquals(self.db.has('test_has'), False)
         self.db.set_value('test_has', 'test_has')
-        self.assertEquals(self.db.has('test_has'), True)
\ No newline at end of file
+        self.assertEquals(self.db.has('test_has'), True)
+
+    def test_get_many(self):
+        self.db.db = MagicMock()
+        self.db.db.mget.return_value = ['value_1', None]
+        self.assertEqual(self.db.get_many(['key_1', 'key_2']), {'key_1': 'value_1'})
+        self.db.db.mget.assert_called_once_with(['key_1', 'key_2'])
+
+        self.db.db.mget.reset_mock()
+        self.assertEqual(self.db.get_many([]), {})
+        self.assertEqual(self.db.db.mget.call_count, 0)
+
+    @patch('openprocurement.bridge.basic.storages.redis_plugin.Db')
+    def test_lazy_get_many(self, mocked_db):
+        db = lazy_includeme(self.config)
+        db.db = {'key_1': 'value_1'}
+        self.assertEqual(db.get_many(['key_1', 'key_2']), {'key_1': 'value_1'})
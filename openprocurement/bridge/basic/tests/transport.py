@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from requests import Session
+
+from openprocurement.bridge.basic.transport import SharedHTTPAdapter
+
+
+class TestSharedHTTPAdapter(unittest.TestCase):
+
+    def test_mount_to(self):
+        adapter = SharedHTTPAdapter(4)
+        self.assertEqual(adapter._pool_maxsize, 4)
+        first, second = Session(), Session()
+        default_adapter = first.get_adapter('http://localhost')
+        default_adapter.poolmanager.connection_from_url('http://localhost')
+        adapter.mount_to(first)
+        adapter.mount_to(second)
+        self.assertIs(first.get_adapter('http://localhost/api'), adapter)
+        self.assertIs(second.get_adapter('https://localhost/api'), adapter)
+        # Connections of default adapter are closed
+        self.assertEqual(len(default_adapter.poolmanager.pools), 0)
+        adapter.mount_to(first)
+        self.assertIs(first.get_adapter('http://localhost/api'), adapter)
+
+        # Cookie jars are separate
+        first.cookies.set('SERVER_ID', '1')
+        self.assertNotIn('SERVER_ID', second.cookies)
+
+    def test_stats(self):
+        adapter = SharedHTTPAdapter(4)
+        self.assertEqual(adapter.stats(), {'requests': 0, 'handshakes': 0, 'reused': 0, 'reuse_rate': 0})
+        pool = adapter.poolmanager.connection_from_url('http://localhost')
+        pool.num_requests, pool.num_connections = 3, 1
+        pool = adapter.poolmanager.connection_from_url('https://localhost')
+        pool.num_requests, pool.num_connections = 1, 1
+        self.assertEqual(adapter.stats(), {'requests': 4, 'handshakes': 2, 'reused': 2, 'reuse_rate': 0.5})
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSharedHTTPAdapter))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import unittest
 
-from openprocurement.bridge.basic.utils import journal_context, generate_req_id
+from openprocurement.bridge.basic.utils import accepted_kwargs, journal_context, generate_req_id
 
 
 class TestUtilsFunctions(unittest.TestCase):
@@ -15,6 +15,20 @@ class TestUtilsFunctions(unittest.TestCase):
         self.assertEquals(len(req_id), 64)
         self.assertEquals(req_id.startswith('contracting-data-bridge-req-'), True)
 
+    def test_accepted_kwargs(self):
+        class Plugin(object):
+            def __init__(self, conf, db=None, pool=None):
+                pass
+
+        class KeywordsPlugin(object):
+            def __init__(self, conf, **kwargs):
+                pass
+
+        kwargs = {'db': 'db', 'pool': 'pool', 'in_flight': {}}
+        self.assertEquals(accepted_kwargs(Plugin, kwargs), {'db': 'db', 'pool': 'pool'})
+        self.assertEquals(accepted_kwargs(KeywordsPlugin, kwargs), kwargs)
+        self.assertEquals(accepted_kwargs(object, kwargs), {})
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -1,19 +1,26 @@
 # -*- coding: utf-8 -*-
 import datetime
+import json
 import logging
 import unittest
 import uuid
 from copy import deepcopy
 
 import iso8601
-from gevent import sleep, idle
-from gevent.queue import Empty, Queue, PriorityQueue
+from gevent import get_hub, sleep, idle
+from gevent.queue import Empty, Queue
 from mock import MagicMock, call, patch
-from munch import munchify
+from munch import Munch, munchify
 from openprocurement_client.exceptions import ResourceNotFound as RNF
-from openprocurement_client.exceptions import (InvalidResponse, RequestFailed,
+from openprocurement_client.exceptions import (InvalidResponse, PreconditionFailed, RequestFailed,
                                                ResourceGone)
 
+from openprocurement.bridge.basic.caches import ContentHashCache, DateModifiedCache, ValidatorsCache
+from openprocurement.bridge.basic.queues import (
+    DedupPriorityQueue, InFlightRegistry, PersistentPriorityQueue, RateLimiter, RetryScheduler
+)
+from openprocurement.bridge.basic.stats import RequestDurations
+from openprocurement.bridge.basic.utils import DataBridgeConfigError
 from openprocurement.bridge.basic.workers import TZ, BasicResourceItemWorker, AgreementWorker, logger
 from openprocurement.bridge.basic.tests.base import TEST_CONFIG
 
@@ -25,8 +32,8 @@ class TestResourceItemWorker(unittest.TestCase):
     config = deepcopy(TEST_CONFIG['main'])
 
     worker_config = config['worker_config']
-    worker_config['client_inc_step_timeout'] = 0.1
-    worker_config['client_dec_step_timeout'] = 0.02
+    worker_config['client_rate_decrease'] = 0.5
+    worker_config['client_rate_increase'] = 1
     worker_config['drop_threshold_client_cookies'] = 1.5
     worker_config['worker_sleep'] = 0.1
     worker_config['retry_default_timeout'] = 0.5
@@ -36,8 +43,8 @@ class TestResourceItemWorker(unittest.TestCase):
     worker_config['bulk_save_interval'] = 0.1
 
     def tearDown(self):
-        self.worker_config['client_inc_step_timeout'] = 0.1
-        self.worker_config['client_dec_step_timeout'] = 0.02
+        self.worker_config['client_rate_decrease'] = 0.5
+        self.worker_config['client_rate_increase'] = 1
         self.worker_config['drop_threshold_client_cookies'] = 1.5
         self.worker_config['worker_sleep'] = 0.03
         self.worker_config['retry_default_timeout'] = 0.05
@@ -59,7 +66,7 @@ class TestResourceItemWorker(unittest.TestCase):
 
     @patch('openprocurement.bridge.basic.workers.logger')
     def test_add_to_retry_queue(self, mocked_logger):
-        retry_items_queue = PriorityQueue()
+        retry_items_queue = DedupPriorityQueue()
         worker = BasicResourceItemWorker(config_dict=self.config, retry_resource_items_queue=retry_items_queue)
         resource_item_id = uuid.uuid4().hex
         priority = 1000
@@ -73,6 +80,12 @@ class TestResourceItemWorker(unittest.TestCase):
         self.assertEqual(priority, 1001)
         self.assertEqual(retry_resource_item_id, resource_item_id)
 
+        # Skip item which already in retry_resource_items_queue
+        retry_items_queue.put((1001, resource_item_id))
+        worker.add_to_retry_queue(resource_item_id, priority=1000)
+        self.assertEqual(retry_items_queue.qsize(), 1)
+        self.assertEqual(retry_items_queue.get(), (1001, resource_item_id))
+
         # Add to retry_resource_items_queue with status_code '429'
         worker.add_to_retry_queue(resource_item_id, priority, status_code=429)
         self.assertEqual(retry_items_queue.qsize(), 1)
@@ -97,6 +110,136 @@ class TestResourceItemWorker(unittest.TestCase):
         )
         del worker
 
+    def test__get_conditional_headers(self):
+        resource_item_id = uuid.uuid4().hex
+        date_modified_cache = DateModifiedCache(1)
+        validators_cache = ValidatorsCache(10)
+        validators_cache.data[resource_item_id] = ['"etag"', None, 100, '2018-01-02']
+        worker = BasicResourceItemWorker(config_dict=self.config, date_modified_cache=date_modified_cache)
+        self.assertIsNone(worker._get_conditional_headers(resource_item_id, None))
+
+        # Storage doesn't have cached version
+        worker.validators_cache = validators_cache
+        self.assertIsNone(worker._get_conditional_headers(resource_item_id, None))
+        date_modified_cache.put(resource_item_id, '2018-01-01')
+        self.assertIsNone(worker._get_conditional_headers(resource_item_id, {'_rev': '1-a'}))
+
+        date_modified_cache.put(resource_item_id, '2018-01-02')
+        self.assertEqual(worker._get_conditional_headers(resource_item_id, {'_rev': '1-a'}),
+                         {'If-None-Match': '"etag"'})
+
+        # Full local doc is checked without date modified cache
+        worker.date_modified_cache = None
+        self.assertIsNone(worker._get_conditional_headers(resource_item_id, None))
+        self.assertIsNone(worker._get_conditional_headers(resource_item_id, {'dateModified': '2018-01-01'}))
+        self.assertEqual(worker._get_conditional_headers(resource_item_id, {'dateModified': '2018-01-02'}),
+                         {'If-None-Match': '"etag"'})
+        self.assertEqual(validators_cache.conditional, 2)
+
+        # Validators without dateModified of received document
+        self.assertIsNone(worker._get_conditional_headers(uuid.uuid4().hex, {'dateModified': '2018-01-02'}))
+        del worker
+
+    def test__get_resource_item_from_public_not_modified(self):
+        resource_item_id = uuid.uuid4().hex
+        client = MagicMock()
+        client_dict = {'id': uuid.uuid4().hex, 'request_interval': 0, 'client': client}
+        api_clients_queue = Queue()
+        validators_cache = ValidatorsCache(10)
+        validators_cache.data[resource_item_id] = ['"etag"', None, 100, None]
+        api_clients_info = {client_dict['id']: {'request_durations': RequestDurations()}}
+        worker = BasicResourceItemWorker(api_clients_queue=api_clients_queue, config_dict=self.config,
+                                         retry_resource_items_queue=DedupPriorityQueue(),
+                                         api_clients_info=api_clients_info,
+                                         validators_cache=validators_cache)
+        date_modified = datetime.datetime.now(TZ).isoformat()
+        client.request.return_value = munchify({
+            'status_code': 200, 'content': json.dumps({'data': {'id': resource_item_id, 'dateModified': date_modified}})
+        })
+        self.assertEqual(worker._get_resource_item_from_public(client_dict, 1, resource_item_id),
+                         {'id': resource_item_id, 'dateModified': date_modified})
+        client.request.assert_called_once_with('GET', '{}/{}'.format(client.prefix_path, resource_item_id),
+                                               headers=None)
+        self.assertEqual(validators_cache.get_date_modified(resource_item_id), date_modified)
+        api_clients_queue.get()
+
+        headers = {'If-None-Match': '"etag"'}
+        client.request.return_value = munchify({'status_code': 304, 'text': '', 'content': ''})
+        self.assertIsNone(worker._get_resource_item_from_public(client_dict, 1, resource_item_id, headers=headers))
+        client.request.assert_called_with('GET', '{}/{}'.format(client.prefix_path, resource_item_id),
+                                          headers=headers)
+        self.assertEqual((validators_cache.not_modified, validators_cache.bytes_saved), (1, 100))
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 0)
+        self.assertEqual(api_clients_queue.qsize(), 1)
+        del worker
+
+    def test__get_public_document(self):
+        resource_item_id = uuid.uuid4().hex
+        body = json.dumps({'data': {'id': resource_item_id, 'lots': [{'description': 'x' * 100}]}})
+        client = MagicMock(prefix_path='http://localhost/api/2.4/tenders')
+        client.request.return_value = munchify({'status_code': 200, 'content': body})
+        worker = BasicResourceItemWorker(config_dict=self.config)
+        self.assertEqual(worker.threadpool_decode_size, 1024 * 1024)
+        document = worker._get_public_document(client, resource_item_id)
+        self.assertIsInstance(document, Munch)
+        self.assertEqual(document.data.lots[0].description, 'x' * 100)
+        client.request.assert_called_once_with(
+            'GET', 'http://localhost/api/2.4/tenders/{}'.format(resource_item_id), headers=None)
+
+        # Large body is decoded in hub thread pool, result is same as decoded in greenlet
+        worker.threadpool_decode_size = len(body)
+        with patch('openprocurement.bridge.basic.workers.get_hub', wraps=get_hub) as mocked_get_hub:
+            self.assertEqual(worker._get_public_document(client, resource_item_id, {'If-None-Match': '"a"'}),
+                             document)
+            self.assertEqual(mocked_get_hub.call_count, 1)
+        client.request.assert_called_with(
+            'GET', 'http://localhost/api/2.4/tenders/{}'.format(resource_item_id), headers={'If-None-Match': '"a"'})
+
+        # Error statuses are mapped to client exceptions
+        for status_code, exception in ((404, RNF), (410, ResourceGone), (412, PreconditionFailed),
+                                       (429, RequestFailed), (201, InvalidResponse)):
+            client.request.return_value = munchify({'status_code': status_code, 'text': '', 'content': ''})
+            with self.assertRaises(exception) as context:
+                worker._get_public_document(client, resource_item_id)
+            self.assertEqual(context.exception.status_code, status_code)
+        del worker
+
+    def test_add_to_retry_queue_dead_letters(self):
+        dead_letters = MagicMock()
+        worker = BasicResourceItemWorker(config_dict=self.config, retry_resource_items_queue=DedupPriorityQueue(),
+                                         dead_letters=dead_letters)
+        resource_item_id = uuid.uuid4().hex
+        worker.add_to_retry_queue(resource_item_id, priority=1003, status_code=502, error='Request failed')
+        dead_letters.add.assert_called_once_with((1003, resource_item_id), error='Request failed', status_code=502)
+
+        # Not dropped item isn't stored
+        dead_letters.reset_mock()
+        worker.add_to_retry_queue(resource_item_id, priority=1000, error='Request failed')
+        self.assertEqual(dead_letters.add.call_count, 0)
+        del worker
+
+    def test_add_to_retry_queue_with_scheduler(self):
+        retry_items_queue = DedupPriorityQueue()
+        scheduler = RetryScheduler(retry_items_queue, jitter=0)
+        worker = BasicResourceItemWorker(config_dict=self.config, retry_resource_items_queue=retry_items_queue,
+                                         retry_scheduler=scheduler)
+        resource_item_id = uuid.uuid4().hex
+
+        # First retry isn't delayed
+        worker.add_to_retry_queue(resource_item_id, priority=1000)
+        self.assertEqual(retry_items_queue.get(), (1001, resource_item_id))
+
+        # Next retry is scheduled without blocking worker
+        worker.add_to_retry_queue(resource_item_id, priority=1001)
+        self.assertEqual(retry_items_queue.qsize(), 0)
+        self.assertIn(resource_item_id, scheduler)
+        self.assertEqual(scheduler.heap[0][2], (1002, resource_item_id))
+
+        # Skip item which already scheduled
+        worker.add_to_retry_queue(resource_item_id, priority=1002)
+        self.assertEqual(len(scheduler), 1)
+        del worker
+
     @patch('openprocurement.bridge.basic.workers.logger')
     @patch('openprocurement.bridge.basic.workers.datetime')
     def test_log_timeshift(self, mocked_datetime, mocked_logger):
@@ -133,9 +276,11 @@ class TestResourceItemWorker(unittest.TestCase):
             client_dict2['id']: {
                 'drop_cookies': True,
                 'not_actual_count': 3,
-                'request_interval': 2
+                'request_interval': 2,
+                'request_durations': RequestDurations()
             }
         }
+        api_clients_info[client_dict2['id']]['request_durations'].add(1)
 
         # Success test
         worker = BasicResourceItemWorker(api_clients_queue=api_clients_queue, config_dict=self.config,
@@ -148,6 +293,7 @@ class TestResourceItemWorker(unittest.TestCase):
         api_client = worker._get_api_client_dict()
         self.assertEqual(api_client['not_actual_count'], 0)
         self.assertEqual(api_client['request_interval'], 0)
+        self.assertEqual(len(api_clients_info[client_dict2['id']]['request_durations']), 0)
 
         # Empty queue test
         api_client = worker._get_api_client_dict()
@@ -171,7 +317,7 @@ class TestResourceItemWorker(unittest.TestCase):
         del worker
 
     def test__get_resource_item_from_queue(self):
-        items_queue = PriorityQueue()
+        items_queue = DedupPriorityQueue()
         item = (1, uuid.uuid4().hex)
         items_queue.put(item)
 
@@ -197,18 +343,19 @@ class TestResourceItemWorker(unittest.TestCase):
         client_dict = {
             'id': uuid.uuid4().hex,
             'request_interval': 0.02,
+            'limiter': RateLimiter(),
             'client': mock_api_client
         }
         api_clients_queue.put(client_dict)
-        api_clients_info = {client_dict['id']: {'drop_cookies': False, 'request_durations': {}}}
-        retry_queue = PriorityQueue()
+        api_clients_info = {client_dict['id']: {'drop_cookies': False, 'request_durations': RequestDurations()}}
+        retry_queue = DedupPriorityQueue()
         return_dict = {
             'data': {
                 'id': resource_item_id,
                 'dateModified': datetime.datetime.utcnow().isoformat()
             }
         }
-        mock_api_client.get_resource_item.return_value = return_dict
+        mock_api_client.request.return_value = munchify({'status_code': 200, 'content': json.dumps(return_dict)})
         worker = BasicResourceItemWorker(api_clients_queue=api_clients_queue,
                                          config_dict=self.config,
                                          retry_resource_items_queue=retry_queue,
@@ -224,41 +371,45 @@ class TestResourceItemWorker(unittest.TestCase):
         self.assertEqual(public_item, return_dict['data'])
 
         # InvalidResponse
-        mock_api_client.get_resource_item.side_effect = InvalidResponse('invalid response')
+        mock_api_client.request.side_effect = InvalidResponse('invalid response')
         api_client = worker._get_api_client_dict()
         self.assertEqual(worker.api_clients_queue.qsize(), 0)
         public_item = worker._get_resource_item_from_public(api_client, priority, resource_item_id)
         self.assertEqual(public_item, None)
         sleep(worker.config['retry_default_timeout'] * 1)
         self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
 
         # RequestFailed status_code=429
-        mock_api_client.get_resource_item.side_effect = RequestFailed(munchify({'status_code': 429}))
+        mock_api_client.request.side_effect = RequestFailed(munchify({'status_code': 429}))
         api_client = worker._get_api_client_dict()
         self.assertEqual(worker.api_clients_queue.qsize(), 0)
         self.assertEqual(api_client['request_interval'], 0)
         public_item = worker._get_resource_item_from_public(api_client, priority, resource_item_id)
         self.assertEqual(public_item, None)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 2)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         api_client = worker._get_api_client_dict()
         self.assertEqual(worker.api_clients_queue.qsize(), 0)
-        self.assertEqual(api_client['request_interval'], worker.config['client_inc_step_timeout'])
+        # Rate is halved
+        self.assertEqual(api_client['request_interval'], 0.02)
 
         # RequestFailed status_code=429 with drop cookies
-        api_client['request_interval'] = 2
+        api_client['limiter'].rate = 0.4
         public_item = worker._get_resource_item_from_public(api_client, priority, resource_item_id)
         sleep(api_client['request_interval'])
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         self.assertEqual(public_item, None)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 3)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
 
         # RequestFailed with status_code not equal 429
-        mock_api_client.get_resource_item.side_effect = RequestFailed(munchify({'status_code': 404}))
+        mock_api_client.request.side_effect = RequestFailed(munchify({'status_code': 404}))
         api_client = worker._get_api_client_dict()
         self.assertEqual(worker.api_clients_queue.qsize(), 0)
         public_item = worker._get_resource_item_from_public(api_client, priority, resource_item_id)
@@ -266,10 +417,11 @@ class TestResourceItemWorker(unittest.TestCase):
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 4)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
 
         # ResourceNotFound
-        mock_api_client.get_resource_item.side_effect = RNF(munchify({'status_code': 404}))
+        mock_api_client.request.side_effect = RNF(munchify({'status_code': 404}))
         api_client = worker._get_api_client_dict()
         self.assertEqual(worker.api_clients_queue.qsize(), 0)
         public_item = worker._get_resource_item_from_public(api_client, priority, resource_item_id)
@@ -277,10 +429,11 @@ class TestResourceItemWorker(unittest.TestCase):
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 5)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
 
         # ResourceGone
-        mock_api_client.get_resource_item.side_effect = ResourceGone(munchify({'status_code': 410}))
+        mock_api_client.request.side_effect = ResourceGone(munchify({'status_code': 410}))
         api_client = worker._get_api_client_dict()
         self.assertEqual(worker.api_clients_queue.qsize(), 0)
         public_item = worker._get_resource_item_from_public(api_client, priority, resource_item_id)
@@ -288,21 +441,22 @@ class TestResourceItemWorker(unittest.TestCase):
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 5)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 0)
 
         # Exception
         api_client = worker._get_api_client_dict()
-        mock_api_client.get_resource_item.side_effect = Exception('text except')
+        mock_api_client.request.side_effect = Exception('text except')
         public_item = worker._get_resource_item_from_public(api_client, priority, resource_item_id)
         self.assertEqual(public_item, None)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 6)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
 
         del worker
 
     def test__add_to_bulk(self):
-        retry_queue = PriorityQueue()
+        retry_queue = DedupPriorityQueue()
         old_date_modified = datetime.datetime.utcnow().isoformat()
         resource_item_id = uuid.uuid4().hex
         priority = 1
@@ -347,9 +501,109 @@ class TestResourceItemWorker(unittest.TestCase):
         self.assertEqual(start_length, end_length)
         del worker
 
+    def test__add_to_bulk_unchanged_content(self):
+        content_hash_cache = ContentHashCache(10)
+        date_modified_cache = DateModifiedCache(1)
+        worker = BasicResourceItemWorker(config_dict=self.config, content_hash_cache=content_hash_cache,
+                                         date_modified_cache=date_modified_cache)
+        resource_item_id = uuid.uuid4().hex
+        local_resource_item = {'_id': resource_item_id, '_rev': '1-' + uuid.uuid4().hex}
+        dates = [datetime.datetime.now(TZ).isoformat() for _ in xrange(4)]
+        content_hash_cache.put({'id': resource_item_id, 'dateModified': dates[0], 'title': 'test',
+                                'doc_type': 'Tender'})
+
+        # Same content is skipped
+        worker._add_to_bulk(local_resource_item, {'id': resource_item_id, 'dateModified': dates[0], 'title': 'test'}, 1)
+        self.assertEqual(worker.bulk, {})
+        self.assertEqual(date_modified_cache.get(resource_item_id), dates[0])
+        self.assertEqual(content_hash_cache.skipped, 1)
+
+        # New dateModified is saved
+        worker._add_to_bulk(local_resource_item, {'id': resource_item_id, 'dateModified': dates[1], 'title': 'test'}, 1)
+        self.assertIn(resource_item_id, worker.bulk)
+        self.assertEqual(content_hash_cache.skipped, 1)
+        worker.bulk = {}
+
+        # Local doc isn't needed, cache has only saved documents
+        worker._add_to_bulk(None, {'id': resource_item_id, 'dateModified': dates[0], 'title': 'test'}, 1)
+        self.assertEqual(worker.bulk, {})
+        self.assertEqual(content_hash_cache.skipped, 2)
+
+        # Changed content is saved
+        worker._add_to_bulk(local_resource_item, {'id': resource_item_id, 'dateModified': dates[3], 'title': 'new'}, 1)
+        self.assertIn(resource_item_id, worker.bulk)
+        self.assertEqual(content_hash_cache.skipped, 2)
+
+        # Saved documents update content hash cache
+        worker.db = MagicMock()
+        worker.db.save_bulk.return_value = [(True, resource_item_id, '2-' + uuid.uuid4().hex)]
+        worker._flush_bulk(worker.bulk, {resource_item_id: 1})
+        self.assertTrue(content_hash_cache.is_unchanged(worker.bulk[resource_item_id]))
+
+    def test__flush_bulk_refresh_revisions(self):
+        worker = BasicResourceItemWorker(config_dict=self.config, db=MagicMock())
+        stored_id, deleted_id = uuid.uuid4().hex, uuid.uuid4().hex
+        date_modified = datetime.datetime.now(TZ).isoformat()
+        bulk = {
+            stored_id: {'id': stored_id, '_id': stored_id, '_rev': '1-prefetched', 'dateModified': date_modified},
+            deleted_id: {'id': deleted_id, '_id': deleted_id, '_rev': '1-prefetched', 'dateModified': date_modified}
+        }
+        # Stored document was saved by other bulk after prefetch, other one is deleted
+        worker.db.get_docs_meta.return_value = {stored_id: {'_id': stored_id, '_rev': '2-saved'}}
+        worker.db.save_bulk.return_value = [(True, stored_id, '3-new'), (True, deleted_id, '1-new')]
+        worker._flush_bulk(bulk, {stored_id: 1, deleted_id: 1})
+        worker.db.get_docs_meta.assert_called_once_with(bulk.keys())
+        saved = worker.db.save_bulk.call_args[0][0]
+        self.assertEqual(saved[stored_id]['_rev'], '2-saved')
+        self.assertNotIn('_rev', saved[deleted_id])
+        self.assertEqual(saved[deleted_id]['_id'], deleted_id)
+
+    def test__flush_bulk_ack(self):
+        queue = MagicMock(spec=PersistentPriorityQueue)
+        retry_queue = MagicMock(spec=PersistentPriorityQueue)
+        worker = BasicResourceItemWorker(config_dict=self.config, db=MagicMock(), resource_items_queue=queue,
+                                         retry_resource_items_queue=retry_queue)
+        worker.add_to_retry_queue = MagicMock()
+        date_modified = datetime.datetime.now(TZ).isoformat()
+        ids = [uuid.uuid4().hex for _ in range(3)]
+        bulk = {doc_id: {'id': doc_id, 'dateModified': date_modified} for doc_id in ids}
+        worker.db.get_docs_meta.return_value = {}
+        worker.db.save_bulk.return_value = [
+            (True, ids[0], '1-new'),
+            (False, ids[1], Exception('New doc with oldest dateModified.')),
+            (False, ids[2], Exception('Conflict'))
+        ]
+        worker._flush_bulk(bulk, {doc_id: 1 for doc_id in ids}, {doc_id: 7 for doc_id in ids})
+        # Entries of failed document are kept until retry is done
+        for q in (queue, retry_queue):
+            self.assertEqual(q.ack.call_args_list, [call(ids[0], 7), call(ids[1], 7)])
+        worker.add_to_retry_queue.assert_called_once_with(ids[2], priority=1, error='Conflict')
+
+    def test__run_return_prefetched_ack(self):
+        queue = MagicMock(spec=PersistentPriorityQueue)
+        worker = BasicResourceItemWorker(config_dict=self.config, resource_items_queue=queue)
+        resource_item_id = uuid.uuid4().hex
+        worker.prefetched.append((1, resource_item_id, None))
+        worker.exit = True
+        worker._run()
+        # Entry is put back to queue and taken one is acknowledged
+        queue.put.assert_called_once_with((1, resource_item_id))
+        queue.ack_entry.assert_called_once_with((1, resource_item_id))
+
+    def test__run_exit_save_bulk(self):
+        worker = BasicResourceItemWorker(config_dict=self.config, db=MagicMock())
+        worker._flush_bulk = MagicMock()
+        doc_id = uuid.uuid4().hex
+        worker.bulk[doc_id] = {'id': doc_id, 'dateModified': '1'}
+        worker.priority_cache[doc_id] = 1
+        worker.exit = True
+        worker._run()
+        worker._flush_bulk.assert_called_once_with({doc_id: {'id': doc_id, 'dateModified': '1'}}, {doc_id: 1}, {})
+        self.assertEqual(worker.bulk, {})
+
     def test__save_bulk_docs(self):
         self.worker_config['bulk_save_limit'] = 3
-        retry_queue = PriorityQueue()
+        retry_queue = DedupPriorityQueue()
         worker = BasicResourceItemWorker(config_dict=self.config, retry_resource_items_queue=retry_queue)
         doc_id_1 = uuid.uuid4().hex
         doc_id_2 = uuid.uuid4().hex
@@ -377,7 +631,10 @@ class TestResourceItemWorker(unittest.TestCase):
 
         # Test success response from couchdb
         worker._save_bulk_docs()
-        sleep(0.1)
+        # Bulk is swapped at once and saved by flush greenlet
+        self.assertEqual(len(worker.bulk), 0)
+        self.assertEqual(len(worker.flushes), 1)
+        worker.flushes.join()
         self.assertEqual(len(worker.bulk), 0)
         self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
 
@@ -394,10 +651,85 @@ class TestResourceItemWorker(unittest.TestCase):
         worker.priority_cache[doc_id_3] = 1
         worker.priority_cache[doc_id_4] = 1
         worker._save_bulk_docs()
-        sleep(0.2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 5)
+        worker.flushes.join()
+        # doc_id_4 already in retry queue after previous save
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 4)
         self.assertEqual(len(worker.bulk), 0)
 
+    def test__save_bulk_docs_fill_date_modified_cache(self):
+        cache = DateModifiedCache(1)
+        worker = BasicResourceItemWorker(config_dict=self.config, retry_resource_items_queue=DedupPriorityQueue(),
+                                         date_modified_cache=cache)
+        worker.bulk_save_limit = 0
+        doc_id_1 = uuid.uuid4().hex
+        doc_id_2 = uuid.uuid4().hex
+        doc_id_3 = uuid.uuid4().hex
+        date_modified = datetime.datetime.utcnow().isoformat()
+        worker.bulk = {
+            doc_id_1: {'id': doc_id_1, 'dateModified': date_modified},
+            doc_id_2: {'id': doc_id_2, 'dateModified': date_modified},
+            doc_id_3: {'id': doc_id_3, 'dateModified': date_modified}
+        }
+        worker.priority_cache = {doc_id_1: 1, doc_id_2: 1, doc_id_3: 1}
+        worker.db = MagicMock()
+        worker.db.save_bulk.return_value = [
+            (True, doc_id_1, 'created'),
+            (True, doc_id_2, 'skipped'),
+            (False, doc_id_3, Exception(u'Document update conflict.'))
+        ]
+        worker._save_bulk_docs()
+        worker.flushes.join()
+        self.assertEqual(cache.get(doc_id_1), date_modified)
+        self.assertNotIn(doc_id_2, cache)
+        self.assertNotIn(doc_id_3, cache)
+
+    def test__save_bulk_docs_outstanding_flushes(self):
+        config = deepcopy(self.config)
+        config['worker_config']['max_outstanding_flushes'] = 2
+        worker = BasicResourceItemWorker(config_dict=config, retry_resource_items_queue=DedupPriorityQueue())
+        worker.bulk_save_limit = 0
+        date_modified = datetime.datetime.utcnow().isoformat()
+        saving = []
+
+        def save_bulk(bulk):
+            saving.append(bulk.keys()[0])
+            sleep(0.1)
+            return [(False, doc_id, Exception(u'Document update conflict.')) for doc_id in bulk]
+
+        worker.db = MagicMock()
+        worker.db.save_bulk.side_effect = save_bulk
+        ids = [uuid.uuid4().hex for _ in xrange(3)]
+        for i, doc_id in enumerate(ids[:2]):
+            worker.bulk = {doc_id: {'id': doc_id, 'dateModified': date_modified}}
+            worker.priority_cache = {doc_id: i}
+            worker._save_bulk_docs()
+        self.assertEqual(len(worker.flushes), 2)
+        self.assertEqual(saving, [])
+
+        # Third flush waits until one of outstanding flushes is finished
+        worker.bulk = {ids[2]: {'id': ids[2], 'dateModified': date_modified}}
+        worker.priority_cache = {ids[2]: 2}
+        worker._save_bulk_docs()
+        self.assertEqual(saving, ids[:2])
+        worker.flushes.join()
+        self.assertEqual(saving, ids)
+
+        # Failed documents of every flush go to retry queue with own priority
+        retried = sorted(worker.retry_resource_items_queue.queue)
+        self.assertEqual(retried, [(1, ids[0]), (2, ids[1]), (3, ids[2])])
+
+    def test__save_bulk_docs_inline(self):
+        config = deepcopy(self.config)
+        config['worker_config']['max_outstanding_flushes'] = 0
+        worker = BasicResourceItemWorker(config_dict=config, retry_resource_items_queue=DedupPriorityQueue())
+        worker.bulk_save_limit = 0
+        worker.db = MagicMock()
+        worker.db.save_bulk.return_value = []
+        worker.bulk = {'id': {'id': 'id', 'dateModified': datetime.datetime.utcnow().isoformat()}}
+        worker._save_bulk_docs()
+        self.assertEqual(worker.db.save_bulk.call_count, 1)
+        self.assertEqual(len(worker.flushes), 0)
+
     def test_shutdown(self):
         worker = BasicResourceItemWorker(
             'api_clients_queue', 'resource_items_queue', 'db',
@@ -412,7 +744,7 @@ class TestResourceItemWorker(unittest.TestCase):
     @patch('openprocurement.bridge.basic.workers.logger')
     def test__run(self, mocked_logger, mock_get_from_public, mocked_save_bulk):
         self.queue = Queue()
-        self.retry_queue = Queue()
+        self.retry_queue = DedupPriorityQueue()
         self.api_clients_queue = Queue()
         queue_item = (1, uuid.uuid4().hex)
         doc = {
@@ -430,16 +762,18 @@ class TestResourceItemWorker(unittest.TestCase):
         client.session.headers = {'User-Agent': 'Test-Agent'}
         self.api_clients_info = {
             api_client_dict['id']: {
-                'drop_cookies': False, 'request_durations': []
+                'drop_cookies': False, 'request_durations': RequestDurations()
             }
         }
         self.db = MagicMock()
+        config = deepcopy(self.config)
+        config['worker_config']['local_docs_lookup'] = 'full'
         worker = BasicResourceItemWorker(
             api_clients_queue=self.api_clients_queue,
             resource_items_queue=self.queue,
             retry_resource_items_queue=self.retry_queue,
             db=self.db, api_clients_info=self.api_clients_info,
-            config_dict=self.config
+            config_dict=config
         )
         worker.exit = MagicMock()
         worker.exit.__nonzero__.side_effect = [False, True]
@@ -496,7 +830,7 @@ class TestResourceItemWorker(unittest.TestCase):
         self.api_clients_queue.put(api_client_dict)
         self.queue.put(queue_item)
         mock_get_from_public.return_value = doc
-        self.db.get_doc.side_effect = [Exception('Database Error')]
+        self.db.get_docs.side_effect = [Exception('Database Error')]
         worker.exit.__nonzero__.side_effect = [False, True]
         worker._run()
         self.assertEqual(
@@ -522,7 +856,7 @@ class TestResourceItemWorker(unittest.TestCase):
         self.api_clients_queue.put(api_client_dict)
         self.queue.put(queue_item)
         mock_get_from_public.return_value = None
-        self.db.get_doc.side_effect = [doc]
+        self.db.get_docs.side_effect = [{doc['id']: {'_id': doc['id'], '_rev': doc['_rev']}}]
         worker.exit.__nonzero__.side_effect = [False, True]
         worker._run()
         self.assertEqual(
@@ -539,15 +873,205 @@ class TestResourceItemWorker(unittest.TestCase):
                 call('Get tender {} from main queue.'.format(doc['id'])),
             ]
         )
-        self.assertEqual(mocked_save_bulk.call_count, 1)
+        # Rest of bulk is saved on each exit
+        self.assertEqual(mocked_save_bulk.call_args_list.count(call()), 1)
+        self.assertEqual(mocked_save_bulk.call_args_list.count(call(force=True)), 5)
+
+    @patch('openprocurement.bridge.basic.workers.BasicResourceItemWorker._save_bulk_docs')
+    @patch('openprocurement.bridge.basic.workers.BasicResourceItemWorker._get_resource_item_from_public')
+    def test__run_prefetch_local_docs(self, mock_get_from_public, mocked_save_bulk):
+        queue = DedupPriorityQueue()
+        api_clients_queue = Queue()
+        api_client_dict = {'id': uuid.uuid4().hex, 'client': MagicMock(), 'request_interval': 0}
+        api_client_dict['client'].session.headers = {'User-Agent': 'Test-Agent'}
+        api_clients_info = {api_client_dict['id']: {'drop_cookies': False, 'request_durations': RequestDurations()}}
+        api_clients_queue.put(api_client_dict)
+        ids = [uuid.uuid4().hex for _ in xrange(3)]
+        for i, resource_item_id in enumerate(ids):
+            queue.put((i, resource_item_id))
+        local_doc = {'_id': ids[0], '_rev': '1-{}'.format(uuid.uuid4().hex)}
+        db = MagicMock()
+        db.get_docs.return_value = {ids[0]: local_doc}
+        config = deepcopy(self.config)
+        config['worker_config'].update({'prefetch_size': 2, 'local_docs_lookup': 'full'})
+        worker = BasicResourceItemWorker(api_clients_queue=api_clients_queue, resource_items_queue=queue,
+                                         db=db, config_dict=config, api_clients_info=api_clients_info)
+        self.assertEqual(worker.prefetch_size, 2)
+        worker._add_to_bulk = MagicMock()
+        mock_get_from_public.side_effect = lambda client, priority, resource_item_id, headers=None, mark=None: (
+            api_clients_queue.put(client) or {'id': resource_item_id})
+
+        worker.exit = MagicMock()
+        worker.exit.__nonzero__.side_effect = [False, False, True]
+        worker._run()
+        # Single storage request for two items
+        db.get_docs.assert_called_once_with(ids[:2])
+        self.assertEqual(db.get_docs_meta.call_count, 0)
+        self.assertEqual([args[:3] for args, _ in worker._add_to_bulk.call_args_list],
+                         [(local_doc, {'id': ids[0]}, 0), (None, {'id': ids[1]}, 1)])
+        self.assertEqual(queue.qsize(), 1)
+
+        # Not processed prefetched items returned to queue on exit
+        worker.exit.__nonzero__.side_effect = [False, True]
+        db.get_docs.return_value = {}
+        last_item = (3, uuid.uuid4().hex)
+        queue.put(last_item)
+        worker._run()
+        self.assertEqual(worker._add_to_bulk.call_args_list[-1][0][:3], (None, {'id': ids[2]}, 2))
+        self.assertEqual(len(worker.prefetched), 0)
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(queue.get(), last_item)
+
+    @patch('openprocurement.bridge.basic.workers.BasicResourceItemWorker._save_bulk_docs')
+    @patch('openprocurement.bridge.basic.workers.BasicResourceItemWorker._get_resource_item_from_public')
+    def test__run_with_writer(self, mock_get_from_public, mocked_save_bulk):
+        queue = DedupPriorityQueue()
+        api_clients_queue = Queue()
+        api_client_dict = {'id': uuid.uuid4().hex, 'client': MagicMock(), 'request_interval': 0}
+        api_client_dict['client'].session.headers = {'User-Agent': 'Test-Agent'}
+        api_clients_queue.put(api_client_dict)
+        resource_item_id = uuid.uuid4().hex
+        queue.put((1, resource_item_id))
+        db = MagicMock()
+        writer = MagicMock()
+        worker = BasicResourceItemWorker(api_clients_queue=api_clients_queue, resource_items_queue=queue, db=db,
+                                         config_dict=self.config, writer=writer,
+                                         api_clients_info={api_client_dict['id']: {'drop_cookies': False}})
+        mock_get_from_public.return_value = {'id': resource_item_id, 'dateModified': '1'}
+        worker.exit = MagicMock()
+        worker.exit.__nonzero__.side_effect = [False, True]
+        worker._run()
+        self.assertEqual(writer.put.call_count, 1)
+        # Revision is read by writer right before save
+        self.assertEqual(writer.put.call_args[0][:3], (
+            {'id': resource_item_id, '_id': resource_item_id, 'dateModified': '1', 'doc_type': 'Tender'},
+            1, worker.add_to_retry_queue))
+        self.assertEqual((db.get_docs_meta.call_count, db.get_docs.call_count), (0, 0))
+        self.assertEqual(worker.bulk, {})
+        self.assertEqual(mocked_save_bulk.call_args_list, [call(force=True)])
+
+    @patch('openprocurement.bridge.basic.workers.BasicResourceItemWorker._get_resource_item_from_public')
+    def test__run_in_flight_fetches(self, mock_get_from_public):
+        queue = DedupPriorityQueue()
+        api_clients_queue = Queue()
+        api_client_dict = {'id': uuid.uuid4().hex, 'client': MagicMock(), 'request_interval': 0}
+        api_clients_queue.put(api_client_dict)
+        resource_item_id = uuid.uuid4().hex
+        queue.put((1, resource_item_id))
+        db = MagicMock()
+        db.get_docs_meta.return_value = {}
+        writer = MagicMock()
+        registry = InFlightRegistry()
+        registry.acquire(resource_item_id)
+        worker = BasicResourceItemWorker(api_clients_queue=api_clients_queue, resource_items_queue=queue, db=db,
+                                         config_dict=self.config, writer=writer, in_flight_fetches=registry,
+                                         api_clients_info={api_client_dict['id']: {'drop_cookies': False}})
+        worker.exit = MagicMock()
+
+        # Other worker fetches same item, it is dropped
+        worker.exit.__nonzero__.side_effect = [False, True]
+        worker._run()
+        self.assertEqual(mock_get_from_public.call_count, 0)
+        self.assertEqual(writer.put.call_count, 0)
+        self.assertEqual(api_clients_queue.qsize(), 1)
+        self.assertEqual(registry.duplicates, 1)
+
+        # Fetch is registered until document is received
+        registry.release(resource_item_id)
+        queue.put((1, resource_item_id))
+        mock_get_from_public.side_effect = lambda client, priority, resource_item_id, headers=None, mark=None: (
+            self.assertIn(resource_item_id, registry) or {'id': resource_item_id, 'dateModified': '1'})
+        worker.exit.__nonzero__.side_effect = [False, True]
+        worker._run()
+        self.assertEqual(mock_get_from_public.call_count, 1)
+        self.assertEqual(writer.put.call_count, 1)
+        self.assertNotIn(resource_item_id, registry)
+
+    def test__get_feed_document(self):
+        config = deepcopy(self.config)
+        config['worker_config']['feed_required_fields'] = ['status']
+        worker = BasicResourceItemWorker(config_dict=config)
+        feed_item = {'id': uuid.uuid4().hex, 'dateModified': '1', 'status': 'active'}
+        # Feed-only mode is off
+        self.assertIsNone(worker._get_feed_document(feed_item))
+
+        worker.feed_only = True
+        self.assertIsNone(worker._get_feed_document(feed_item['id']))
+        document = worker._get_feed_document(feed_item)
+        self.assertEqual(document, feed_item)
+        self.assertIsNot(document, feed_item)
+        self.assertEqual((worker.feed_documents, worker.feed_fallbacks), (1, 0))
+
+        # Fallback to public API
+        del feed_item['status']
+        self.assertIsNone(worker._get_feed_document(feed_item))
+        self.assertEqual((worker.feed_documents, worker.feed_fallbacks), (1, 1))
+
+    def test_feed_only_required_fields(self):
+        # Default config has no required fields, so feed items are just id and dateModified stubs
+        config = deepcopy(self.config)
+        config['worker_config']['feed_only'] = True
+        with self.assertRaises(DataBridgeConfigError):
+            BasicResourceItemWorker(config_dict=config)
+        config['worker_config']['feed_required_fields'] = []
+        with self.assertRaises(DataBridgeConfigError):
+            BasicResourceItemWorker(config_dict=config)
+        config['worker_config']['feed_required_fields'] = ['status']
+        worker = BasicResourceItemWorker(config_dict=config)
+        self.assertEqual(worker.feed_required_fields, {'id', 'dateModified', 'status'})
+
+    @patch('openprocurement.bridge.basic.workers.BasicResourceItemWorker._get_resource_item_from_public')
+    def test__run_feed_only(self, mock_get_from_public):
+        queue = DedupPriorityQueue()
+        api_clients_queue = Queue()
+        api_client_dict = {'id': uuid.uuid4().hex, 'client': MagicMock(), 'request_interval': 0}
+        api_clients_queue.put(api_client_dict)
+        feed_item = {'id': uuid.uuid4().hex, 'dateModified': '1', 'status': 'active'}
+        queue.put((1, feed_item))
+        db = MagicMock()
+        db.get_docs_meta.return_value = {}
+        writer = MagicMock()
+        config = deepcopy(self.config)
+        config['worker_config'].update({'feed_only': True, 'feed_required_fields': ['status']})
+        worker = BasicResourceItemWorker(api_clients_queue=api_clients_queue, resource_items_queue=queue, db=db,
+                                         config_dict=config, writer=writer,
+                                         api_clients_info={api_client_dict['id']: {'drop_cookies': False}})
+        worker.exit = MagicMock()
+        worker.exit.__nonzero__.side_effect = [False, True]
+        worker._run()
+        self.assertEqual(db.get_docs_meta.call_count, 0)
+        self.assertEqual(mock_get_from_public.call_count, 0)
+        self.assertEqual(writer.put.call_count, 1)
+        self.assertEqual(writer.put.call_args[0][:3], (
+            {'id': feed_item['id'], '_id': feed_item['id'], 'dateModified': '1', 'status': 'active',
+             'doc_type': 'Tender'}, 1, worker.add_to_retry_queue))
+        self.assertEqual(api_clients_queue.qsize(), 1)
+
+    def test__get_local_resource_items(self):
+        db = MagicMock()
+        db.get_docs.return_value = {'id_1': {'_id': 'id_1', '_rev': '1-a', 'title': 'Large document'}}
+        worker = BasicResourceItemWorker(db=db, config_dict=self.config)
+        self.assertEqual((worker.local_docs_lookup, worker.prefetch_size), ('meta', 1))
+        # Revisions are read right before save
+        self.assertEqual(worker._get_local_resource_items(['id_1', 'id_2']), {})
+        self.assertEqual(db.get_docs_meta.call_count, 0)
+
+        worker.local_docs_lookup = 'full'
+        self.assertEqual(worker._get_local_resource_items(['id_1', 'id_2']), db.get_docs.return_value)
+        db.get_docs.assert_called_once_with(['id_1', 'id_2'])
+
+        # Only service keys of full local doc are copied to public doc
+        worker._add_to_bulk(db.get_docs.return_value['id_1'], {'id': 'id_1', 'dateModified': '1'}, 1)
+        self.assertEqual(worker.bulk['id_1'], {'id': 'id_1', '_id': 'id_1', '_rev': '1-a', 'dateModified': '1',
+                                               'doc_type': 'Tender'})
 
 
 class TestResourceAgreementWorker(unittest.TestCase):
     worker_config = {
         'worker_config': {
             'worker_type': 'basic_couchdb',
-            'client_inc_step_timeout': 0.1,
-            'client_dec_step_timeout': 0.02,
+            'client_rate_decrease': 0.5,
+            'client_rate_increase': 1,
             'drop_threshold_client_cookies': 1.5,
             'worker_sleep': 5,
             'retry_default_timeout': 0.5,
@@ -604,8 +1128,8 @@ class TestResourceAgreementWorker(unittest.TestCase):
 
     def tearDown(self):
         self.worker_config['resource'] = 'tenders'
-        self.worker_config['client_inc_step_timeout'] = 0.1
-        self.worker_config['client_dec_step_timeout'] = 0.02
+        self.worker_config['client_rate_decrease'] = 0.5
+        self.worker_config['client_rate_increase'] = 1
         self.worker_config['drop_threshold_client_cookies'] = 1.5
         self.worker_config['worker_sleep'] = 0.03
         self.worker_config['retry_default_timeout'] = 0.01
@@ -626,7 +1150,7 @@ class TestResourceAgreementWorker(unittest.TestCase):
 
     @patch('openprocurement.bridge.basic.workers.logger')
     def test_add_to_retry_queue(self, mocked_logger):
-        retry_items_queue = PriorityQueue()
+        retry_items_queue = DedupPriorityQueue()
         worker = AgreementWorker(config_dict=self.worker_config, retry_resource_items_queue=retry_items_queue)
         resource_item = {'id': uuid.uuid4().hex}
         priority = 1000
@@ -662,6 +1186,33 @@ class TestResourceAgreementWorker(unittest.TestCase):
         )
         del worker
 
+    def test_add_to_retry_queue_dead_letters(self):
+        dead_letters = MagicMock()
+        worker = AgreementWorker(config_dict=self.worker_config, retry_resource_items_queue=DedupPriorityQueue(),
+                                 dead_letters=dead_letters)
+        resource_item = {'id': uuid.uuid4().hex}
+        worker.add_to_retry_queue(resource_item, priority=1003, error='Not found', status_code=404)
+        dead_letters.add.assert_called_once_with((1003, resource_item), error='Not found', status_code=404)
+        del worker
+
+    def test_add_to_retry_queue_with_scheduler(self):
+        retry_items_queue = DedupPriorityQueue()
+        scheduler = RetryScheduler(retry_items_queue, jitter=0)
+        worker = AgreementWorker(config_dict=self.worker_config, retry_resource_items_queue=retry_items_queue,
+                                 retry_scheduler=scheduler)
+        resource_item = {'id': uuid.uuid4().hex}
+
+        worker.add_to_retry_queue(resource_item, priority=1000)
+        self.assertEqual(retry_items_queue.get(), (1001, resource_item))
+
+        worker.add_to_retry_queue(resource_item, priority=1001)
+        self.assertEqual(retry_items_queue.qsize(), 0)
+        self.assertEqual(scheduler.heap[0][2], (1002, resource_item))
+
+        worker.add_to_retry_queue(resource_item, priority=1002)
+        self.assertEqual(len(scheduler), 1)
+        del worker
+
     def test__get_api_client_dict(self):
         api_clients_queue = Queue()
         client = MagicMock()
@@ -686,9 +1237,11 @@ class TestResourceAgreementWorker(unittest.TestCase):
             client_dict2['id']: {
                 'drop_cookies': True,
                 'not_actual_count': 3,
-                'request_interval': 2
+                'request_interval': 2,
+                'request_durations': RequestDurations()
             }
         }
+        api_clients_info[client_dict2['id']]['request_durations'].add(1)
 
         # Success test
         worker = AgreementWorker(api_clients_queue=api_clients_queue, config_dict=self.worker_config,
@@ -701,6 +1254,7 @@ class TestResourceAgreementWorker(unittest.TestCase):
         api_client = worker._get_api_client_dict()
         self.assertEqual(api_client['not_actual_count'], 0)
         self.assertEqual(api_client['request_interval'], 0)
+        self.assertEqual(len(api_clients_info[client_dict2['id']]['request_durations']), 0)
 
         # Empty queue test
         api_client = worker._get_api_client_dict()
@@ -726,7 +1280,7 @@ class TestResourceAgreementWorker(unittest.TestCase):
         del worker
 
     def test__get_resource_item_from_queue(self):
-        items_queue = PriorityQueue()
+        items_queue = DedupPriorityQueue()
         item = (1, {'id': uuid.uuid4().hex})
         items_queue.put(item)
 
@@ -753,11 +1307,12 @@ class TestResourceAgreementWorker(unittest.TestCase):
         client_dict = {
             'id': uuid.uuid4().hex,
             'request_interval': 0.02,
+            'limiter': RateLimiter(),
             'client': mock_api_client
         }
         api_clients_queue.put(client_dict)
-        api_clients_info = {client_dict['id']: {'drop_cookies': False, 'request_durations': {}}}
-        retry_queue = PriorityQueue()
+        api_clients_info = {client_dict['id']: {'drop_cookies': False, 'request_durations': RequestDurations()}}
+        retry_queue = DedupPriorityQueue()
         return_dict = {
             'data': {
                 'id': resource_item_id,
@@ -787,6 +1342,7 @@ class TestResourceAgreementWorker(unittest.TestCase):
         self.assertEqual(public_item, None)
         sleep(worker.config['retry_default_timeout'] * 1)
         self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
 
         # RequestFailed status_code=429
@@ -797,22 +1353,24 @@ class TestResourceAgreementWorker(unittest.TestCase):
         public_item = worker._get_resource_item_from_public(api_client, priority, resource_item)
         self.assertEqual(public_item, None)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 2)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         api_client = worker._get_api_client_dict()
         self.assertEqual(worker.api_clients_queue.qsize(), 0)
-        self.assertEqual(api_client['request_interval'],
-                         worker.config['client_inc_step_timeout'])
+        # Rate is halved
+        self.assertEqual(api_client['request_interval'], 0.02)
 
         # RequestFailed status_code=429 with drop cookies
-        api_client['request_interval'] = 2
+        api_client['limiter'].rate = 0.4
         public_item = worker._get_resource_item_from_public(api_client, priority, resource_item)
         sleep(api_client['request_interval'])
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         self.assertEqual(public_item, None)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 3)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
 
         # RequestFailed with status_code not equal 429
         mock_api_client.get_resource_item.side_effect = RequestFailed(
@@ -824,7 +1382,8 @@ class TestResourceAgreementWorker(unittest.TestCase):
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 4)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
 
         # ResourceNotFound
         mock_api_client.get_resource_item.side_effect = RNF(munchify({'status_code': 404}))
@@ -835,7 +1394,8 @@ class TestResourceAgreementWorker(unittest.TestCase):
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 5)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
 
         # ResourceGone
         mock_api_client.get_resource_item.side_effect = ResourceGone(munchify({'status_code': 410}))
@@ -846,7 +1406,7 @@ class TestResourceAgreementWorker(unittest.TestCase):
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 5)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 0)
 
         # Exception
         api_client = worker._get_api_client_dict()
@@ -855,7 +1415,8 @@ class TestResourceAgreementWorker(unittest.TestCase):
         self.assertEqual(public_item, None)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 6)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        worker.retry_resource_items_queue.get()
 
         del worker
 
@@ -878,12 +1439,50 @@ class TestResourceAgreementWorker(unittest.TestCase):
         worker_thread.shutdown()
         sleep(3)
 
+    def test__schedule_processing(self):
+        config = deepcopy(self.worker_config)
+        config['worker_config']['handlers_window'] = 2
+        worker = AgreementWorker(config_dict=config, retry_resource_items_queue=DedupPriorityQueue())
+        events = []
+
+        def process_resource(resource):
+            events.append(('start', resource['id'], resource['dateModified']))
+            sleep(0.01)
+            events.append(('end', resource['id'], resource['dateModified']))
+        handler = MagicMock()
+        handler.process_resource.side_effect = process_resource
+        ids = [uuid.uuid4().hex for _ in xrange(3)]
+        for resource_id, date_modified in [(ids[0], '1'), (ids[0], '2'), (ids[1], '1'), (ids[2], '1')]:
+            resource = {'id': resource_id, 'dateModified': date_modified}
+            worker._schedule_processing(handler, 1, resource, resource)
+        # Third resource waited for free slot in window
+        self.assertIn(('end', ids[1], '1'), events)
+        self.assertEqual(len(worker.handlers_pool), 2)
+        self.assertEqual(set(worker.handling), {ids[0], ids[2]})
+        worker.handlers_pool.join()
+        self.assertEqual(worker.handling, {})
+
+        # Different resources are processed concurrently, updates of same resource in order
+        self.assertEqual(events[:2], [('start', ids[0], '1'), ('start', ids[1], '1')])
+        first = [event for event in events if event[1] == ids[0]]
+        self.assertEqual(first, [('start', ids[0], '1'), ('end', ids[0], '1'),
+                                 ('start', ids[0], '2'), ('end', ids[0], '2')])
+        self.assertEqual(handler.process_resource.call_count, 4)
+
+        # Failed resource is retried, next update is still processed
+        handler.process_resource.side_effect = [Exception('test'), None]
+        worker._schedule_processing(handler, 1, {'id': ids[0], 'dateModified': '3'}, {})
+        worker._schedule_processing(handler, 1, {'id': ids[0], 'dateModified': '4'}, {})
+        worker.handlers_pool.join()
+        self.assertEqual(handler.process_resource.call_count, 6)
+        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+
     @patch('openprocurement.bridge.basic.workers.handlers_registry')
     @patch('openprocurement.bridge.basic.workers.AgreementWorker._get_resource_item_from_public')
     @patch('openprocurement.bridge.basic.workers.logger')
     def test__run(self, mocked_logger, mock_get_from_public, mock_registry):
         self.queue = Queue()
-        self.retry_queue = Queue()
+        self.retry_queue = DedupPriorityQueue()
         self.api_clients_queue = Queue()
         queue_item = (1, {'id': uuid.uuid4().hex, 'procurementMethodType': 'closeFrameworkAgreementUA'})
         doc = {
@@ -900,7 +1499,7 @@ class TestResourceAgreementWorker(unittest.TestCase):
         }
         client.session.headers = {'User-Agent': 'Test-Agent'}
         self.api_clients_info = {
-            api_client_dict['id']: {'drop_cookies': False, 'request_durations': []}
+            api_client_dict['id']: {'drop_cookies': False, 'request_durations': RequestDurations()}
         }
         self.db = MagicMock()
         worker = AgreementWorker(
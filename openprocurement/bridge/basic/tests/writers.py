@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+import unittest
+from copy import deepcopy
+from datetime import datetime
+from uuid import uuid4
+
+from gevent import sleep
+from mock import MagicMock, call, patch
+
+from openprocurement.bridge.basic.caches import ContentHashCache, DateModifiedCache
+from openprocurement.bridge.basic.tests.base import TEST_CONFIG
+from openprocurement.bridge.basic.writers import BulkWriter
+
+
+class TestBulkWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.config = deepcopy(TEST_CONFIG['main'])
+        self.config['worker_config'].update({'bulk_save_limit': 3, 'bulk_save_interval': 1,
+                                             'writers_min': 1, 'writers_max': 2, 'writer_latency_target': 0.5})
+        self.db = MagicMock()
+        self.retry = MagicMock()
+        self.date_modified = datetime.now().isoformat()
+
+    def doc(self, doc_id=None, date_modified=None):
+        return {'id': doc_id or uuid4().hex, 'dateModified': date_modified or self.date_modified}
+
+    def test_init(self):
+        writer = BulkWriter(self.db, self.config)
+        self.assertEqual((writer.bulk_save_limit, writer.bulk_save_interval), (3, 1))
+        self.assertEqual(writer.bulk_save_bytes, 10 * 1024 * 1024)
+        self.assertEqual((writer.writers, writer.writers_min, writer.writers_max), (1, 1, 2))
+        self.assertIsNone(writer.dispatcher)
+
+    def test_put_merge(self):
+        writer = BulkWriter(self.db, self.config)
+        doc_id = uuid4().hex
+        writer.put(self.doc(doc_id, '2018-01-02'), 1000, self.retry)
+        self.assertTrue(writer.wakeup.is_set())
+        size = writer.bulk_bytes
+
+        # Older document is ignored, highest priority is kept
+        writer.put(self.doc(doc_id, '2018-01-01'), 1, self.retry)
+        self.assertEqual(writer.bulk[doc_id][:2], (self.doc(doc_id, '2018-01-02'), 1))
+
+        # Newer document replaces previous one
+        writer.put(self.doc(doc_id, '2018-01-03'), 1000, self.retry)
+        self.assertEqual(writer.bulk[doc_id][:2], (self.doc(doc_id, '2018-01-03'), 1))
+        self.assertEqual(len(writer.bulk), 1)
+        self.assertEqual(writer.bulk_bytes, size)
+
+    def test_bulk_due(self):
+        writer = BulkWriter(self.db, self.config)
+        writer.put(self.doc(), 1, self.retry)
+        self.assertFalse(writer._bulk_due())
+
+        # By age
+        writer.bulk_start -= 1
+        self.assertTrue(writer._bulk_due())
+
+        # By size
+        writer.bulk_start += 1
+        writer.bulk_save_bytes = writer.bulk_bytes + 1
+        writer.put(self.doc(), 1, self.retry)
+        self.assertTrue(writer._bulk_due())
+
+        # By count
+        writer.bulk_save_bytes = 10 * 1024 * 1024
+        self.assertFalse(writer._bulk_due())
+        writer.put(self.doc(), 1, self.retry)
+        self.assertTrue(writer._bulk_due())
+
+    def test_save(self):
+        cache = DateModifiedCache(1)
+        content_hash_cache = ContentHashCache(10)
+        writer = BulkWriter(self.db, self.config, date_modified_cache=cache, content_hash_cache=content_hash_cache)
+        docs = [self.doc() for _ in xrange(4)]
+        for priority, doc in enumerate(docs):
+            writer.put(doc, priority, self.retry)
+        self.db.save_bulk.return_value = [
+            (True, docs[0]['id'], 'created'),
+            (True, docs[1]['id'], 'skipped'),
+            (False, docs[2]['id'], Exception(u'New doc with oldest dateModified.')),
+            (False, docs[3]['id'], Exception(u'Document update conflict.'))
+        ]
+        writer._dispatch().join()
+        self.assertEqual(writer.bulk, {})
+        self.assertEqual(writer.busy, 0)
+        self.db.save_bulk.assert_called_once_with({doc['id']: doc for doc in docs})
+        self.assertEqual(writer.saved, 2)
+        self.assertIn(docs[0]['id'], cache)
+        self.assertNotIn(docs[1]['id'], cache)
+        self.assertEqual(len(content_hash_cache), 1)
+        self.assertTrue(content_hash_cache.is_unchanged(docs[0]))
+        self.retry.assert_called_once_with(docs[3]['id'], priority=3, error=u'Document update conflict.')
+
+        # Storage error, all documents are retried
+        self.retry.reset_mock()
+        self.db.save_bulk.side_effect = Exception('Storage error')
+        writer.put(docs[0], 1, self.retry)
+        writer.put(docs[1], 2, self.retry)
+        writer._dispatch().join()
+        self.assertEqual(sorted(self.retry.call_args_list),
+                         sorted([call(docs[0]['id'], priority=1, error="Exception('Storage error',)"),
+                                 call(docs[1]['id'], priority=2, error="Exception('Storage error',)")]))
+        self.assertEqual(writer.busy, 0)
+
+    def test_save_refresh_revisions(self):
+        writer = BulkWriter(self.db, self.config)
+        doc = dict(self.doc(), _ver=1)
+        writer.put(doc, 1, self.retry)
+        self.db.get_docs_meta.return_value = {doc['id']: {'_ver': 2}}
+        self.db.save_bulk.return_value = [(True, doc['id'], 'updated')]
+        writer._dispatch().join()
+        self.db.get_docs_meta.assert_called_once_with([doc['id']])
+        self.assertEqual(self.db.save_bulk.call_args[0][0][doc['id']]['_ver'], 2)
+
+    def test_save_ack(self):
+        writer = BulkWriter(self.db, self.config)
+        saved, oldest, failed = self.doc(), self.doc(), self.doc()
+        acks = MagicMock(), MagicMock(), MagicMock()
+        writer.put(self.doc(saved['id'], '2018-01-01'), 1, self.retry, acks[0])
+        writer.put(saved, 1, self.retry, acks[1])
+        writer.put(oldest, 1, self.retry, acks[2])
+        writer.put(failed, 1, self.retry, acks[2])
+        self.db.save_bulk.return_value = [(True, saved['id'], '2-a'),
+                                          (False, oldest['id'], Exception('New doc with oldest dateModified.')),
+                                          (False, failed['id'], Exception('Conflict'))]
+        writer._dispatch().join()
+        # Acks of replaced document are called too, failed document isn't acknowledged
+        acks[0].assert_called_once_with(saved['id'])
+        acks[1].assert_called_once_with(saved['id'])
+        acks[2].assert_called_once_with(oldest['id'])
+        self.retry.assert_called_once_with(failed['id'], priority=1, error='Conflict')
+
+    def test_flush(self):
+        writer = BulkWriter(self.db, self.config)
+        writer.flush()
+        docs = [self.doc() for _ in range(2)]
+        for doc in docs:
+            writer.put(doc, 1, self.retry)
+        self.db.save_bulk.return_value = [(True, doc['id'], '1-a') for doc in docs]
+        # Bulk isn't due yet, but it is saved
+        writer.flush()
+        self.assertEqual(self.db.save_bulk.call_count, 1)
+        self.assertEqual((writer.bulk, writer.busy, writer.saved), ({}, 0, 2))
+
+    @patch('openprocurement.bridge.basic.writers.logger')
+    def test_writers_autoscale(self, logger):
+        writer = BulkWriter(self.db, self.config)
+
+        # All writers busy and storage is fast, add writer
+        writer.busy = 1
+        writer.latency = 0.1
+        writer._wait_writer()
+        self.assertEqual(writer.writers, 2)
+        logger.info.assert_called_once_with('Writers count increased to 2', extra={'WRITERS': 2})
+
+        # Storage is slow, remove writer
+        writer._update_latency(2)
+        self.assertEqual(round(writer.latency, 2), 0.67)
+        self.assertEqual(writer.writers, 1)
+        writer._update_latency(2)
+        self.assertEqual(writer.writers, 1)
+
+        # Slow storage doesn't get more writers, dispatcher waits for free one
+        writer.busy = 1
+        writer.writer_done.set()
+        with patch.object(writer, 'writer_done') as writer_done:
+            writer_done.wait.side_effect = lambda: setattr(writer, 'busy', 0)
+            writer._wait_writer()
+        self.assertEqual(writer_done.wait.call_count, 1)
+        self.assertEqual(writer.writers, 1)
+        self.assertEqual(writer.stats(), {'writers': 1, 'busy': 0, 'pending': 0,
+                                          'latency': round(writer.latency * 1000, 3), 'saved': 0})
+
+    @patch('openprocurement.bridge.basic.writers.INFINITY')
+    def test_run(self, infinity):
+        writer = BulkWriter(self.db, self.config)
+        self.db.save_bulk.return_value = []
+        docs = [self.doc() for _ in xrange(3)]
+        for doc in docs:
+            writer.put(doc, 1, self.retry)
+        infinity.__nonzero__.side_effect = [True, False]
+        writer._run()
+        sleep(0)
+        self.db.save_bulk.assert_called_once_with({doc['id']: doc for doc in docs})
+
+        # Not full bulk is saved after bulk_save_interval
+        writer.bulk_save_interval = 0.01
+        writer.put(docs[0], 1, self.retry)
+        infinity.__nonzero__.side_effect = [True, True, False]
+        writer._run()
+        sleep(0)
+        self.assertEqual(self.db.save_bulk.call_count, 2)
+        self.assertEqual(writer.bulk, {})
+
+    def test_start(self):
+        writer = BulkWriter(self.db, self.config)
+        dispatcher = writer.start()
+        self.assertIs(writer.dispatcher, dispatcher)
+        dispatcher.kill()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestBulkWriter))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
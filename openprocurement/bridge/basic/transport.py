@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from requests.adapters import HTTPAdapter
+
+
+# Kept pools of different hosts, bridge talks to single API host
+POOL_CONNECTIONS = 10
+
+
+class SharedHTTPAdapter(HTTPAdapter):
+    """
+    `requests` transport adapter mounted to sessions of all API clients, so
+    keep-alive connections to API are reused by any client instead of each
+    client opening its own ones. Cookies are kept by sessions, so clients
+    cookie jars stay separate.
+
+    :param int pool_maxsize: Kept connections per host, workers_max + retry_workers_max
+    """
+
+    def __init__(self, pool_maxsize):
+        HTTPAdapter.__init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize)
+
+    def mount_to(self, session):
+        """ Replace default adapters of session, their connections are closed """
+        for adapter in session.adapters.values():
+            if adapter is not self:
+                adapter.close()
+        session.mount('http://', self)
+        session.mount('https://', self)
+
+    def stats(self):
+        """
+        Counters of pools of hosts which are currently kept, `handshakes`
+        is count of opened connections
+        """
+        requests_count = handshakes = 0
+        for key in self.poolmanager.pools.keys():
+            pool = self.poolmanager.pools.get(key)
+            if pool is not None:
+                requests_count += pool.num_requests
+                handshakes += pool.num_connections
+        reused = max(requests_count - handshakes, 0)
+        return {
+            'requests': requests_count,
+            'handshakes': handshakes,
+            'reused': reused,
+            'reuse_rate': round(reused * 1.0 / requests_count, 3) if requests_count else 0
+        }
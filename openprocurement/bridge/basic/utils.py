@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import inspect
 import os
 from pytz import timezone
 from uuid import uuid4
@@ -18,3 +19,23 @@ def journal_context(record={}, params={}):
 
 def generate_req_id():
     return b'contracting-data-bridge-req-' + str(uuid4()).encode('ascii')
+
+
+def accepted_kwargs(plugin, kwargs):
+    """
+    Select keyword arguments which plugin constructor accepts, so worker and
+    filter plugins with older constructor signature still can be spawned.
+
+    :param plugin: Worker or filter plugin class
+    :param dict kwargs: Keyword arguments bridge can pass to plugin
+    :return: Dict of accepted keyword arguments
+    :rtype: dict
+    """
+    try:
+        spec = inspect.getargspec(plugin.__init__)
+    except TypeError:
+        # Constructor isn't python function, e.g. inherited from Greenlet
+        return {}
+    if spec.keywords:
+        return kwargs
+    return {key: value for key, value in kwargs.items() if key in spec.args}
@@ -2,21 +2,27 @@
 from gevent import monkey
 monkey.patch_all()
 
+import json
 import logging
 import logging.config
 import os
 
+from collections import deque
 from datetime import datetime
+from functools import partial
 from time import time
 
-from gevent import Greenlet, sleep
+from gevent import Greenlet, get_hub, sleep
+from gevent.pool import Pool
 from gevent.queue import Empty
 from iso8601 import parse_date
+from munch import munchify
 from pytz import timezone
 from requests.exceptions import ConnectionError
 from zope.interface import implementer
 
 from openprocurement_client.exceptions import (
+    http_exceptions_dict,
     InvalidResponse,
     RequestFailed,
     ResourceNotFound,
@@ -24,12 +30,81 @@ from openprocurement_client.exceptions import (
 )
 from openprocurement.bridge.basic.constants import PROCUREMENT_METHOD_TYPE_HANDLERS as handlers_registry
 from openprocurement.bridge.basic.interfaces import IWorker
-from openprocurement.bridge.basic.utils import journal_context
+from openprocurement.bridge.basic.queues import PersistentPriorityQueue, item_key, next_mark
+from openprocurement.bridge.basic.utils import DataBridgeConfigError, journal_context
 
 
 logger = logging.getLogger(__name__)
 INFINITY = True
 TZ = timezone(os.environ['TZ'] if 'TZ' in os.environ else 'Europe/Kiev')
+# Service keys with revision (CouchDB) or version (ElasticSearch) of stored document
+REVISION_KEYS = ('_rev', '_ver')
+
+
+def refresh_revisions(db, docs):
+    """
+    Replace revisions read when documents were prefetched with current ones
+    right before bulk save, so documents saved meanwhile by other bulk don't
+    cause conflicts
+
+    :param dict docs: Dict where key: doc_id, value: document
+    """
+    meta = db.get_docs_meta(docs.keys())
+    for doc_id, doc in docs.items():
+        for key in REVISION_KEYS:
+            doc.pop(key, None)
+        for key, value in meta.get(doc_id, {}).items():
+            if key in REVISION_KEYS:
+                doc[key] = value
+
+
+def decode_document(body):
+    """ Decode API response body to Munch as API client does """
+    return munchify(json.loads(body))
+
+
+def ack_processed(queues, resource_item_id, mark=None):
+    """
+    Acknowledge entries of resource item taken from persistent queues before
+    mark, i.e. document is saved or dropped
+
+    :param queues: Queues where worker takes entries from and puts retries to
+    :param int mark: Mark from next_mark taken when processing started, all taken entries if None
+    """
+    for queue in queues:
+        if isinstance(queue, PersistentPriorityQueue):
+            queue.ack(resource_item_id, mark)
+
+
+def ack_entry(queues, item):
+    """ Acknowledge single entry taken from one of persistent queues """
+    for queue in queues:
+        if isinstance(queue, PersistentPriorityQueue) and queue.ack_entry(item):
+            return
+
+
+def client_succeeded(api_client_dict):
+    """ Increase requests rate of API client after successful request """
+    limiter = api_client_dict.get('limiter')
+    if limiter is not None:
+        limiter.success()
+        api_client_dict['request_interval'] = limiter.interval
+
+
+def client_throttled(api_client_dict, drop_threshold):
+    """
+    Decrease requests rate of API client after `429 Too Many Requests`,
+    cookies are dropped when requests interval exceeds drop_threshold seconds
+    """
+    limiter = api_client_dict.get('limiter')
+    if limiter is not None:
+        limiter.throttle()
+        api_client_dict['request_interval'] = limiter.interval
+    if api_client_dict['request_interval'] > drop_threshold:
+        api_client_dict['client'].session.cookies.clear()
+        if limiter is not None:
+            limiter.reset()
+        api_client_dict['request_interval'] = 0
 
 
 @implementer(IWorker)
@@ -37,11 +112,25 @@ class BasicResourceItemWorker(Greenlet):
 
     def __init__(self, api_clients_queue=None, resource_items_queue=None,
                  db=None, config_dict=None, retry_resource_items_queue=None,
-                 api_clients_info=None):
+                 api_clients_info=None, date_modified_cache=None, writer=None, retry_scheduler=None,
+                 dead_letters=None, validators_cache=None, content_hash_cache=None, in_flight_fetches=None):
         Greenlet.__init__(self)
         self.exit = False
         self.update_doc = False
         self.db = db
+        self.date_modified_cache = date_modified_cache
+        # Shared BulkWriter, when set documents are saved by it instead of own bulk
+        self.writer = writer
+        # Shared RetryScheduler, without it worker sleeps before putting item to retry queue
+        self.retry_scheduler = retry_scheduler
+        # DeadLetterStore for items dropped after retries_count retries
+        self.dead_letters = dead_letters
+        # ValidatorsCache for conditional requests to public API
+        self.validators_cache = validators_cache
+        # ContentHashCache, documents with not changed content aren't saved
+        self.content_hash_cache = content_hash_cache
+        # Shared InFlightRegistry, ids which are being fetched by other workers are dropped
+        self.in_flight_fetches = in_flight_fetches
         self.config = config_dict['worker_config']
         self.resource = config_dict['resource']
         self.api_clients_queue = api_clients_queue
@@ -49,12 +138,36 @@ class BasicResourceItemWorker(Greenlet):
         self.retry_resource_items_queue = retry_resource_items_queue
         self.bulk = {}
         self.priority_cache = {}
+        # doc_id -> mark of processing start, entries taken before it are acknowledged when bulk is saved
+        self.ack_marks = {}
         self.bulk_save_limit = self.config['bulk_save_limit']
         self.bulk_save_interval = self.config['bulk_save_interval']
+        # Full bulks are saved by flush greenlets while worker keeps fetching,
+        # worker blocks when max_outstanding_flushes bulks are being saved
+        self.max_outstanding_flushes = self.config.get('max_outstanding_flushes', 1)
+        self.flushes = Pool(self.max_outstanding_flushes or None)
+        # Items taken from queue at once, more than one pays off only with full local docs lookup
+        self.prefetch_size = self.config.get('prefetch_size', 1)
+        # Larger response bodies are decoded in hub thread pool, 0 - always decode in greenlet
+        self.threadpool_decode_size = self.config.get('threadpool_decode_size', 1024 * 1024)
+        # 'meta' - local docs aren't prefetched, revisions/versions are read right before save,
+        # 'full' - whole local docs are prefetched
+        self.local_docs_lookup = self.config.get('local_docs_lookup', 'meta')
+        # Items taken from queue with local docs: (priority, resource_item_id or feed item, local_resource_item)
+        self.prefetched = deque()
+        # Build documents from feed items which have all required fields instead of fetching them
+        self.feed_only = self.config.get('feed_only', False)
+        if self.feed_only and not self.config.get('feed_required_fields'):
+            # Feed items have only id and dateModified by default, such stubs would replace stored documents
+            raise DataBridgeConfigError(
+                'Feed-only mode requires non-empty \'feed_required_fields\' in \'worker_config\'')
+        self.feed_required_fields = set(self.config.get('feed_required_fields', [])) | {'id', 'dateModified'}
+        self.feed_documents = 0
+        self.feed_fallbacks = 0
         self.start_time = datetime.now()
         self.api_clients_info = api_clients_info
 
-    def add_to_retry_queue(self, resource_item_id, priority=0, status_code=0):
+    def add_to_retry_queue(self, resource_item_id, priority=0, status_code=0, error=None):
         retries_count = priority - 1000 if priority >= 1000 else priority
         if retries_count > self.config['retries_count'] and status_code != 429:
             logger.critical(
@@ -62,16 +175,34 @@ class BasicResourceItemWorker(Greenlet):
                     self.resource[:-1].title(), resource_item_id, self.config['retries_count']),
                 extra={'MESSAGE_ID': 'dropped_documents'}
             )
+            if self.dead_letters is not None:
+                self.dead_letters.add((priority, resource_item_id), error=error, status_code=status_code)
+            self.ack(resource_item_id)
+            return
+        if resource_item_id in self.retry_resource_items_queue or (
+                self.retry_scheduler is not None and resource_item_id in self.retry_scheduler):
+            logger.debug('Skipped {} {}: In retry queue exist with same id'.format(self.resource[:-1],
+                                                                                  resource_item_id),
+                         extra={'MESSAGE_ID': 'skipped'})
             return
         timeout = 0
         if status_code != 429:
             timeout = self.config['retry_default_timeout'] * retries_count
             priority += 1
-        sleep(timeout)
-        self.retry_resource_items_queue.put((priority, resource_item_id))
+        if self.retry_scheduler is not None:
+            self.retry_scheduler.schedule((priority, resource_item_id), timeout)
+        else:
+            sleep(timeout)
+            self.retry_resource_items_queue.put((priority, resource_item_id))
         logger.info('Put to \'retry_queue\' {}: {}'.format(self.resource[:-1], resource_item_id),
                     extra={'MESSAGE_ID': 'add_to_retry'})
 
+    def ack(self, resource_item_id, mark=None):
+        ack_processed((self.resource_items_queue, self.retry_resource_items_queue), resource_item_id, mark)
+
+    def ack_entry(self, item):
+        ack_entry((self.resource_items_queue, self.retry_resource_items_queue), item)
+
     def _get_api_client_dict(self):
         if not self.api_clients_queue.empty():
             try:
@@ -81,14 +212,18 @@ class BasicResourceItemWorker(Greenlet):
             if self.api_clients_info[api_client_dict['id']]['drop_cookies']:
                 try:
                     api_client_dict['client'].renew_cookies()
+                    request_durations = self.api_clients_info[api_client_dict['id']]['request_durations']
+                    request_durations.reset()
                     self.api_clients_info[api_client_dict['id']] = {
                         'drop_cookies': False,
-                        'request_durations': {},
+                        'request_durations': request_durations,
                         'request_interval': 0,
                         'avg_duration': 0
                     }
                     api_client_dict['request_interval'] = 0
                     api_client_dict['not_actual_count'] = 0
+                    if api_client_dict.get('limiter') is not None:
+                        api_client_dict['limiter'].reset()
                     logger.info('Drop lazy api_client {} cookies'.format(api_client_dict['id']))
                 except (Exception, ConnectionError) as e:
                     self.api_clients_queue.put(api_client_dict)
@@ -107,7 +242,10 @@ class BasicResourceItemWorker(Greenlet):
                     'REQUESTS_TIMEOUT': api_client_dict['request_interval']
                 }
             )
-            sleep(api_client_dict['request_interval'])
+            # Clients queue hands out client which is ready first, so worker waits only when all clients are throttled
+            delay = api_client_dict['limiter'].acquire() if api_client_dict.get('limiter') is not None else 0
+            if delay:
+                sleep(delay)
             return api_client_dict
         else:
             return None
@@ -116,24 +254,122 @@ class BasicResourceItemWorker(Greenlet):
         priority = resource_item_id = None
         if not self.resource_items_queue.empty():
             priority, resource_item_id = self.resource_items_queue.get(timeout=self.config['queue_timeout'])
-            logger.debug('Get {} {} from main queue.'.format(self.resource[:-1], resource_item_id))
+            logger.debug('Get {} {} from main queue.'.format(self.resource[:-1],
+                                                             item_key((priority, resource_item_id))))
         return priority, resource_item_id
 
-    def _get_resource_item_from_public(self, api_client_dict, priority, resource_item_id):
+    def _acquire_fetch(self, api_client_dict, resource_item_id):
+        """
+        Register fetch in bridge-wide registry, API client is returned
+        to queue if resource item is already being fetched by other worker
+        """
+        if self.in_flight_fetches is None or self.in_flight_fetches.acquire(resource_item_id):
+            return True
+        self.api_clients_queue.put(api_client_dict)
+        logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
+        logger.debug('Skipped {} {}: Is being fetched by other worker'.format(self.resource[:-1], resource_item_id),
+                     extra={'MESSAGE_ID': 'skipped'})
+        return False
+
+    def _release_fetch(self, resource_item_id):
+        if self.in_flight_fetches is not None:
+            self.in_flight_fetches.release(resource_item_id)
+
+    def _get_feed_document(self, feed_item):
+        """
+        Build document from feed item in feed-only mode
+
+        :param feed_item: Feed item or resource item id
+        :return: Document or None if it should be fetched from public API
+        """
+        if not self.feed_only or not isinstance(feed_item, dict):
+            return None
+        if self.feed_required_fields.issubset(feed_item):
+            self.feed_documents += 1
+            return dict(feed_item)
+        self.feed_fallbacks += 1
+        logger.debug('Fetch {} {}: feed item misses required fields'.format(self.resource[:-1], feed_item['id']),
+                     extra={'MESSAGE_ID': 'feed_fallback'})
+        return None
+
+    def _get_resource_items_from_queue(self):
+        """
+        Take up to prefetch_size items from resource items queue
+
+        :return: List of tuples (priority, resource_item_id) or (priority, feed item)
+        :rtype: list
+        """
+        batch = []
+        while len(batch) < self.prefetch_size:
+            priority, resource_item_id = self._get_resource_item_from_queue()
+            if resource_item_id is None:
+                break
+            batch.append((priority, resource_item_id))
+        return batch
+
+    def _get_local_resource_items(self, resource_items_ids):
+        """
+        Only service keys of local docs are copied to public docs and they
+        are read again by refresh_revisions right before save, so by default
+        local docs aren't requested from storage here.
+        """
+        if self.local_docs_lookup == 'full':
+            return self.db.get_docs(resource_items_ids)
+        return {}
+
+    def _get_conditional_headers(self, resource_item_id, local_resource_item):
+        """
+        Get validators for conditional request when storage already has
+        version of document which validators belong to.
+
+        :return: Conditional request headers or None
+        """
+        if self.validators_cache is None:
+            return None
+        date_modified = self.validators_cache.get_date_modified(resource_item_id)
+        if date_modified is None:
+            return None
+        if local_resource_item is not None and 'dateModified' in local_resource_item:
+            fresh = local_resource_item['dateModified'] >= date_modified
+        else:
+            fresh = self.date_modified_cache is not None and self.date_modified_cache.is_fresh(resource_item_id,
+                                                                                               date_modified)
+        return self.validators_cache.headers(resource_item_id) if fresh else None
+
+    def _get_public_document(self, client, resource_item_id, headers=None):
+        """
+        Get resource item from public API like client.get_resource_item does.
+        Body of threadpool_decode_size bytes or more is decoded in hub thread
+        pool, so other greenlets run meanwhile.
+        """
+        response = client.request('GET', '{}/{}'.format(client.prefix_path, resource_item_id), headers=headers)
+        if response.status_code >= 400:
+            # client.request raises these itself, checked for clients which return any response
+            raise http_exceptions_dict.get(response.status_code, RequestFailed)(response)
+        if response.status_code != 200:
+            raise InvalidResponse(response)
+        body = response.content
+        if self.threadpool_decode_size and len(body) >= self.threadpool_decode_size:
+            return get_hub().threadpool.apply(decode_document, (body,))
+        return decode_document(body)
+
+    def _get_resource_item_from_public(self, api_client_dict, priority, resource_item_id, headers=None, mark=None):
         try:
             logger.debug('Request interval {} sec. for client {}'.format(
                 api_client_dict['request_interval'], api_client_dict['client'].session.headers['User-Agent']),
                 extra={'REQUESTS_TIMEOUT': api_client_dict['request_interval']})
             start = time()
-            public_resource_item = api_client_dict['client'].get_resource_item(resource_item_id).get('data')
-            self.api_clients_info[api_client_dict['id']]['request_durations'][datetime.now()] = time() - start
+            public_resource_item = self._get_public_document(api_client_dict['client'], resource_item_id,
+                                                             headers).get('data')
+            self.api_clients_info[api_client_dict['id']]['request_durations'].add(time() - start)
             self.api_clients_info[api_client_dict['id']]['request_interval'] = api_client_dict['request_interval']
             logger.debug(
                 'Recieved from API {}: {} {}'.format(self.resource[:-1], public_resource_item['id'],
                                                      public_resource_item['dateModified'])
             )
-            if api_client_dict['request_interval'] > 0:
-                api_client_dict['request_interval'] -= self.config['client_dec_step_timeout']
+            if self.validators_cache is not None:
+                self.validators_cache.put_date_modified(resource_item_id, public_resource_item['dateModified'])
+            client_succeeded(api_client_dict)
             self.api_clients_queue.put(api_client_dict)
             logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
             return public_resource_item
@@ -141,31 +377,34 @@ class BasicResourceItemWorker(Greenlet):
             self.api_clients_queue.put(api_client_dict)
             logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
             logger.info('{} {} archived.'.format(self.resource[:-1].title(), resource_item_id))
+            self.ack(resource_item_id, mark)
             return None  # Archived
         except InvalidResponse as e:
-            self.api_clients_info[api_client_dict['id']]['request_durations'][datetime.now()] = time() - start
+            self.api_clients_info[api_client_dict['id']]['request_durations'].add(time() - start)
             self.api_clients_info[api_client_dict['id']]['request_interval'] = api_client_dict['request_interval']
             self.api_clients_queue.put(api_client_dict)
             logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
+            if e.status_code == 304 and headers:
+                self.validators_cache.put_not_modified(resource_item_id)
+                logger.debug('{} {} not modified'.format(self.resource[:-1].title(), resource_item_id),
+                             extra={'MESSAGE_ID': 'not_modified'})
+                self.ack(resource_item_id, mark)
+                return None  # Storage already has this version
             logger.error(
                 'Error while getting {} {} from public with status code: {}'.format(
                     self.resource[:-1], resource_item_id, e.status_code),
                 extra={'MESSAGE_ID': 'exceptions'})
-            self.add_to_retry_queue(resource_item_id, priority=priority)
+            self.add_to_retry_queue(resource_item_id, priority=priority,
+                                    error='Invalid response with status code {}'.format(e.status_code))
             return None
         except RequestFailed as e:
-            self.api_clients_info[api_client_dict['id']]['request_durations'][datetime.now()] = time() - start
+            self.api_clients_info[api_client_dict['id']]['request_durations'].add(time() - start)
             self.api_clients_info[api_client_dict['id']]['request_interval'] = api_client_dict['request_interval']
             if e.status_code == 429:
-                if api_client_dict['request_interval'] > self.config['drop_threshold_client_cookies']:
-                    api_client_dict['client'].session.cookies.clear()
-                    api_client_dict['request_interval'] = 0
-                else:
-                    api_client_dict['request_interval'] += self.config['client_inc_step_timeout']
-                self.api_clients_queue.put(api_client_dict, timeout=api_client_dict['request_interval'])
-                logger.warning('PUT API CLIENT: {} after {} sec.'.format(api_client_dict['id'],
-                                                                         api_client_dict['request_interval']),
-                               extra={'MESSAGE_ID': 'put_client'})
+                client_throttled(api_client_dict, self.config['drop_threshold_client_cookies'])
+                self.api_clients_queue.put(api_client_dict)
+                logger.warning('PUT API CLIENT: {} with requests interval {} sec.'.format(
+                    api_client_dict['id'], api_client_dict['request_interval']), extra={'MESSAGE_ID': 'put_client'})
             else:
                 self.api_clients_queue.put(api_client_dict)
                 logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
@@ -173,22 +412,23 @@ class BasicResourceItemWorker(Greenlet):
                 'Request failed while getting {} {} from public with status code {}: '.format(
                     self.resource[:-1], resource_item_id, e.status_code),
                 extra={'MESSAGE_ID': 'exceptions'})
-            self.add_to_retry_queue(resource_item_id, priority=priority, status_code=e.status_code)
+            self.add_to_retry_queue(resource_item_id, priority=priority, status_code=e.status_code,
+                                    error='Request failed')
             return None  # request failed
         except ResourceNotFound as e:
-            self.api_clients_info[api_client_dict['id']]['request_durations'][datetime.now()] = time() - start
+            self.api_clients_info[api_client_dict['id']]['request_durations'].add(time() - start)
             self.api_clients_info[api_client_dict['id']]['request_interval'] = api_client_dict['request_interval']
             logger.error('Resource not found {} at public: {}. {}'.format(self.resource[:-1],
                                                                           resource_item_id, e.message),
                          extra={'MESSAGE_ID': 'not_found_docs'})
             api_client_dict['client'].session.cookies.clear()
             logger.info('Clear client cookies')
-            self.add_to_retry_queue(resource_item_id, priority=priority)
+            self.add_to_retry_queue(resource_item_id, priority=priority, status_code=404, error='Not found')
             self.api_clients_queue.put(api_client_dict)
             logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
             return None  # not found
         except Exception as e:
-            self.api_clients_info[api_client_dict['id']]['request_durations'][datetime.now()] = time() - start
+            self.api_clients_info[api_client_dict['id']]['request_durations'].add(time() - start)
             self.api_clients_info[api_client_dict['id']]['request_interval'] = api_client_dict['request_interval']
             self.api_clients_queue.put(api_client_dict)
             logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
@@ -196,10 +436,10 @@ class BasicResourceItemWorker(Greenlet):
                 'Error while getting resource item {} {} from public {}: '.format(
                     self.resource[:-1], resource_item_id, e.message),
                 extra={'MESSAGE_ID': 'exceptions'})
-            self.add_to_retry_queue(resource_item_id, priority=priority)
+            self.add_to_retry_queue(resource_item_id, priority=priority, error=repr(e))
         return None
 
-    def _add_to_bulk(self, local_item, public_item, priority):
+    def _prepare_doc(self, local_item, public_item):
         public_item['doc_type'] = self.resource[:-1].title()
         public_item['_id'] = public_item['id']
 
@@ -208,6 +448,29 @@ class BasicResourceItemWorker(Greenlet):
             for k in local_item:
                 if k.startswith('_'):
                     public_item[k] = local_item[k]
+        return public_item
+
+    def _is_unchanged(self, doc):
+        """
+        Check that storage already has document with same content, i.e. it
+        differs only by fields excluded from content hash. Cache has hashes
+        of saved documents only, so local doc isn't required.
+        """
+        if self.content_hash_cache is None or not self.content_hash_cache.is_unchanged(doc):
+            return False
+        if self.date_modified_cache is not None:
+            self.date_modified_cache.put(doc['id'], doc['dateModified'])
+        logger.debug('Skipped {} {}: content not changed'.format(self.resource[:-1], doc['id']),
+                     extra={'MESSAGE_ID': 'skipped'})
+        return True
+
+    def _add_to_bulk(self, local_item, public_item, priority, mark=None):
+        self._prepare_doc(local_item, public_item)
+        if self._is_unchanged(public_item):
+            self.ack(public_item['id'], mark)
+            return
+        if mark is not None:
+            self.ack_marks[public_item['id']] = max(mark, self.ack_marks.get(public_item['id'], mark))
 
         bulk_doc = self.bulk.get(public_item['id'])
 
@@ -237,53 +500,82 @@ class BasicResourceItemWorker(Greenlet):
         logger.debug('{} {} timeshift is {} sec.'.format(self.resource[:-1], resource_item['id'], ts),
                      extra={'DOCUMENT_TIMESHIFT': ts})
 
-    def _save_bulk_docs(self):
-        if (len(self.bulk) > self.bulk_save_limit or (datetime.now() - self.start_time).total_seconds() >
+    def _save_bulk_docs(self, force=False):
+        if (force or len(self.bulk) > self.bulk_save_limit or (datetime.now() - self.start_time).total_seconds() >
                 self.bulk_save_interval or self.exit):
-            try:
-                logger.debug('Try save bulk: {}'.format(len(self.bulk)), extra={'SAVE_BULK_LEN': len(self.bulk)})
-                start = time()
-                res = self.db.save_bulk(self.bulk)
-                end = time() - start
-                logger.debug('Bulk save duration: {} sec.'.format(end), extra={'SAVE_BULK_DURATION': end})
-                for resource_item in self.bulk.values():
-                    ts = (datetime.now(TZ) - parse_date(resource_item['dateModified'])).total_seconds()
-                    logger.debug(
-                        '{} {} timeshift is {} sec.'.format(self.resource[:-1], resource_item['id'], ts),
-                        extra={'DOCUMENT_TIMESHIFT': ts}
-                    )
-                logger.info('Save bulk {} docs to db.'.format(len(self.bulk)))
-            except Exception as e:
-                logger.error('Error while saving bulk_docs in db: {}'.format(e.message),
-                             extra={'MESSAGE_ID': 'exceptions'})
-                for doc in self.bulk.values():
-                    self.add_to_retry_queue(doc['id'], priority=self.priority_cache[doc['id']])
-                self.start_time = datetime.now()
-                self.priority_cache = {}
-                self.bulk = {}
-                return
-            for success, doc_id, rev_or_exc in res:
-                if success:
-                    if not rev_or_exc.startswith('1-'):
-                        logger.info('Update {} {}'.format(self.resource[:-1], doc_id),
-                                    extra={'MESSAGE_ID': 'update_documents'})
-                    else:
-                        logger.info('Save {} {}'.format(self.resource[:-1], doc_id),
-                                    extra={'MESSAGE_ID': 'save_documents'})
-                    continue
-                else:
-                    if rev_or_exc.message != u'New doc with oldest dateModified.':
-                        self.add_to_retry_queue(doc_id, priority=self.priority_cache[doc_id])
-                        logger.error('Put to retry queue {} {} with reason: {}'.format(self.resource[:-1],
-                                                                                       doc_id, rev_or_exc.message))
-                    else:
-                        logger.debug(
-                            'Ignored {} {} with reason: {}'.format(self.resource[:-1], doc_id, rev_or_exc),
-                            extra={'MESSAGE_ID': 'skiped'})
-                        continue
+            # Swap buffers, next bulk is filled while previous one is saved
+            bulk, priority_cache, ack_marks = self.bulk, self.priority_cache, self.ack_marks
             self.bulk = {}
             self.priority_cache = {}
+            self.ack_marks = {}
             self.start_time = datetime.now()
+            if not bulk:
+                return
+            if not self.max_outstanding_flushes:
+                self._flush_bulk(bulk, priority_cache, ack_marks)
+                return
+            if self.flushes.full():
+                logger.debug('Wait for bulk flush, outstanding flushes: {}'.format(len(self.flushes)),
+                             extra={'OUTSTANDING_FLUSHES': len(self.flushes)})
+            self.flushes.spawn(self._flush_bulk, bulk, priority_cache, ack_marks)
+
+    def _flush_bulk(self, bulk, priority_cache, ack_marks=None):
+        """
+        Save bulk to storage, failed documents go to retry queue
+
+        :param dict bulk: Dict where key: doc_id, value: document
+        :param dict priority_cache: Dict where key: doc_id, value: priority
+        :param dict ack_marks: Dict where key: doc_id, value: mark, queue entries of saved documents
+                               taken before mark are acknowledged
+        """
+        ack_marks = ack_marks or {}
+        try:
+            logger.debug('Try save bulk: {}'.format(len(bulk)), extra={'SAVE_BULK_LEN': len(bulk)})
+            start = time()
+            refresh_revisions(self.db, bulk)
+            res = self.db.save_bulk(bulk)
+            end = time() - start
+            logger.debug('Bulk save duration: {} sec.'.format(end), extra={'SAVE_BULK_DURATION': end})
+            for resource_item in bulk.values():
+                ts = (datetime.now(TZ) - parse_date(resource_item['dateModified'])).total_seconds()
+                logger.debug(
+                    '{} {} timeshift is {} sec.'.format(self.resource[:-1], resource_item['id'], ts),
+                    extra={'DOCUMENT_TIMESHIFT': ts}
+                )
+            logger.info('Save bulk {} docs to db.'.format(len(bulk)))
+        except Exception as e:
+            logger.error('Error while saving bulk_docs in db: {}'.format(e.message),
+                         extra={'MESSAGE_ID': 'exceptions'})
+            for doc in bulk.values():
+                self.add_to_retry_queue(doc['id'], priority=priority_cache[doc['id']], error=repr(e))
+            return
+        for success, doc_id, rev_or_exc in res:
+            if success or rev_or_exc.message == u'New doc with oldest dateModified.':
+                if doc_id in ack_marks:
+                    self.ack(doc_id, ack_marks[doc_id])
+            if success:
+                if rev_or_exc != 'skipped':
+                    if self.date_modified_cache is not None:
+                        self.date_modified_cache.put(doc_id, bulk[doc_id]['dateModified'])
+                    if self.content_hash_cache is not None:
+                        self.content_hash_cache.put(bulk[doc_id])
+                if not rev_or_exc.startswith('1-'):
+                    logger.info('Update {} {}'.format(self.resource[:-1], doc_id),
+                                extra={'MESSAGE_ID': 'update_documents'})
+                else:
+                    logger.info('Save {} {}'.format(self.resource[:-1], doc_id),
+                                extra={'MESSAGE_ID': 'save_documents'})
+                continue
+            else:
+                if rev_or_exc.message != u'New doc with oldest dateModified.':
+                    self.add_to_retry_queue(doc_id, priority=priority_cache[doc_id], error=rev_or_exc.message)
+                    logger.error('Put to retry queue {} {} with reason: {}'.format(self.resource[:-1],
+                                                                                   doc_id, rev_or_exc.message))
+                else:
+                    logger.debug(
+                        'Ignored {} {} with reason: {}'.format(self.resource[:-1], doc_id, rev_or_exc),
+                        extra={'MESSAGE_ID': 'skiped'})
+                    continue
 
     def _run(self):
         while not self.exit:
@@ -294,37 +586,80 @@ class BasicResourceItemWorker(Greenlet):
                 sleep(self.config['worker_sleep'])
                 continue
 
-            # Try get item from resource items queue
-            priority, resource_item_id = self._get_resource_item_from_queue()
-            if resource_item_id is None:
-                self.api_clients_queue.put(api_client_dict)
-                logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
-                logger.debug('Resource items queue is empty.')
-                sleep(self.config['worker_sleep'])
-                continue
+            if not self.prefetched:
+                # Try get items from resource items queue
+                batch = self._get_resource_items_from_queue()
+                if not batch:
+                    self.api_clients_queue.put(api_client_dict)
+                    logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
+                                 extra={'MESSAGE_ID': 'put_client'})
+                    logger.debug('Resource items queue is empty.')
+                    sleep(self.config['worker_sleep'])
+                    continue
 
-            try:
-                # Resource object from local db server
-                local_resource_item = self.db.get_doc(resource_item_id)
-            except Exception as e:
+                try:
+                    # Service keys of resource objects from local db server with single request
+                    local_resource_items = self._get_local_resource_items([item_key(entry) for entry in batch])
+                except Exception as e:
+                    self.api_clients_queue.put(api_client_dict)
+                    logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
+                                 extra={'MESSAGE_ID': 'put_client'})
+                    for entry in batch:
+                        self.add_to_retry_queue(item_key(entry), priority=entry[0], error=repr(e))
+                    logger.error('Error while getting resource item from couchdb: {}'.format(repr(e)),
+                                 extra={'MESSAGE_ID': 'exceptions'})
+                    continue
+                for priority, resource_item in batch:
+                    self.prefetched.append(
+                        (priority, resource_item, local_resource_items.get(item_key((priority, resource_item)))))
+            priority, resource_item, local_resource_item = self.prefetched.popleft()
+            resource_item_id = item_key((priority, resource_item))
+            # Entries of resource taken before this mark are acknowledged when document is saved
+            mark = next_mark()
+
+            public_resource_item = self._get_feed_document(resource_item)
+            if public_resource_item is not None:
                 self.api_clients_queue.put(api_client_dict)
                 logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
-                self.add_to_retry_queue(resource_item_id, priority=priority)
-                logger.error('Error while getting resource item from couchdb: {}'.format(repr(e)),
-                             extra={'MESSAGE_ID': 'exceptions'})
-                continue
+            else:
+                if not self._acquire_fetch(api_client_dict, resource_item_id):
+                    # Fetching worker saves the document
+                    self.ack_entry((priority, resource_item))
+                    continue
+                try:
+                    # Try get resource item from public server
+                    public_resource_item = self._get_resource_item_from_public(
+                        api_client_dict, priority, resource_item_id,
+                        headers=self._get_conditional_headers(resource_item_id, local_resource_item), mark=mark)
+                finally:
+                    self._release_fetch(resource_item_id)
+                if public_resource_item is None:
+                    continue
 
-            # Try get resource item from public server
-            public_resource_item = self._get_resource_item_from_public(api_client_dict, priority, resource_item_id)
-            if public_resource_item is None:
+            if self.writer is not None:
+                doc = self._prepare_doc(local_resource_item, public_resource_item)
+                if self._is_unchanged(doc):
+                    self.ack(resource_item_id, mark)
+                else:
+                    self.writer.put(doc, priority, self.add_to_retry_queue, partial(self.ack, mark=mark))
                 continue
 
             # Add docs to bulk
-            self._add_to_bulk(local_resource_item, public_resource_item, priority)
+            self._add_to_bulk(local_resource_item, public_resource_item, priority, mark)
 
             # Save/Update docs in db
             self._save_bulk_docs()
 
+        # Save rest of bulk on exit and wait for outstanding flushes
+        self._save_bulk_docs(force=True)
+        self.flushes.join()
+
+        # Return not processed items to queue
+        while self.prefetched:
+            priority, resource_item, _ = self.prefetched.popleft()
+            self.resource_items_queue.put((priority, resource_item))
+            self.ack_entry((priority, resource_item))
+
     def shutdown(self):
         self.exit = True
         logger.info('Worker complete his job.')
@@ -334,7 +669,11 @@ class BasicResourceItemWorker(Greenlet):
 class AgreementWorker(Greenlet):
 
     def __init__(self, api_clients_queue=None, resource_items_queue=None, db=None, config_dict=None,
-                 retry_resource_items_queue=None, api_clients_info=None):
+                 retry_resource_items_queue=None, api_clients_info=None, date_modified_cache=None, writer=None,
+                 retry_scheduler=None, dead_letters=None, validators_cache=None, content_hash_cache=None,
+                 in_flight_fetches=None):
+        # validators_cache and content_hash_cache are accepted for common spawn signature, but not used:
+        # documents are passed to handlers, not saved to storage
         Greenlet.__init__(self)
         logger.info("Init CloseFrameworkAgreement UA Worker")
         self.cache_db = db
@@ -347,10 +686,20 @@ class AgreementWorker(Greenlet):
         self.resource_items_queue = resource_items_queue
         self.retry_resource_items_queue = retry_resource_items_queue
         self.api_clients_info = api_clients_info
+        self.retry_scheduler = retry_scheduler
+        self.dead_letters = dead_letters
+        self.in_flight_fetches = in_flight_fetches
+        # Up to handlers_window resources are processed by handlers concurrently while worker fetches next ones,
+        # 0 - process inline
+        self.handlers_window = self.config.get('handlers_window', 1)
+        self.handlers_pool = Pool(self.handlers_window or None)
+        # resource id -> deque of (handler, priority, resource_item, public_resource_item, mark) waiting for processing,
+        # updates of same resource are processed in order by single greenlet
+        self.handling = {}
         self.start_time = datetime.now()
         self.exit = False
 
-    def add_to_retry_queue(self, resource_item, priority=0, status_code=0):
+    def add_to_retry_queue(self, resource_item, priority=0, status_code=0, error=None):
         retries_count = priority - 1000 if priority >= 1000 else priority
         if retries_count > self.config['retries_count'] and status_code != 429:
             logger.critical(
@@ -358,16 +707,34 @@ class AgreementWorker(Greenlet):
                     self.resource[:-1].title(), resource_item['id'], self.config['retries_count']),
                 extra=journal_context({'MESSAGE_ID': 'dropped_documents'}, {"TENDER_ID": resource_item['id']})
             )
+            if self.dead_letters is not None:
+                self.dead_letters.add((priority, resource_item), error=error, status_code=status_code)
+            self.ack(resource_item['id'])
+            return
+        if resource_item['id'] in self.retry_resource_items_queue or (
+                self.retry_scheduler is not None and resource_item['id'] in self.retry_scheduler):
+            logger.debug('Skipped {} {}: In retry queue exist with same id'.format(self.resource[:-1],
+                                                                                  resource_item['id']),
+                         extra={'MESSAGE_ID': 'skipped'})
             return
         timeout = 0
         if status_code != 429:
             timeout = self.config['retry_default_timeout'] * retries_count
             priority += 1
-        sleep(timeout)
-        self.retry_resource_items_queue.put((priority, resource_item))
+        if self.retry_scheduler is not None:
+            self.retry_scheduler.schedule((priority, resource_item), timeout)
+        else:
+            sleep(timeout)
+            self.retry_resource_items_queue.put((priority, resource_item))
         logger.info('Put to \'retry_queue\' {}: {}'.format(self.resource[:-1], resource_item['id']),
                     extra={'MESSAGE_ID': 'add_to_retry'})
 
+    def ack(self, resource_item_id, mark=None):
+        ack_processed((self.resource_items_queue, self.retry_resource_items_queue), resource_item_id, mark)
+
+    def ack_entry(self, item):
+        ack_entry((self.resource_items_queue, self.retry_resource_items_queue), item)
+
     def _get_api_client_dict(self):
         if not self.api_clients_queue.empty():
             try:
@@ -377,14 +744,18 @@ class AgreementWorker(Greenlet):
             if self.api_clients_info[api_client_dict['id']]['drop_cookies']:
                 try:
                     api_client_dict['client'].renew_cookies()
+                    request_durations = self.api_clients_info[api_client_dict['id']]['request_durations']
+                    request_durations.reset()
                     self.api_clients_info[api_client_dict['id']] = {
                         'drop_cookies': False,
-                        'request_durations': {},
+                        'request_durations': request_durations,
                         'request_interval': 0,
                         'avg_duration': 0
                     }
                     api_client_dict['request_interval'] = 0
                     api_client_dict['not_actual_count'] = 0
+                    if api_client_dict.get('limiter') is not None:
+                        api_client_dict['limiter'].reset()
                     logger.debug('Drop lazy api_client {} cookies'.format(api_client_dict['id']))
                 except (Exception, ConnectionError) as e:
                     self.api_clients_queue.put(api_client_dict)
@@ -399,24 +770,26 @@ class AgreementWorker(Greenlet):
                 ),
                 extra={'MESSAGE_ID': 'get_client', 'REQUESTS_TIMEOUT': api_client_dict['request_interval']}
             )
-            sleep(api_client_dict['request_interval'])
+            # Clients queue hands out client which is ready first, so worker waits only when all clients are throttled
+            delay = api_client_dict['limiter'].acquire() if api_client_dict.get('limiter') is not None else 0
+            if delay:
+                sleep(delay)
             return api_client_dict
         else:
             return None
 
-    def _get_resource_item_from_public(self, api_client_dict, priority, resource_item):
+    def _get_resource_item_from_public(self, api_client_dict, priority, resource_item, mark=None):
         try:
             logger.debug('Request interval {} sec. for client {}'.format(
                 api_client_dict['request_interval'], api_client_dict['client'].session.headers['User-Agent']),
                 extra={'REQUESTS_TIMEOUT': api_client_dict['request_interval']})
             start = time()
             public_resource_item = api_client_dict['client'].get_resource_item(resource_item['id']).get('data')
-            self.api_clients_info[api_client_dict['id']]['request_durations'][datetime.now()] = time() - start
+            self.api_clients_info[api_client_dict['id']]['request_durations'].add(time() - start)
             self.api_clients_info[api_client_dict['id']]['request_interval'] = api_client_dict['request_interval']
             logger.debug('Recieved from API {}: {} {}'.format(self.resource[:-1], public_resource_item['id'],
                                                               public_resource_item['dateModified']))
-            if api_client_dict['request_interval'] > 0:
-                api_client_dict['request_interval'] -= self.config['client_dec_step_timeout']
+            client_succeeded(api_client_dict)
             self.api_clients_queue.put(api_client_dict)
             logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
             return public_resource_item
@@ -424,9 +797,10 @@ class AgreementWorker(Greenlet):
             self.api_clients_queue.put(api_client_dict)
             logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
             logger.info('{} {} archived.'.format(self.resource[:-1].title(), resource_item['id']))
+            self.ack(resource_item['id'], mark)
             return None  # Archived
         except InvalidResponse as e:
-            self.api_clients_info[api_client_dict['id']]['request_durations'][datetime.now()] = time() - start
+            self.api_clients_info[api_client_dict['id']]['request_durations'].add(time() - start)
             self.api_clients_info[api_client_dict['id']]['request_interval'] = api_client_dict['request_interval']
             self.api_clients_queue.put(api_client_dict)
             logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
@@ -434,21 +808,17 @@ class AgreementWorker(Greenlet):
                 'Error while getting {} {} from public with status code: {}'.format(self.resource[:-1],
                                                                                     resource_item['id'], e.status_code),
                 extra={'MESSAGE_ID': 'exceptions'})
-            self.add_to_retry_queue(resource_item, priority=priority)
+            self.add_to_retry_queue(resource_item, priority=priority,
+                                    error='Invalid response with status code {}'.format(e.status_code))
             return None
         except RequestFailed as e:
-            self.api_clients_info[api_client_dict['id']]['request_durations'][datetime.now()] = time() - start
+            self.api_clients_info[api_client_dict['id']]['request_durations'].add(time() - start)
             self.api_clients_info[api_client_dict['id']]['request_interval'] = api_client_dict['request_interval']
             if e.status_code == 429:
-                if api_client_dict['request_interval'] > self.config['drop_threshold_client_cookies']:
-                    api_client_dict['client'].session.cookies.clear()
-                    api_client_dict['request_interval'] = 0
-                else:
-                    api_client_dict['request_interval'] += self.config['client_inc_step_timeout']
-                self.api_clients_queue.put(api_client_dict, timeout=api_client_dict['request_interval'])
-                logger.warning('PUT API CLIENT: {} after {} sec.'.format(api_client_dict['id'],
-                                                                         api_client_dict['request_interval']),
-                               extra={'MESSAGE_ID': 'put_client'})
+                client_throttled(api_client_dict, self.config['drop_threshold_client_cookies'])
+                self.api_clients_queue.put(api_client_dict)
+                logger.warning('PUT API CLIENT: {} with requests interval {} sec.'.format(
+                    api_client_dict['id'], api_client_dict['request_interval']), extra={'MESSAGE_ID': 'put_client'})
             else:
                 self.api_clients_queue.put(api_client_dict)
                 logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
@@ -456,10 +826,11 @@ class AgreementWorker(Greenlet):
                 'Request failed while getting {} {} from public with status code {}: '.format(
                     self.resource[:-1], resource_item['id'], e.status_code),
                 extra={'MESSAGE_ID': 'exceptions'})
-            self.add_to_retry_queue(resource_item, priority=priority, status_code=e.status_code)
+            self.add_to_retry_queue(resource_item, priority=priority, status_code=e.status_code,
+                                    error='Request failed')
             return None  # request failed
         except ResourceNotFound as e:
-            self.api_clients_info[api_client_dict['id']]['request_durations'][datetime.now()] = time() - start
+            self.api_clients_info[api_client_dict['id']]['request_durations'].add(time() - start)
             self.api_clients_info[api_client_dict['id']]['request_interval'] = api_client_dict['request_interval']
             logger.error('Resource not found {} at public: {}. {}'.format(self.resource[:-1],
                                                                           resource_item['id'], e.message),
@@ -467,11 +838,11 @@ class AgreementWorker(Greenlet):
             api_client_dict['client'].session.cookies.clear()
             logger.debug('Clear client cookies')
             self.api_clients_queue.put(api_client_dict)
-            self.add_to_retry_queue(resource_item, priority=priority)
+            self.add_to_retry_queue(resource_item, priority=priority, status_code=404, error='Not found')
             logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
             return None  # not found
         except Exception as e:
-            self.api_clients_info[api_client_dict['id']]['request_durations'][datetime.now()] = time() - start
+            self.api_clients_info[api_client_dict['id']]['request_durations'].add(time() - start)
             self.api_clients_info[api_client_dict['id']]['request_interval'] = api_client_dict['request_interval']
             self.api_clients_queue.put(api_client_dict)
             logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
@@ -479,7 +850,7 @@ class AgreementWorker(Greenlet):
                 'Error while getting resource item {} {} from public {}: '.format(self.resource[:-1],
                                                                                   resource_item['id'], e.message),
                 extra={'MESSAGE_ID': 'exceptions'})
-            self.add_to_retry_queue(resource_item, priority=priority)
+            self.add_to_retry_queue(resource_item, priority=priority, error=repr(e))
         return None
 
     def _get_resource_item_from_queue(self):
@@ -526,27 +897,74 @@ class AgreementWorker(Greenlet):
                 )
                 continue
 
-            # Try get resource item from public server
-            public_resource_item = self._get_resource_item_from_public(api_client_dict, priority, resource_item)
+            # Entries of resource taken before this mark are acknowledged when it is processed
+            mark = next_mark()
+            if self.in_flight_fetches is not None and not self.in_flight_fetches.acquire(resource_item['id']):
+                self.ack_entry((priority, resource_item))
+                self.api_clients_queue.put(api_client_dict)
+                logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']), extra={'MESSAGE_ID': 'put_client'})
+                logger.debug('Skipped {} {}: Is being fetched by other worker'.format(self.resource[:-1],
+                                                                                      resource_item['id']),
+                             extra={'MESSAGE_ID': 'skipped'})
+                continue
+            try:
+                # Try get resource item from public server
+                public_resource_item = self._get_resource_item_from_public(api_client_dict, priority, resource_item,
+                                                                           mark)
+            finally:
+                if self.in_flight_fetches is not None:
+                    self.in_flight_fetches.release(resource_item['id'])
             if public_resource_item is None:
                 continue
 
-            try:
-                handler.process_resource(public_resource_item)
-            except RequestFailed as e:
-                logger.error(
-                    "Error while processing {} {}: {}".format(self.resource[:-1], resource_item['id'], e.message),
-                    extra=journal_context({"MESSAGE_ID": "bridge_worker_exception"},
-                                          {self.input_resource_id: resource_item['id']})
-                )
-                self.add_to_retry_queue(resource_item, priority)
-            except Exception as e:
-                logger.error(
-                    "Error while processing {} {}: {}".format(self.resource[:-1], resource_item['id'], e.message),
-                    extra=journal_context({"MESSAGE_ID": "bridge_worker_exception"},
-                                          {self.input_resource_id: resource_item['id']})
-                )
-                self.add_to_retry_queue(resource_item, priority)
+            if not self.handlers_window:
+                self._process_resource(handler, priority, resource_item, public_resource_item, mark)
+            else:
+                self._schedule_processing(handler, priority, resource_item, public_resource_item, mark)
+
+        # Wait for scheduled processing
+        self.handlers_pool.join()
+
+    def _process_resource(self, handler, priority, resource_item, public_resource_item, mark=None):
+        try:
+            handler.process_resource(public_resource_item)
+            self.ack(resource_item['id'], mark)
+        except RequestFailed as e:
+            logger.error(
+                "Error while processing {} {}: {}".format(self.resource[:-1], resource_item['id'], e.message),
+                extra=journal_context({"MESSAGE_ID": "bridge_worker_exception"},
+                                      {self.input_resource_id: resource_item['id']})
+            )
+            self.add_to_retry_queue(resource_item, priority, error=repr(e))
+        except Exception as e:
+            logger.error(
+                "Error while processing {} {}: {}".format(self.resource[:-1], resource_item['id'], e.message),
+                extra=journal_context({"MESSAGE_ID": "bridge_worker_exception"},
+                                      {self.input_resource_id: resource_item['id']})
+            )
+            self.add_to_retry_queue(resource_item, priority, error=repr(e))
+
+    def _schedule_processing(self, handler, priority, resource_item, public_resource_item, mark=None):
+        """
+        Process resource in handlers pool, blocks while handlers_window resources are being processed.
+        Update of resource which is being processed waits for previous one.
+        """
+        resource_item_id = resource_item['id']
+        pending = self.handling.get(resource_item_id)
+        if pending is not None:
+            pending.append((handler, priority, resource_item, public_resource_item, mark))
+            logger.debug('Wait for processing of previous {} {} update'.format(self.resource[:-1], resource_item_id))
+            return
+        self.handling[resource_item_id] = deque([(handler, priority, resource_item, public_resource_item, mark)])
+        self.handlers_pool.spawn(self._process_pending, resource_item_id)
+
+    def _process_pending(self, resource_item_id):
+        pending = self.handling[resource_item_id]
+        try:
+            while pending:
+                self._process_resource(*pending.popleft())
+        finally:
+            del self.handling[resource_item_id]
 
     def shutdown(self):
         self.exit = True
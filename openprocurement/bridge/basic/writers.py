@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import logging
+from datetime import datetime
+from time import time
+
+from gevent import spawn
+from gevent.event import Event
+from iso8601 import parse_date
+
+from openprocurement.bridge.basic.workers import TZ, refresh_revisions
+
+
+logger = logging.getLogger(__name__)
+INFINITY = True
+# Weight of last save duration in average save latency
+LATENCY_EWMA_WEIGHT = 0.3
+
+
+class BulkWriter(object):
+    """
+    Bridge-wide write stage shared by all workers.
+
+    Workers put fetched documents, writer merges them by id keeping the newest
+    dateModified and saves bulk to storage when it has bulk_save_limit
+    documents, bulk_save_bytes of JSON or when the oldest document waits
+    bulk_save_interval seconds.
+
+    Bulks are saved concurrently by up to `writers` greenlets. Count starts
+    from writers_min, grows up to writers_max while all writers are busy and
+    average save latency is below writer_latency_target seconds and shrinks
+    when latency exceeds it, i.e. storage is saturated.
+
+    :param db: Storage object
+    :param dict config: Databridge config
+    :param date_modified_cache: Cache updated with dateModified of saved documents
+    :param content_hash_cache: Cache updated with content hash of saved documents
+    """
+
+    def __init__(self, db, config, date_modified_cache=None, content_hash_cache=None):
+        self.db = db
+        self.dispatcher = None
+        self.date_modified_cache = date_modified_cache
+        self.content_hash_cache = content_hash_cache
+        self.resource = config['resource']
+        worker_config = config['worker_config']
+        self.bulk_save_limit = worker_config['bulk_save_limit']
+        self.bulk_save_interval = worker_config['bulk_save_interval']
+        self.bulk_save_bytes = worker_config.get('bulk_save_bytes', 10 * 1024 * 1024)
+        self.writers_min = worker_config.get('writers_min', 1)
+        self.writers_max = worker_config.get('writers_max', 4)
+        self.latency_target = worker_config.get('writer_latency_target', 1)
+        self.writers = self.writers_min
+        self.busy = 0
+        self.latency = 0.0
+        self.saved = 0
+        # doc_id -> (doc, priority, retry callback, JSON size, ack callbacks)
+        self.bulk = {}
+        self.bulk_bytes = 0
+        self.bulk_start = None
+        # Set when bulk may be due or first document is added
+        self.wakeup = Event()
+        # Set when one of writers is done
+        self.writer_done = Event()
+
+    def put(self, doc, priority, retry, ack=None):
+        """
+        Add document to bulk. Blocks while bulk has twice bulk_save_limit
+        documents, i.e. all writers are busy and storage doesn't keep up.
+
+        :param dict doc: Document prepared for storage
+        :param int priority: Queue priority of document
+        :param callable retry: Called as retry(doc_id, priority=priority, error=error) when document isn't saved
+        :param callable ack: Called as ack(doc_id) when document or newer one is saved
+        """
+        while len(self.bulk) >= self.bulk_save_limit * 2:
+            self.writer_done.clear()
+            self.writer_done.wait()
+        doc_id = doc['id']
+        acks = [ack] if ack is not None else []
+        current = self.bulk.get(doc_id)
+        if current is not None:
+            priority = min(priority, current[1])
+            acks = current[4] + acks
+            if current[0]['dateModified'] >= doc['dateModified']:
+                logger.debug(
+                    'Ignored dublicate {} {} in bulk: previous {}, current {}'.format(
+                        self.resource[:-1], doc_id, current[0]['dateModified'], doc['dateModified']),
+                    extra={'MESSAGE_ID': 'skipped'})
+                self.bulk[doc_id] = (current[0], priority, current[2], current[3], acks)
+                return
+            logger.debug(
+                'Replaced {} in bulk {} previous {}, current {}'.format(
+                    self.resource[:-1], doc_id, current[0]['dateModified'], doc['dateModified']),
+                extra={'MESSAGE_ID': 'skipped'})
+            self.bulk_bytes -= current[3]
+        else:
+            logger.debug('Put in bulk {} {} {}'.format(self.resource[:-1], doc_id, doc['dateModified']),
+                         extra={'MESSAGE_ID': 'add_to_save_bulk'})
+        size = len(json.dumps(doc))
+        self.bulk[doc_id] = (doc, priority, retry, size, acks)
+        self.bulk_bytes += size
+        if self.bulk_start is None:
+            self.bulk_start = time()
+            self.wakeup.set()
+        elif self._bulk_due():
+            self.wakeup.set()
+
+    def _bulk_due(self):
+        return (len(self.bulk) >= self.bulk_save_limit or self.bulk_bytes >= self.bulk_save_bytes or
+                time() - self.bulk_start >= self.bulk_save_interval)
+
+    def _wait_writer(self):
+        while self.busy >= self.writers:
+            if self.writers < self.writers_max and self.latency <= self.latency_target:
+                self.writers += 1
+                logger.info('Writers count increased to {}'.format(self.writers), extra={'WRITERS': self.writers})
+                return
+            self.writer_done.clear()
+            self.writer_done.wait()
+
+    def _dispatch(self):
+        bulk = self.bulk
+        self.bulk = {}
+        self.bulk_bytes = 0
+        self.bulk_start = None
+        self.busy += 1
+        return spawn(self._save, bulk)
+
+    def _save(self, bulk):
+        failed = []
+        done = []
+        try:
+            docs = {doc_id: entry[0] for doc_id, entry in bulk.items()}
+            logger.debug('Try save bulk: {}'.format(len(docs)), extra={'SAVE_BULK_LEN': len(docs)})
+            start = time()
+            try:
+                refresh_revisions(self.db, docs)
+                res = self.db.save_bulk(docs)
+            except Exception as e:
+                logger.error('Error while saving bulk_docs in db: {}'.format(e.message),
+                             extra={'MESSAGE_ID': 'exceptions'})
+                failed = [(doc_id, repr(e)) for doc_id in bulk]
+                return
+            duration = time() - start
+            self._update_latency(duration)
+            logger.debug('Bulk save duration: {} sec.'.format(duration), extra={'SAVE_BULK_DURATION': duration})
+            logger.info('Save bulk {} docs to db.'.format(len(docs)))
+            for success, doc_id, rev_or_exc in res:
+                if success:
+                    done.append(doc_id)
+                    self.saved += 1
+                    if rev_or_exc != 'skipped':
+                        if self.date_modified_cache is not None:
+                            self.date_modified_cache.put(doc_id, docs[doc_id]['dateModified'])
+                        if self.content_hash_cache is not None:
+                            self.content_hash_cache.put(docs[doc_id])
+                    ts = (datetime.now(TZ) - parse_date(docs[doc_id]['dateModified'])).total_seconds()
+                    logger.debug('{} {} timeshift is {} sec.'.format(self.resource[:-1], doc_id, ts),
+                                 extra={'DOCUMENT_TIMESHIFT': ts})
+                elif rev_or_exc.message != u'New doc with oldest dateModified.':
+                    logger.error('Put to retry queue {} {} with reason: {}'.format(
+                        self.resource[:-1], doc_id, rev_or_exc.message))
+                    failed.append((doc_id, rev_or_exc.message))
+                else:
+                    done.append(doc_id)
+                    logger.debug('Ignored {} {} with reason: {}'.format(self.resource[:-1], doc_id, rev_or_exc),
+                                 extra={'MESSAGE_ID': 'skiped'})
+        finally:
+            self.busy -= 1
+            self.writer_done.set()
+            for doc_id in done:
+                for ack in bulk[doc_id][4]:
+                    ack(doc_id)
+            # Retry may sleep, so it is called after writer is released
+            for doc_id, error in failed:
+                _, priority, retry, _, _ = bulk[doc_id]
+                retry(doc_id, priority=priority, error=error)
+
+    def flush(self):
+        """ Save pending documents and wait until all bulks are saved """
+        while self.bulk or self.busy:
+            if self.bulk:
+                self._wait_writer()
+                if self.bulk:
+                    self._dispatch()
+                continue
+            self.writer_done.clear()
+            self.writer_done.wait()
+
+    def _update_latency(self, duration):
+        if self.latency:
+            self.latency = LATENCY_EWMA_WEIGHT * duration + (1 - LATENCY_EWMA_WEIGHT) * self.latency
+        else:
+            self.latency = duration
+        if self.latency > self.latency_target and self.writers > self.writers_min:
+            self.writers -= 1
+            logger.info('Writers count decreased to {}'.format(self.writers), extra={'WRITERS': self.writers})
+
+    def stats(self):
+        return {
+            'writers': self.writers,
+            'busy': self.busy,
+            'pending': len(self.bulk),
+            'latency': round(self.latency * 1000, 3),
+            'saved': self.saved
+        }
+
+    def start(self):
+        """ Spawn greenlet which dispatches due bulks to writers """
+        self.dispatcher = spawn(self._run)
+        return self.dispatcher
+
+    def _run(self):
+        while INFINITY:
+            timeout = None
+            if self.bulk_start is not None:
+                timeout = max(self.bulk_save_interval - (time() - self.bulk_start), 0)
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+            if not self.bulk or not self._bulk_due():
+                continue
+            self._wait_writer()
+            # Bulk may be saved by flush meanwhile
+            if self.bulk:
+                self._dispatch()